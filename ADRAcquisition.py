@@ -0,0 +1,409 @@
+"""
+Instrument acquisition for the ADR Controller.  All GPIB communication happens on one background thread so that
+a slow or timed out instrument can't freeze the window or hold up the control loops.  The thread reads every
+instrument once per cycle, on deadlines that are phase locked to the SIM922's own update (see ADRScheduler), and
+puts the readings on a queue as timestamped Samples, and keeps the newest value of every quantity in a SampleHub.
+If the SIM922 hadn't measured again yet, it is read again every few tens of ms until it has, so each sample has
+a new reading as soon as there is one, and the samples it still hadn't measured again for are marked stale.
+The instruments are read in parallel (see ADRPipeline), so a cycle takes about as long as the slowest one.
+The mag up or regulation control loop, if one is running, is stepped right after each reading.  Anything else that needs
+the bus (ex: setting the power supply voltage) is submitted to the thread and run in between readings.
+"""
+
+import threading, Queue, time, numpy
+from ADRHistory import HISTORY_CHANNELS
+import ADRTiming
+from ADRScheduler import DeadlineScheduler, PhaseLock, BusArbiter, monotonic
+from ADRPipeline import runPipelined, callSteps
+
+SIM922_CHANNELS = ['60K', '3K', 'backEMF']
+
+""" One reading of all instruments.  timeStamp is time.time() at the start of the reading.  temps are the
+    60K, 3K, GGG and FAA temperatures in K; the RuOx temperatures are the last settled reading of that channel
+    (NaN if the channel isn't being read), and readTimes says when those were actually read.  Anything that
+    couldn't be read is NaN.  monotonicTime is the same moment on the monotonic clock, for time differences.
+    FAAEstimate is (FAA temperature, standard deviation) from the FAAEstimator, if there is one.  fresh is False
+    if the SIM922 hadn't measured again since the last sample, so the diode temperatures and the back EMF are
+    the same as last time (their readTimes then say when they were measured). """
+class Sample:
+    def __init__(self, timeStamp, temps, backEMF, current, voltage, psConnected, readTimes=None, monotonicTime=None,
+                 FAAEstimate=None, fresh=True):
+        self.timeStamp = timeStamp
+        self.monotonicTime = monotonicTime if monotonicTime is not None else timeStamp
+        self.temps = temps
+        self.backEMF = backEMF
+        self.current = current
+        self.voltage = voltage
+        self.psConnected = psConnected
+        self.readTimes = readTimes if readTimes is not None else {}
+        self.FAAEstimate = FAAEstimate
+        self.fresh = fresh
+    def values(self):
+        """Same order as ADRHistory.HISTORY_CHANNELS."""
+        return self.temps + [self.backEMF, self.current, self.voltage]
+    def value(self, name):
+        return self.values()[HISTORY_CHANNELS.index(name)]
+    def readTime(self, name):
+        """When the quantity name (one of HISTORY_CHANNELS) was read, or None if it never was."""
+        return self.readTimes.get(name, self.timeStamp)
+
+class StaleDataError(Exception):
+    pass
+
+""" The newest reading of every quantity (HISTORY_CHANNELS), with the time it was read.  The acquisition thread
+    publishes each Sample here, and the control loops read from here instead of from the instruments, saying how
+    old a value they are willing to act on.  get() and getSample() raise StaleDataError if the value is older
+    than that, so nothing acts on old data by accident. """
+class SampleHub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = None
+        self.values = {} #name: (read time, value)
+    def publish(self, sample):
+        with self.lock:
+            self.latest = sample
+            for name, value in zip(HISTORY_CHANNELS, sample.values()):
+                readTime = sample.readTime(name)
+                if readTime is not None and not numpy.isnan(value): self.values[name] = (readTime, value)
+    def getTimestamped(self, name, maxAge):
+        """Returns (read time, value) of the newest good reading of name, if it is at most maxAge seconds old."""
+        with self.lock: entry = self.values.get(name)
+        if entry is None: raise StaleDataError('There is no reading of '+name+' yet.')
+        age = time.time() - entry[0]
+        if age > maxAge: raise StaleDataError('The newest reading of '+name+' is '+str(int(age))+' s old.')
+        return entry
+    def get(self, name, maxAge):
+        return self.getTimestamped(name, maxAge)[1]
+    def getSample(self, maxAge, required=()):
+        """Returns the newest Sample, if it is at most maxAge seconds old and none of the quantities in
+        required are NaN in it.  Everything in one Sample was read at the same time."""
+        sample = self.latest
+        if sample is None: raise StaleDataError('There are no readings yet.')
+        age = time.time() - sample.timeStamp
+        if age > maxAge: raise StaleDataError('The newest reading is '+str(int(age))+' s old.')
+        for name in required:
+            if numpy.isnan(sample.value(name)): raise StaleDataError('The newest reading has no '+name+'.')
+        return sample
+
+""" Has the same log() as the ADRCore's log, but only puts the messages on a queue.  The log is shown in the
+    window, which can only be used from the GUI thread, so that thread takes the messages off the queue. """
+class MessageQueue:
+    def __init__(self):
+        self.queue = Queue.Queue()
+    def log(self, message, alert=False):
+        self.queue.put( (message, alert) )
+    def getMessages(self):
+        messages = []
+        while True:
+            try: messages.append( self.queue.get_nowait() )
+            except Queue.Empty: return messages
+
+""" Decides when to read the RuOx bridge and which channel the SIM925 multiplexer should be on.  After switching,
+    the bridge needs settleTimeConstants time constants to settle before a reading means anything, and the
+    multiplexer clicks if it switches back and forth quickly, so each channel gets a dwell time planned from the
+    settling time: with both channels wanted, each one stays on for at least minDwell and at least twice the
+    settling time (so at least half of the time is spent reading).  When one channel has priority (the FAA while
+    regulating) it stays on that one and only visits the other for one settled reading every priorityInterval.
+    The bridge's time constant is cached by the RuOxTemperatureMonitor, so it isn't queried every cycle. """
+class RuOxScheduler:
+    channelNumbers = {'GGG':1, 'FAA':2}
+    outOfRange = {'GGG':20.0, 'FAA':45.0} #what the bridge reads when the temperature is off its curve
+    def __init__(self, monitor, settleTimeConstants=10, minDwell=30., priorityInterval=600.):
+        self.monitor = monitor
+        self.settleTimeConstants = settleTimeConstants
+        self.minDwell = minDwell
+        self.priorityInterval = priorityInterval
+        self.wanted = {'GGG':False, 'FAA':True}
+        self.priority = None
+        self.temperatures = {'GGG':numpy.nan, 'FAA':numpy.nan}
+        self.readTimes = {'GGG':None, 'FAA':None}
+        self.channel = 'GGG' if monitor.getChannel() == 1 else 'FAA'
+    def setChannels(self, GGG, FAA, priority=None):
+        self.wanted = {'GGG':GGG, 'FAA':FAA}
+        self.priority = priority
+    def settleTime(self):
+        """Seconds from switching channel to the first good reading."""
+        timeConstant = self.monitor.getTimeConstant()
+        if not isinstance(timeConstant, (int, float)): timeConstant = 0 #filter off
+        return self.settleTimeConstants*timeConstant
+    def dwellTime(self, channel):
+        """How long to stay on channel before switching to the other one, when both are wanted."""
+        settle = self.settleTime()
+        if self.priority == channel: return max(self.priorityInterval, 2*settle)
+        if self.priority is not None: return max(self.minDwell, settle) #just long enough for one settled reading
+        return max(self.minDwell, 2*settle)
+    def step(self):
+        """Called every cycle.  Reads the current channel if it has settled, then switches channel if its dwell
+        time is up."""
+        other = 'GGG' if self.channel == 'FAA' else 'FAA'
+        timeOnChannel = self.monitor.getTimeSinceChannelSet()
+        settled = timeOnChannel >= self.settleTime()
+        if settled and self.wanted[self.channel]:
+            T = self.monitor.getTemperature()
+            if T == self.outOfRange[self.channel]: T = numpy.nan
+            self.temperatures[self.channel] = T
+            self.readTimes[self.channel] = time.time()
+        for channel in self.wanted:
+            if not self.wanted[channel]:
+                self.temperatures[channel] = numpy.nan
+                self.readTimes[channel] = None
+        if not self.wanted[self.channel]:
+            if self.wanted[other]: self.switchTo(other)
+        elif self.wanted[other] and settled and timeOnChannel >= self.dwellTime(self.channel):
+            self.switchTo(other)
+    def switchTo(self, channel):
+        self.monitor.setChannel(self.channelNumbers[channel])
+        self.channel = channel
+
+""" The acquisition thread.  It owns the instruments: nothing else should talk to them directly once it is
+    started.  Every period seconds (on the deadlines of a DeadlineScheduler on clock) it runs any submitted
+    commands and then takes a Sample, which is published to hub, handed to the control loop and put on the
+    samples queue (for the plot and the log, which want every sample).  If one SIM922 reads the diodes and the
+    magnet, the deadlines are phase locked to its update, and if it still hadn't measured again when it is read,
+    it is read again every newDataPollInterval seconds, for up to newDataWait, until it has.  How late each cycle
+    starts, how long it takes and whether it overran are recorded in timing (see ADRTiming).  If pipelined, the
+    queries to different instruments are overlapped (see ADRPipeline); otherwise they are run one after the
+    other.  If there is an estimator (ADREstimator.FAAEstimator), every sample gets an FAA temperature estimate.
+    Bus access is serialized with busLock, a client of bus (an ADRScheduler.BusArbiter shared with the other
+    cryostats' engines, or one of its own) named name, which gets the bus in the order of the cycles' deadlines.
+    It is let go while waiting for new data.  Anything else that really has to use an instrument from another
+    thread has to hold it too. """
+class AcquisitionEngine(threading.Thread):
+    def __init__(self, diodeTempMonitor, ruoxTempMonitor, magnetVoltageMonitor, ps, period=1.0, ruoxScheduler=None, timing=None,
+                 clock=monotonic, phaseLock=True, pipelined=True, estimator=None, newDataWait=0.25, newDataPollInterval=0.02,
+                 sleep=time.sleep, bus=None, name='ADR'):
+        threading.Thread.__init__(self, name=name+' acquisition')
+        self.daemon = True
+        self.diodeTempMonitor = diodeTempMonitor
+        self.ruoxTempMonitor = ruoxTempMonitor
+        self.magnetVoltageMonitor = magnetVoltageMonitor
+        self.ps = ps
+        self.period = period
+        self.pipelined = pipelined
+        self.estimator = estimator
+        self.lastFAAReadTime = None
+        if bus is None: bus = BusArbiter(clock, period)
+        self.busLock = bus.client(name)
+        self.samples = Queue.Queue()
+        self.commands = Queue.Queue()
+        self.messageLog = MessageQueue()
+        self.hub = SampleHub()
+        self.stopEvent = threading.Event()
+        if ruoxScheduler is None and ruoxTempMonitor is not None: ruoxScheduler = RuOxScheduler(ruoxTempMonitor)
+        self.ruoxScheduler = ruoxScheduler
+        self.failing = {}
+        if timing is None: timing = ADRTiming.timing
+        self.timing = timing
+        self.clock = clock
+        self.sleep = sleep
+        self.newDataWait = newDataWait
+        self.newDataPollInterval = newDataPollInterval
+        self.scheduler = DeadlineScheduler(period, clock)
+        self.phaseLock = None
+        if phaseLock and self.readsTogether():
+            #reading before the update only costs a poll when waiting for new data, so the cycles can stay closer to it
+            if newDataWait > newDataPollInterval > 0: self.phaseLock = PhaseLock(self.scheduler, lateStep=newDataPollInterval/period)
+            else: self.phaseLock = PhaseLock(self.scheduler)
+        self.lastDiodeReading = None
+        self.diodeReadingIsNew = True
+        self.diodeReadTime = None #when the SIM922 reading last changed
+        self.controlLoop = None
+        self.controlLock = threading.Lock()
+        self.listeners = []
+    def stop(self):
+        self.stopEvent.set()
+        self.commands.put(None) #wakes the thread up if it is waiting for commands
+    def submit(self, function, *args, **kwargs):
+        """Runs function(*args,**kwargs) on the acquisition thread as soon as it is free.  Returns immediately."""
+        self.commands.put( (function, args, kwargs) )
+    def setPowerSupplyVoltage(self, V):
+        """Sets the voltage on whichever power supply instance is current when the command is run."""
+        self.submit( lambda: self.ps.setVoltage(V) )
+    def startControl(self, loop):
+        """From the next sample on, runs loop.step(hub) right after each sample is published and sets the power
+        supply to the voltage it returns, until loop.finished is set or stopControl() is called."""
+        with self.controlLock: self.controlLoop = loop
+    def stopControl(self):
+        """Stops the control loop.  Once this returns, it won't set the voltage again."""
+        with self.controlLock: self.controlLoop = None
+    def addListener(self, function):
+        """Calls function(sample) on the acquisition thread with every new sample, right after the control loop
+        is stepped.  It must be quick."""
+        self.listeners = self.listeners + [function]
+    def removeListener(self, function):
+        """Stops calling function.  The list is replaced rather than changed, so a cycle that is running calls the
+        ones it started with."""
+        self.listeners = [listener for listener in self.listeners if listener != function]
+    def setRuOxChannels(self, GGG, FAA, priority=None):
+        """Which RuOx channels should be read, and which one (if any) has priority.  Called from the GUI thread."""
+        if self.ruoxScheduler is not None: self.ruoxScheduler.setChannels(GGG, FAA, priority)
+    def getSamples(self):
+        """Takes all new samples off the queue, oldest first."""
+        samples = []
+        while True:
+            try: samples.append( self.samples.get_nowait() )
+            except Queue.Empty: return samples
+    def run(self):
+        while not self.stopEvent.is_set():
+            deadline = self.scheduler.next()
+            self.busLock.deadline = deadline
+            self.runCommands(deadline)
+            if self.stopEvent.is_set(): break
+            cycleStart = self.clock()
+            sample, firstReadingIsNew = self.takeSample()
+            self.timing.addCycle(cycleStart - deadline, self.clock() - cycleStart > self.period, sample.fresh)
+            if self.phaseLock is not None: self.phaseLock.update(firstReadingIsNew)
+            self.hub.publish(sample)
+            self.runControl(sample)
+            for listener in self.listeners:
+                try: listener(sample)
+                except Exception as e: self.messageLog.log('Error sending the new sample: '+str(e)+'\n', alert=True)
+            self.samples.put(sample)
+    def runControl(self, sample):
+        """Steps the control loop, if there is one, with the sample that was just published."""
+        with self.controlLock:
+            loop = self.controlLoop
+            if loop is None: return
+            with self.timing.phase('control'):
+                try: newVoltage = loop.step(self.hub)
+                except Exception as e:
+                    loop.finish(loop.name+' stopped: '+str(e)+'\n', alert=True)
+                    newVoltage = None
+            if newVoltage is not None:
+                with self.busLock:
+                    try: self.ps.setVoltage(newVoltage)
+                    except Exception as e: self.messageLog.log('Could not set the power supply voltage: '+str(e)+'\n', alert=True)
+                self.timing.addPhase('control latency', time.time() - sample.timeStamp) #from the reading to the new voltage
+            if loop.finished: self.controlLoop = None
+    def runCommands(self, until):
+        """Runs submitted commands until the time until (on clock)."""
+        while not self.stopEvent.is_set():
+            timeout = until - self.clock()
+            try:
+                if timeout > 0: command = self.commands.get(timeout=timeout)
+                else: command = self.commands.get_nowait()
+            except Queue.Empty: return
+            if command is None: continue
+            function, args, kwargs = command
+            with self.busLock, self.timing.phase('commands'):
+                try: function(*args, **kwargs)
+                except Exception as e:
+                    self.messageLog.log('Error in acquisition thread command: '+str(e)+'\n', alert=True)
+    def tryRead(self, name, function, default):
+        """Calls function, and if it fails, logs it (once, not every cycle) and returns default."""
+        try: value = function()
+        except Exception as e: value = e
+        return self.checkRead(name, value, default)
+    def checkRead(self, name, value, default):
+        """Returns value, or if it is the exception a read failed with, logs it (once, not every cycle) and
+        returns default."""
+        if isinstance(value, Exception):
+            if not self.failing.get(name, False):
+                self.messageLog.log('Could not read '+name+': '+str(value)+'\n', alert=True)
+            self.failing[name] = True
+            return default
+        if self.failing.get(name, False):
+            self.messageLog.log('Reading '+name+' again.\n')
+        self.failing[name] = False
+        return value
+    def readsTogether(self):
+        """True if the same SIM922 reads the diodes and the magnet voltage, so they can be read in one transaction."""
+        return self.diodeTempMonitor is not None and self.diodeTempMonitor is self.magnetVoltageMonitor \
+               and hasattr(self.diodeTempMonitor, 'getDiodeTemperaturesAndMagnetVoltage')
+    def readTransactions(self, psConnected):
+        """The reads of one cycle, as (name, device, transaction) for runPipelined.  Instruments without steps
+        methods are just called."""
+        transactions = []
+        def add(name, instrument, stepsName, functionName):
+            if hasattr(instrument, stepsName): steps = getattr(instrument, stepsName)()
+            else: steps = callSteps(getattr(instrument, functionName))
+            transactions.append( (name, getattr(instrument, 'device', instrument), steps) )
+        #the power supply is the slowest to answer, so its query goes out first
+        if psConnected: add('power supply current and voltage', self.ps, 'currentAndVoltageSteps', 'getCurrentAndVoltage')
+        if self.readsTogether():
+            add('diode temperatures and magnet voltage', self.diodeTempMonitor, 'diodeTemperaturesAndMagnetVoltageSteps', 'getDiodeTemperaturesAndMagnetVoltage')
+        else:
+            if self.magnetVoltageMonitor is not None: add('magnet voltage', self.magnetVoltageMonitor, 'magnetVoltageSteps', 'getMagnetVoltage')
+            if self.diodeTempMonitor is not None: add('diode temperatures', self.diodeTempMonitor, 'diodeTemperaturesSteps', 'getDiodeTemperatures')
+        if self.ruoxScheduler is not None:
+            transactions.append( ('RuOx temperature', getattr(self.ruoxScheduler.monitor, 'device', self.ruoxScheduler.monitor), callSteps(self.ruoxScheduler.step)) )
+        return transactions
+    def acquire(self):
+        """Reads all the instruments once and returns a Sample."""
+        timeStamp = time.time()
+        monotonicTime = self.clock()
+        psConnected = self.ps is not None and self.ps.instrumentIsConnected()[0]
+        transactions = self.readTransactions(psConnected)
+        if self.pipelined: results = runPipelined(transactions)
+        else:
+            results = {}
+            for transaction in transactions: results.update( runPipelined([transaction]) )
+        backEMF = numpy.nan
+        temps = [numpy.nan, numpy.nan]
+        if 'diode temperatures and magnet voltage' in results:
+            temps, backEMF = self.checkRead('diode temperatures and magnet voltage', results['diode temperatures and magnet voltage'], (temps,backEMF))
+            temps, backEMF = self.checkDiodeReading(temps, backEMF, timeStamp)
+        if 'magnet voltage' in results: backEMF = self.checkRead('magnet voltage', results['magnet voltage'], numpy.nan)
+        if 'diode temperatures' in results: temps = self.checkRead('diode temperatures', results['diode temperatures'], temps)
+        I_now, V_now = numpy.nan, numpy.nan
+        if psConnected:
+            I_now, V_now = self.checkRead('power supply current and voltage', results['power supply current and voltage'], (I_now, V_now))
+        GGGTemp, FAATemp = numpy.nan, numpy.nan
+        readTimes = {'GGG':None, 'FAA':None}
+        if self.ruoxScheduler is not None:
+            self.checkRead('RuOx temperature', results['RuOx temperature'], None)
+            GGGTemp, FAATemp = self.ruoxScheduler.temperatures['GGG'], self.ruoxScheduler.temperatures['FAA']
+            readTimes = dict(self.ruoxScheduler.readTimes)
+        fresh = True
+        if 'diode temperatures and magnet voltage' in results:
+            fresh = self.diodeReadingIsNew
+            for name in SIM922_CHANNELS: readTimes[name] = self.diodeReadTime
+        FAAEstimate = None
+        if self.estimator is not None:
+            newFAAReading = readTimes.get('FAA') is not None and readTimes['FAA'] != self.lastFAAReadTime
+            self.lastFAAReadTime = readTimes.get('FAA')
+            timeConstant = self.ruoxScheduler.monitor.getTimeConstant() if self.ruoxScheduler is not None else 0
+            if not isinstance(timeConstant, (int, float)): timeConstant = 0 #filter off
+            self.estimator.update(monotonicTime, I_now, FAATemp if newFAAReading else None, timeConstant)
+            FAAEstimate = self.estimator.estimate()
+        return Sample(timeStamp, list(temps) + [GGGTemp,FAATemp], backEMF, I_now, V_now, psConnected, readTimes, monotonicTime,
+                      FAAEstimate, fresh)
+    def checkDiodeReading(self, temps, backEMF, readTime):
+        """Sets diodeReadingIsNew (and diodeReadTime, if it is), and returns the (temps, backEMF) to use.  The SIM922
+        measures once a second, so exactly the same numbers mean it hasn't measured again yet, and any of them
+        changing means it has (the back EMF stays the same while the current does).  The temperatures are queried
+        first, so if only the voltage changed, it may have measured in between the two queries: then it is read
+        again, and if the temperatures have changed by then, that reading is used instead."""
+        reading = (tuple(temps), backEMF)
+        last = self.lastDiodeReading
+        if last is not None and reading[0] == last[0] and reading[1] != last[1]:
+            again = self.tryRead('diode temperatures and magnet voltage', self.diodeTempMonitor.getDiodeTemperaturesAndMagnetVoltage, None)
+            if again is not None and tuple(again[0]) != reading[0]: reading, readTime = (tuple(again[0]), again[1]), time.time()
+        self.diodeReadingIsNew = last is None or reading != last
+        if self.diodeReadingIsNew:
+            self.lastDiodeReading = reading
+            self.diodeReadTime = readTime
+        return list(reading[0]), reading[1]
+    def takeSample(self):
+        """acquire(), and if the SIM922 hadn't measured again yet, rereadDiodes() every newDataPollInterval until
+        it has or newDataWait is up.  Returns (sample, whether the first reading was new)."""
+        with self.busLock, self.timing.phase('acquire'): sample = self.acquire()
+        firstReadingIsNew = sample.fresh
+        until = self.clock() + self.newDataWait
+        while not sample.fresh and self.clock() + self.newDataPollInterval <= until:
+            #a SIM922 that can't be read would just time out again
+            if self.stopEvent.is_set() or self.failing.get('diode temperatures and magnet voltage', False): break
+            self.sleep(self.newDataPollInterval)
+            with self.busLock, self.timing.phase('wait for new data'): self.rereadDiodes(sample)
+        return sample, firstReadingIsNew
+    def rereadDiodes(self, sample):
+        """Reads the SIM922 again, and if it has measured again, puts the new reading in sample and marks it fresh."""
+        reading = self.tryRead('diode temperatures and magnet voltage', self.diodeTempMonitor.getDiodeTemperaturesAndMagnetVoltage, None)
+        if reading is None: return
+        temps, backEMF = self.checkDiodeReading(reading[0], reading[1], time.time())
+        if not self.diodeReadingIsNew: return
+        sample.temps[0:2] = temps
+        sample.backEMF = backEMF
+        sample.readTimes = dict(sample.readTimes)
+        for name in SIM922_CHANNELS: sample.readTimes[name] = self.diodeReadTime
+        sample.fresh = True
@@ -0,0 +1,239 @@
+"""
+Multi-resolution storage of the ADR temperature logs, for looking back at old cooldowns.  Next to each binary
+log (see ADRLogFile) there are level files with the min, mean and max of every channel over 10s, 1min and 10min
+buckets, so a day or a week can be shown without reading every sample.  Level files are ordinary binary log
+files whose channels are 'min:60K', ..., 'mean:60K', ..., 'max:60K', ... and whose time stamps are the start of
+each bucket, so both are indexed by time with a binary search and read through a memory map: loading a range
+takes time proportional to the number of points returned, not the length of the file.
+
+MultiResolutionWriter writes a log and its levels as the data comes in.  buildLevels() makes the levels for a
+log that doesn't have them.  LogArchive reads any time range out of all the logs in a directory.
+
+Run this file with a log file name to build its levels.
+"""
+
+import numpy, os, glob, sys, time
+from ADRLogFile import BinaryLogWriter, readLog, readHeader
+
+LEVELS = [10, 60, 600] #bucket lengths in seconds
+
+def levelPath(path, bucketLength):
+    """temperatures_141124_1530.bin -> temperatures_141124_1530.600s.bin"""
+    root, ext = os.path.splitext(path)
+    return '%s.%ds%s' %(root, bucketLength, ext)
+
+def isLevelPath(path):
+    root = os.path.splitext(path)[0]
+    level = os.path.splitext(root)[1]
+    return len(level) > 2 and level[-1] == 's' and level[1:-1].isdigit()
+
+def nameStartTime(path):
+    """The start time in the name of a log (temperatures_141124_1530.bin, to the minute), or None."""
+    try: return time.mktime(time.strptime(os.path.splitext(os.path.basename(path))[0].split('_',1)[1], '%y%m%d_%H%M'))
+    except (IndexError, ValueError): return None
+
+def levelChannels(channels):
+    return ['min:'+c for c in channels] + ['mean:'+c for c in channels] + ['max:'+c for c in channels]
+
+""" Keeps the NaN-ignoring min, mean and max of each channel over the current bucket and writes a record to the
+    level file when a sample in the next bucket comes in. """
+class LevelAccumulator:
+    def __init__(self, writer, bucketLength, nChannels):
+        self.writer = writer
+        self.bucketLength = bucketLength
+        self.nChannels = nChannels
+        self.bucket = None
+    def add(self, timeStamp, values):
+        bucket = int(timeStamp // self.bucketLength)
+        if bucket != self.bucket:
+            self.emit()
+            self.bucket = bucket
+            self.min = numpy.empty(self.nChannels)
+            self.min.fill(numpy.nan)
+            self.max = self.min.copy()
+            self.sum = numpy.zeros(self.nChannels)
+            self.count = numpy.zeros(self.nChannels)
+        values = numpy.asarray(values, dtype=float)
+        isNumber = ~numpy.isnan(values)
+        self.min = numpy.fmin(self.min, values)
+        self.max = numpy.fmax(self.max, values)
+        self.sum[isNumber] += values[isNumber]
+        self.count += isNumber
+    def emit(self):
+        if self.bucket is None: return
+        mean = numpy.empty(self.nChannels)
+        mean.fill(numpy.nan)
+        hasData = self.count > 0
+        mean[hasData] = self.sum[hasData]/self.count[hasData]
+        self.writer.write(self.bucket*self.bucketLength, numpy.concatenate([self.min,mean,self.max]))
+        self.bucket = None
+
+""" A BinaryLogWriter that also writes the level files.  It has the same write/flush/sync/close. """
+class MultiResolutionWriter:
+    def __init__(self, path, channels, startTime, levels=LEVELS, **kwargs):
+        self.raw = BinaryLogWriter(path, channels, startTime, **kwargs)
+        self.levelWriters = []
+        self.accumulators = []
+        for bucketLength in levels:
+            writer = BinaryLogWriter(levelPath(path,bucketLength), levelChannels(channels), self.raw.startTime,
+                                     extraHeader={'bucketLength':bucketLength}, **kwargs)
+            self.levelWriters.append(writer)
+            self.accumulators.append( LevelAccumulator(writer, bucketLength, len(channels)) )
+    def write(self, timeStamp, values):
+        self.raw.write(timeStamp, values)
+        for accumulator in self.accumulators: accumulator.add(timeStamp, values)
+    def flush(self):
+        for writer in [self.raw]+self.levelWriters: writer.flush()
+    def sync(self):
+        for writer in [self.raw]+self.levelWriters: writer.sync()
+    def close(self):
+        for accumulator in self.accumulators: accumulator.emit() #the last, partly filled buckets
+        for writer in [self.raw]+self.levelWriters: writer.close()
+
+def buildLevels(path, levels=LEVELS):
+    """(Re)writes the level files for the binary log at path."""
+    header, records = readLog(path, memoryMap=True)
+    channels = header['channels']
+    for bucketLength in levels:
+        outPath = levelPath(path, bucketLength)
+        if os.path.exists(outPath): os.remove(outPath)
+        writer = BinaryLogWriter(outPath, levelChannels(channels), header['startTime'], extraHeader={'bucketLength':bucketLength})
+        if len(records) > 0:
+            t = numpy.asarray(records['t'])
+            values = numpy.asarray(records['values'], dtype=float)
+            buckets = numpy.floor(t/bucketLength)
+            starts = numpy.concatenate([[0], numpy.nonzero(numpy.diff(buckets))[0]+1])
+            isNumber = ~numpy.isnan(values)
+            counts = numpy.add.reduceat(isNumber, starts, axis=0)
+            sums = numpy.add.reduceat(numpy.where(isNumber, values, 0), starts, axis=0)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                means = numpy.where(counts > 0, sums/counts, numpy.nan)
+            mins = numpy.fmin.reduceat(values, starts, axis=0)
+            maxs = numpy.fmax.reduceat(values, starts, axis=0)
+            for n in range(len(starts)):
+                writer.write(buckets[starts[n]]*bucketLength, numpy.concatenate([mins[n],means[n],maxs[n]]))
+        writer.close()
+
+""" Data loaded from a LogArchive.  t are absolute times (time.time() style).  mean, min and max have one row per
+    point and one column per channel; for raw samples they are all the same array.  bucketLength is 0 for raw
+    samples, otherwise the length of the buckets in seconds. """
+class ArchiveData:
+    def __init__(self, channels, t, mean, min, max, bucketLength):
+        self.channels = channels
+        self.t = t
+        self.mean = mean
+        self.min = min
+        self.max = max
+        self.bucketLength = bucketLength
+    def __len__(self):
+        return len(self.t)
+    def column(self, name, kind='mean'):
+        return getattr(self, kind)[:,self.channels.index(name)]
+
+""" One log file and whichever of its level files exist, all memory mapped. """
+class ArchiveFile:
+    def __init__(self, path):
+        self.path = path
+        header, self.raw = readLog(path, memoryMap=True)
+        self.channels = header['channels']
+        self.startTime = header['startTime']
+        self.levels = {}
+        for levelFile in glob.glob(os.path.splitext(path)[0]+'.*s'+os.path.splitext(path)[1]):
+            levelHeader, records = readLog(levelFile, memoryMap=True)
+            if 'bucketLength' in levelHeader: self.levels[levelHeader['bucketLength']] = records
+    def timeRange(self):
+        if len(self.raw) == 0: return (numpy.inf, -numpy.inf)
+        return (self.startTime+self.raw[0]['t'], self.startTime+self.raw[-1]['t'])
+    def records(self, bucketLength):
+        if bucketLength == 0: return self.raw
+        return self.levels.get(bucketLength)
+    def count(self, bucketLength, tMin, tMax):
+        """How many points of this resolution are between tMin and tMax (absolute times)."""
+        records = self.records(bucketLength)
+        if records is None or len(records) == 0: return 0
+        i0, i1 = self.indices(records, tMin - bucketLength, tMax)
+        return i1 - i0
+    def indices(self, records, tMin, tMax):
+        t = records['t'] #binary search on the memory map only touches a few pages
+        return int(numpy.searchsorted(t, tMin-self.startTime, 'left')), int(numpy.searchsorted(t, tMax-self.startTime, 'right'))
+    def load(self, bucketLength, tMin, tMax):
+        records = self.records(bucketLength)
+        i0, i1 = self.indices(records, tMin - bucketLength, tMax)
+        records = records[i0:i1]
+        t = self.startTime + numpy.asarray(records['t'])
+        values = numpy.asarray(records['values'], dtype=float)
+        if bucketLength == 0: return t, values, values, values
+        n = len(self.channels)
+        return t, values[:,n:2*n], values[:,:n], values[:,2*n:]
+
+""" All the logs in a directory.  load() returns any time range at the finest resolution that fits in maxPoints,
+    using the same resolution for every file it covers.  If tMin or tMax are given, only the logs that can have
+    data between them are opened, picked by their start times (from their names, or their headers if the names
+    don't have them): the ones that started before tMax, back to the newest one that started before tMin.  That
+    assumes only one program writes logs in the directory at a time, which the ADR Controller makes sure of. """
+class LogArchive:
+    def __init__(self, directory, pattern='temperatures*.bin', tMin=None, tMax=None):
+        self.files = []
+        for path in self.selectPaths(glob.glob(os.path.join(directory, pattern)), tMin, tMax):
+            try: archiveFile = ArchiveFile(path)
+            except (IOError, ValueError): continue
+            if len(archiveFile.raw) > 0: self.files.append(archiveFile)
+        self.files.sort(key=lambda f: f.timeRange()[0])
+    def selectPaths(self, paths, tMin, tMax):
+        paths = [path for path in paths if not isLevelPath(path)]
+        if tMin is None and tMax is None: return paths
+        def startTime(path):
+            try: return readHeader(path)[0]['startTime']
+            except (IOError, ValueError, KeyError): return None
+        starts = []
+        for path in paths:
+            start = nameStartTime(path) #to the minute, so at most 60 s before the one in the header
+            if start is None: start = startTime(path)
+            if start is not None and (tMax is None or start <= tMax): starts.append( (start, path) )
+        selected = []
+        for start, path in sorted(starts, reverse=True):
+            selected.append(path)
+            if tMin is None or start > tMin: continue
+            start = startTime(path)
+            if start is not None and start <= tMin: break
+        return selected
+    def close(self):
+        """Lets go of the memory maps (they are also closed once it isn't used anymore)."""
+        self.files = []
+    def timeRange(self):
+        if len(self.files) == 0: return (numpy.nan, numpy.nan)
+        return (self.files[0].timeRange()[0], max(f.timeRange()[1] for f in self.files))
+    def load(self, tMin, tMax, maxPoints=None, channels=None):
+        """Loads the data between the absolute times tMin and tMax.  If maxPoints is None, raw samples are always
+        returned.  channels defaults to the channels of the newest file."""
+        files = [f for f in self.files if f.timeRange()[1] >= tMin and f.timeRange()[0] <= tMax]
+        if channels is None: channels = self.files[-1].channels if len(self.files) > 0 else []
+        bucketLength = 0
+        if maxPoints is not None:
+            for bucketLength in [0]+sorted(LEVELS):
+                if all(bucketLength == 0 or bucketLength in f.levels for f in files) and \
+                   sum(f.count(bucketLength, tMin, tMax) for f in files) <= maxPoints:
+                    break
+        parts = [[], [], [], []]
+        for f in files:
+            if f.records(bucketLength) is None or len(f.records(bucketLength)) == 0: continue
+            loaded = f.load(bucketLength, tMin, tMax)
+            parts[0].append(loaded[0])
+            #put the columns in the order asked for, NaN for channels this file doesn't have
+            columns = [f.channels.index(c) if c in f.channels else None for c in channels]
+            for kind in range(1,4):
+                part = numpy.empty( (len(loaded[0]), len(channels)) )
+                for n, column in enumerate(columns):
+                    part[:,n] = loaded[kind][:,column] if column is not None else numpy.nan
+                parts[kind].append(part)
+        if len(parts[0]) == 0:
+            empty = numpy.zeros( (0,len(channels)) )
+            return ArchiveData(channels, numpy.zeros(0), empty, empty, empty, bucketLength)
+        t, mean, mins, maxs = [numpy.concatenate(p) for p in parts]
+        return ArchiveData(channels, t, mean, mins, maxs, bucketLength)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2: print __doc__
+    for path in sys.argv[1:]:
+        buildLevels(path)
+        print 'Built', ', '.join(levelPath(path,l) for l in LEVELS)
@@ -0,0 +1,82 @@
+"""
+Checkpoints of the ADR Controller's state, so that if it dies (or is restarted) in the middle of a mag up or
+regulation, the next run picks it up again within a cycle instead of someone having to notice and start it over
+by hand while the hold time runs out.  The power supply keeps the last voltage it was set to, so nothing needs
+to be undone: the new run only needs to know what was running, where it was going and the control loop's state
+(the mag up planner's progress and model correction, the regulation target).  The plot history is reloaded
+from the temperature log anyway (see ADRCore.reloadHistory).
+
+A checkpoint is a small dict (see ADRCore.checkpointState), saved every few seconds, whenever mag up or
+regulation starts or stops, and when the program is closed (marked clean, so nothing is picked up again after
+a shutdown on purpose).  It is written as MAGIC, <I sequence, <I crc32, <I length, then the dict as JSON, and
+fsync'ed.  There are two files, written in turns, so a crash while one is being written leaves the other one:
+load() returns the newest one whose crc is right.
+
+Before picking up where it left off, checkResume compares the checkpoint with what the power supply reads now,
+since it may have been reset, turned off or turned by hand in between.
+"""
+
+import json, struct, zlib, os, time
+
+MAGIC = 'ADRCKPT1'
+HEADER_FORMAT = struct.Struct('<8sIII')
+
+""" The two checkpoint files in directory (name0.bin and name1.bin).  save() raises IOError or OSError if the
+    file can't be written. """
+class CheckpointFile:
+    def __init__(self, directory, name='checkpoint'):
+        self.paths = [os.path.join(directory, name+str(n)+'.bin') for n in range(2)]
+        self.sequence = 0
+        newest = self.loadNewest()
+        if newest is not None: self.sequence = newest[0]
+    def read(self, path):
+        """(sequence, state) of the checkpoint in path, or None if there isn't a whole one."""
+        try:
+            with open(path, 'rb') as f: data = f.read()
+        except (IOError, OSError): return None
+        if len(data) < HEADER_FORMAT.size: return None
+        magic, sequence, crc, length = HEADER_FORMAT.unpack_from(data, 0)
+        body = data[HEADER_FORMAT.size:HEADER_FORMAT.size+length]
+        if magic != MAGIC or len(body) != length or zlib.crc32(body) & 0xffffffff != crc: return None
+        try: return sequence, json.loads(body)
+        except ValueError: return None
+    def loadNewest(self):
+        checkpoints = [checkpoint for checkpoint in [self.read(path) for path in self.paths] if checkpoint is not None]
+        if len(checkpoints) == 0: return None
+        return max(checkpoints, key=lambda checkpoint: checkpoint[0])
+    def load(self):
+        """The newest checkpoint saved, or None if there isn't one."""
+        newest = self.loadNewest()
+        return newest[1] if newest is not None else None
+    def save(self, state):
+        """Saves state (a dict that can be made into JSON) over the older of the two files."""
+        self.sequence += 1
+        body = json.dumps(state, separators=(',',':'), sort_keys=True)
+        with open(self.paths[self.sequence % 2], 'wb') as f:
+            f.write(HEADER_FORMAT.pack(MAGIC, self.sequence, zlib.crc32(body) & 0xffffffff, len(body)) + body)
+            f.flush()
+            os.fsync(f.fileno())
+
+def checkResume(checkpoint, sample, settings, maxAge, interval, currentTolerance=0.05, voltageTolerance=0.01, now=None):
+    """Returns why the mag up or regulation in checkpoint can't be picked up again with the power supply reading
+    sample (an ADRAcquisition.Sample) and the ControlSettings settings, or None if it can.  It can't if the
+    checkpoint is more than maxAge seconds old, if any limit is exceeded, if the current changed by more than the
+    dI/dt limit allows for the time in between, or if the voltage isn't the one it was left at (it could only have
+    been changed by the dV/dt limit in the last checkpoint interval before the program stopped), each give or
+    take the tolerance."""
+    if now is None: now = time.time()
+    age = now - checkpoint['time']
+    last = checkpoint.get('sample')
+    if age > maxAge: return 'the checkpoint is %.0f s old' %age
+    if last is None: return 'the checkpoint has no power supply readings'
+    if not sample.psConnected: return 'the power supply is not connected'
+    if sample.current > settings.currentLimit + currentTolerance: return 'the current (%g A) is over the limit' %sample.current
+    if sample.voltage > settings.voltageLimit + voltageTolerance: return 'the voltage (%g V) is over the limit' %sample.voltage
+    if abs(sample.backEMF) > settings.magnetVoltageLimit: return 'the back EMF (%g V) is over the limit' %sample.backEMF
+    elapsed = max(now - last['time'], 0.)
+    if abs(sample.voltage - last['V']) > settings.dVdtLimit*min(elapsed, interval) + voltageTolerance:
+        return 'the power supply is at %g V instead of %g V (was it reset or turned off?)' %(sample.voltage, last['V'])
+    rateLimit = settings.dIdtMagUpLimit if checkpoint['control'] == 'magUp' else settings.dIdtRegulateLimit
+    if abs(sample.current - last['I']) > rateLimit*elapsed + currentTolerance:
+        return 'the current went from %g A to %g A in between' %(last['I'], sample.current)
+    return None
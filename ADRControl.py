@@ -0,0 +1,272 @@
+"""
+The mag up and regulation control laws of the ADR Controller, as plain functions of the readings.  They don't
+talk to any instruments or windows, so the same code that runs the cryostat can be run against the simulated
+ADR (see ADRSimulator) or stepped through by hand.  Each one is given the newest readings and returns the
+voltage the power supply should be set to.
+
+regulationStepArrays is the same regulation law on numpy arrays, for simulating many gains at once (see
+ADRTuning).  MagUpPlanner is the other way of magging up: from a model of the magnet (MagnetModel) it sets the
+voltage that raises the current at the dI/dt limit, instead of stepping the voltage up and pausing.
+
+MagUpLoop and RegulationLoop wrap them as the control loops the acquisition thread runs right after each new
+reading (see AcquisitionEngine.startControl).
+"""
+
+import numpy, math
+from ADRAcquisition import StaleDataError
+
+CONTROL_QUANTITIES = ['I','V','backEMF'] #every control step needs all of these from the same reading
+
+""" The limits and gains used by the control laws.  The ADR Controller makes one from the constants at the top
+    of ADRController.py. """
+class ControlSettings:
+    def __init__(self, currentLimit, voltageLimit, magnetVoltageLimit, magUpdV, dIdtMagUpLimit, dIdtRegulateLimit, dVdtLimit, KP, KD, KI=0):
+        self.currentLimit = currentLimit             #[A]
+        self.voltageLimit = voltageLimit             #[V]
+        self.magnetVoltageLimit = magnetVoltageLimit #[V] back EMF limit
+        self.magUpdV = magUpdV                       #[V/step]
+        self.dIdtMagUpLimit = dIdtMagUpLimit         #[A/s]
+        self.dIdtRegulateLimit = dIdtRegulateLimit   #[A/s]
+        self.dVdtLimit = dVdtLimit                   #[V/s]
+        self.KP = KP
+        self.KD = KD
+        self.KI = KI #not implemented
+
+def magUpStep(settings, V_now, I_now, backEMF, dIdt):
+    """One step of magging up: raise the voltage by magUpdV, unless the back EMF or dI/dt are over their limits.
+    Returns (new voltage or None to leave it where it is, True once the current limit is reached)."""
+    if I_now >= settings.currentLimit: return None, True
+    if backEMF < settings.magnetVoltageLimit and abs(dIdt) < settings.dIdtMagUpLimit:
+        return min(V_now + settings.magUpdV, settings.voltageLimit), False
+    return None, False
+
+def regulationStep(settings, V_now, I_now, backEMF, dI, dT, T, T_target):
+    """One step of regulating the FAA temperature T at T_target.  dI is the change in current over the last dT
+    seconds.  A new voltage V+dV is proposed by the PID-esque law and dV is then limited as necessary.
+    Returns (new voltage, True once the voltage has reached 0 and regulation is over)."""
+    if dT == 0: dT = 0.0000000001 #to prevent divide by zero error
+    #propose new voltage
+    dV = settings.KP*(T_target-T)-backEMF*settings.KD
+    #hard current limit
+    if I_now > settings.currentLimit:
+        if dV>0: dV=0
+    #hard voltage limit
+    if V_now + dV > settings.voltageLimit:
+        dV = settings.voltageLimit - V_now
+    # steady state limit
+    if dV < 0:
+        dV = max(dV,backEMF-settings.magnetVoltageLimit)
+        if dV > 0: dV = 0
+    if dV > 0:
+        dV = min(dV, settings.magnetVoltageLimit-backEMF)
+        if dV < 0: dV = 0
+    # limit by hard voltage increase limit
+    if abs(dV/dT) > settings.dVdtLimit:
+        dV = settings.dVdtLimit*dT*(dV/abs(dV))
+    # limit by hard current increase limit
+    if abs(dI/dT) > settings.dIdtRegulateLimit:
+        dV = 0
+    # will voltage go negative?
+    if V_now+dV <= 0: return 0, True
+    return V_now + dV, False
+
+def regulationStepArrays(settings, V_now, I_now, backEMF, dI, dT, T, T_target):
+    """regulationStep element by element on numpy arrays: any of the readings, T_target and the settings can be
+    arrays (ex: one element per combination of gains).  Must be kept the same as regulationStep.
+    Returns (new voltages, finished)."""
+    dT = numpy.where(dT == 0, 0.0000000001, dT)
+    dV = settings.KP*(T_target-T)-backEMF*settings.KD
+    dV = numpy.where((I_now > settings.currentLimit) & (dV > 0), 0., dV)
+    dV = numpy.where(V_now + dV > settings.voltageLimit, settings.voltageLimit - V_now, dV)
+    dV = numpy.where(dV < 0, numpy.minimum(numpy.maximum(dV, backEMF-settings.magnetVoltageLimit), 0.), dV)
+    dV = numpy.where(dV > 0, numpy.maximum(numpy.minimum(dV, settings.magnetVoltageLimit-backEMF), 0.), dV)
+    dV = numpy.where(numpy.abs(dV/dT) > settings.dVdtLimit, settings.dVdtLimit*dT*numpy.sign(dV), dV)
+    dV = numpy.where(numpy.abs(dI/dT) > settings.dIdtRegulateLimit, 0., dV)
+    finished = V_now+dV <= 0
+    return numpy.where(finished, 0., V_now + dV), finished
+
+""" The magnet as the power supply sees it: an inductance L [H] in series with a resistance R [Ohm] (leads and
+    joints) and, with the external protection box, a diode drop [V]. """
+class MagnetModel:
+    def __init__(self, inductance, resistance, diodeDrop=0.):
+        self.inductance = inductance
+        self.resistance = resistance
+        self.diodeDrop = diodeDrop
+    def decay(self, dt):
+        return math.exp(-dt*self.resistance/self.inductance)
+    def voltageFor(self, I_now, I_next, dt):
+        """The voltage that takes the current from I_now to I_next in dt seconds."""
+        decay = self.decay(dt)
+        return self.diodeDrop + self.resistance*(I_next - I_now*decay)/(1-decay)
+    def currentAfter(self, I_now, V, dt):
+        """The current dt seconds after setting V."""
+        finalCurrent = max(V - self.diodeDrop, 0.)/self.resistance
+        return finalCurrent + (I_now-finalCurrent)*self.decay(dt)
+
+""" Plans the mag up from a MagnetModel: every step it sets the voltage that, by the model, raises the measured
+    current by rateFraction of the dI/dt limit over the next step, or less if the voltage limit doesn't allow it
+    or if the measured back EMF per dI/dt says it would go over rateFraction of the back EMF limit.  Since it
+    starts from the measured current every step, the plan is redone every step.  The model doesn't need to be
+    exact: the difference between the rate it asked for and the rate that was measured is integrated into a
+    voltage offset (correctionGain of it per step), so an L, R or diode drop that is off is made up for in a few
+    steps.  The inductance it plans with is the model's, or the one measured from the back EMF (L dI/dt) if that
+    is lower: with the model's on a magnet of a lot less inductance, each step would ask for many times the rate,
+    and the correction (which is in volts per A/s) would overshoot more every step.  Until it has measured it,
+    the rate is ramped up over the first rampTime seconds.  Whatever the model says, it holds the voltage like
+    magUpStep when the back EMF or dI/dt are over their limits, and the offset isn't corrected while it does.
+    Since it goes at nearly the limit, dI/dt is averaged over a few steps for that, or the noise in the current
+    readings alone would hold it every other step. """
+class MagUpPlanner:
+    def __init__(self, model, rateFraction=0.99, correctionGain=0.5, rampTime=20.):
+        self.model = model
+        self.rateFraction = rateFraction
+        self.correctionGain = correctionGain
+        self.rampTime = rampTime
+        self.time = 0.
+        self.offset = 0.
+        self.inductance = model.inductance #what it plans with
+        self.lastRate = None #what the last step asked for, if it wasn't held back by the voltage limit
+        self.averagedIdt = None #dI/dt averaged over the last few steps, for holding
+    def rate(self, settings, backEMF, dIdt):
+        rate = self.rateFraction*settings.dIdtMagUpLimit
+        if self.time < self.rampTime: rate *= self.time/self.rampTime
+        if backEMF > 0 and dIdt > 0.1*rate:
+            #the back EMF is proportional to dI/dt, so this is the rate that keeps it under the limit
+            rate = min(rate, dIdt*self.rateFraction*settings.magnetVoltageLimit/backEMF)
+        return rate
+    def measureInductance(self, settings, backEMF, dIdt):
+        """Goes down to a lower measured inductance right away, and back up towards the model's slowly."""
+        if backEMF <= 0 or dIdt <= 0.01*settings.dIdtMagUpLimit: return
+        measured = backEMF/dIdt
+        if measured < self.inductance: self.inductance = measured
+        else: self.inductance = min(self.inductance + 0.1*(measured - self.inductance), self.model.inductance)
+    def step(self, settings, V_now, I_now, backEMF, dIdt, dt):
+        """Like magUpStep, and dt is how long the step is."""
+        if I_now >= settings.currentLimit: return None, True
+        self.measureInductance(settings, backEMF, dIdt)
+        if self.averagedIdt is None: self.averagedIdt = dIdt
+        else: self.averagedIdt += 0.5*(dIdt - self.averagedIdt)
+        if backEMF >= settings.magnetVoltageLimit or abs(self.averagedIdt) >= settings.dIdtMagUpLimit:
+            self.lastRate = None
+            return None, False
+        if self.lastRate is not None: self.offset += self.correctionGain*self.inductance*(self.lastRate - dIdt)
+        self.time += dt
+        rate = self.rate(settings, backEMF, dIdt)
+        I_next = min(I_now + rate*dt, settings.currentLimit)
+        model = MagnetModel(self.inductance, self.model.resistance, self.model.diodeDrop)
+        V = model.voltageFor(I_now, I_next, dt) + self.offset
+        #don't wind up the offset while the voltage limit is holding the current back
+        self.lastRate = rate if V <= settings.voltageLimit else None
+        return max(min(V, settings.voltageLimit), 0.), False
+    def state(self):
+        """What it has learned so far, for a checkpoint (see ADRCheckpoint)."""
+        return {'time':self.time, 'offset':self.offset, 'inductance':self.inductance}
+    def restore(self, state):
+        """Carries on from state.  The last rate and dI/dt aren't kept, since the current wasn't being stepped in
+        between."""
+        self.time = state['time']
+        self.offset = state['offset']
+        self.inductance = min(state.get('inductance', self.inductance), self.model.inductance)
+        self.lastRate = None
+        self.averagedIdt = None
+    def timeToFull(self, settings, I_now, dt=1.):
+        """How long the mag up should take from I_now, by the model, in s (inf if the voltage limit is too low
+        to ever get there)."""
+        if self.model.diodeDrop + settings.currentLimit*self.model.resistance >= settings.voltageLimit: return float('inf')
+        t = 0.
+        while I_now < settings.currentLimit - 1e-6:
+            rate = self.rateFraction*settings.dIdtMagUpLimit*min((t+dt)/self.rampTime, 1.)
+            I_next = min(I_now + rate*dt, settings.currentLimit)
+            I_now = min(self.model.currentAfter(I_now, min(self.model.voltageFor(I_now, I_next, dt), settings.voltageLimit), dt), settings.currentLimit)
+            t += dt
+        return t
+
+""" Mag up (magUpStep) as a control loop.  step() is called by the acquisition thread with the SampleHub right
+    after each new sample is published, and returns the voltage to set, or None to leave it.  Readings older
+    than maxSampleAge or missing I, V or the back EMF hold the voltage, and it only steps on fresh samples (the
+    back EMF of a stale one was already acted on), unless the SIM922 hasn't measured for maxSampleAge.  When the current limit is reached,
+    finished is set and the message logged.  lastSample is the reading before the loop was started, if any.  With a
+    MagUpPlanner, the voltage comes from it instead of magUpStep.  state() and restore() save and load what is
+    needed to pick it up again after a restart (see ADRCheckpoint); the readings come from the new run. """
+class MagUpLoop:
+    name = 'Magging up'
+    def __init__(self, settings, maxSampleAge, log, lastSample=None, planner=None):
+        self.settings = settings
+        self.planner = planner
+        self.maxSampleAge = maxSampleAge
+        self.log = log
+        self.lastSample = lastSample
+        self.holding = False
+        self.finished = False
+    def finish(self, message, alert=False):
+        self.finished = True
+        self.log.log(message, alert=alert)
+    def getSample(self, hub):
+        """The newest sample, or None (logged once until it is good again) if the voltage should be held.  Stale
+        samples are None too, without logging, as long as the SIM922 has measured within maxSampleAge."""
+        try:
+            sample = hub.getSample(self.maxSampleAge, required=CONTROL_QUANTITIES)
+            if not sample.fresh: hub.getTimestamped('backEMF', self.maxSampleAge)
+        except StaleDataError as e:
+            if not self.holding: self.log.log(self.name+' is holding the voltage: '+str(e)+'\n', alert=True)
+            self.holding = True
+            return None
+        if not sample.fresh: return None
+        self.holding = False
+        return sample
+    def step(self, hub):
+        sample = self.getSample(hub)
+        if sample is None: return None
+        lastSample, self.lastSample = self.lastSample, sample
+        if lastSample is None: return None
+        dt = sample.monotonicTime - lastSample.monotonicTime
+        if dt == 0: dt = 0.0000000001 #to prevent divide by zero error
+        dIdt = (sample.current-lastSample.current)/dt
+        if self.planner is not None: newVoltage, finished = self.planner.step(self.settings, sample.voltage, sample.current, sample.backEMF, dIdt, dt)
+        else: newVoltage, finished = magUpStep(self.settings, sample.voltage, sample.current, sample.backEMF, dIdt)
+        if finished: self.finish('Finished magging up. '+str(sample.current)+' Amps reached.\n')
+        return newVoltage
+    def state(self):
+        return {'planner':self.planner.state()} if self.planner is not None else {}
+    def restore(self, state):
+        if self.planner is not None and 'planner' in state: self.planner.restore(state['planner'])
+
+""" Regulation at T_target (regulationStep) as a control loop, like MagUpLoop.  It acts on the sample's FAA
+    temperature estimate (see ADREstimator) as long as its standard deviation is at most maxFAAUncertainty times
+    the temperature, and otherwise on the newest FAA reading, holding the voltage if that is older than maxFAAAge.
+    It is finished once the voltage reaches 0. """
+class RegulationLoop(MagUpLoop):
+    name = 'Regulation'
+    def __init__(self, settings, T_target, maxSampleAge, maxFAAAge, log, lastSample=None, maxFAAUncertainty=0.01):
+        MagUpLoop.__init__(self, settings, maxSampleAge, log, lastSample)
+        self.T_target = T_target
+        self.maxFAAAge = maxFAAAge
+        self.maxFAAUncertainty = maxFAAUncertainty
+        self.holdingFAA = False
+    def getFAATemperature(self, hub, sample):
+        if sample.FAAEstimate is not None:
+            T, uncertainty = sample.FAAEstimate
+            if uncertainty <= self.maxFAAUncertainty*T: return T
+        return hub.get('FAA', self.maxFAAAge)
+    def step(self, hub):
+        sample = self.getSample(hub)
+        if sample is None: return None
+        try: FAATemp = self.getFAATemperature(hub, sample)
+        except StaleDataError as e:
+            #the RuOx may still be settling; getSample clears holding on every fresh sample, so this has its own flag
+            if not self.holdingFAA: self.log.log(self.name+' is holding the voltage: '+str(e)+'\n', alert=True)
+            self.holdingFAA = True
+            return None
+        self.holdingFAA = False
+        lastSample, self.lastSample = self.lastSample, sample
+        if lastSample is None: return None
+        dT = sample.monotonicTime - lastSample.monotonicTime
+        newVoltage, finished = regulationStep(self.settings, sample.voltage, sample.current, sample.backEMF,
+                                              sample.current-lastSample.current, dT, FAATemp, self.T_target)
+        print str(sample.voltage)+'\t'+str(sample.backEMF)+'\t'+str(newVoltage-sample.voltage)
+        if finished: self.finish('Regulation has completed. Mag up and try again.\n')
+        return newVoltage
+    def state(self):
+        return {'T_target':self.T_target}
+    def restore(self, state):
+        self.T_target = state['T_target']
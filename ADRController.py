@@ -20,18 +20,62 @@ PID_KI = 0						#not currently used, or even implemented
 dVdT_LIMIT = 0.008              #Keep dV/dt to under this value [V/s]
 dIdt_MAGUP_LIMIT = 9./(30*60)   #limit on the rate at which we allow current to increase in amps/s (we want 9A over 30 min)
 dIdt_REGULATE_LIMIT = 9./(40*60)#limit on the rate at which we allow current to change in amps/s (we want 9A over 40 min)
+MAG_UP_PLANNER = True           #Mag up by setting the voltage that keeps dI/dt just under dIdt_MAGUP_LIMIT, from the magnet model below (see ADRControl.MagUpPlanner), instead of raising it by MAG_UP_dV every step.  It stays within 1% of the limits and gets to CURRENT_LIMIT within about a minute of the fastest that allows; stepping is up to 2 min faster only by going 3-17% over dIdt_MAGUP_LIMIT, and a few minutes slower with the diode box.  See "python ADRSimulator.py magup".
+MAGNET_INDUCTANCE = 10.         #[H] The planner uses the inductance it measures from the back EMF instead whenever that is lower, so erring high is safe; a value far too low only makes it slower to get up to the full rate.
+MAGNET_RESISTANCE = 1.69/9      #[Ohm] Leads and joints (1.69V at 9A without the diode box).
+MAGNET_DIODE_DROP = 0.          #[V] About 0.9 with the external diode protection box.
 
+PLOT_BLITTING = True            #Only redraw the lines and legend every cycle, and the whole plot only when the axis limits change.  Set to False to redraw everything every cycle.
 STEP_LENGTH = 1000              #How long is each regulation/mag up cycle in ms.  **Never set this less than 1000ms.**  The SRS SIM922 only measures once a second and this would cause runaway voltages/currents.
+SIM922_PHASE_LOCK = True        #Keep the 1s cycles just after the SIM922 measures, so every cycle gets a new reading and the control steps act on it right away.
+SIM922_NEW_DATA_WAIT = 250      #[ms] If the SIM922 hasn't measured again when it is read, read it again every SIM922_NEW_DATA_POLL until it has, for up to this long.  0 to never wait.
+SIM922_NEW_DATA_POLL = 20       #[ms]
+RUOX_SETTLE_TIME_CONSTANTS = 10 #After the multiplexer switches, the RuOx bridge is read once this many time constants have passed.
+RUOX_MIN_DWELL = 30             #[s] When reading both GGG and FAA, stay on each channel at least this long so the multiplexer doesn't click back and forth.
+RUOX_PRIORITY_INTERVAL = 600    #[s] While regulating, the FAA has priority and the GGG is only read once this often.
+RUOX_TIME_CONSTANT_RECHECK = 600#[s] The RuOx bridge time constant is cached; it is only queried again this often in case it was changed on the front panel.
+CONTROL_MAX_SAMPLE_AGE = 2.5    #[s] Mag up and regulation only act on back EMF, I and V readings at most this old, otherwise they hold the voltage.
+REGULATE_TEMPERATURE = 0.1      #[K] The temperature regulated at until another one is entered.
+REGULATE_MAX_FAA_AGE = 120      #[s] Regulation only acts on an FAA temperature at most this old (the RuOx isn't read while the multiplexer settles).
+FAA_ESTIMATOR = True            #Estimate the FAA temperature every cycle from the RuOx readings and the magnet current (see ADREstimator), and regulate on that instead of the last reading.
+REGULATE_MAX_FAA_UNCERTAINTY = 0.01 #[fraction] ...as long as the estimate is this certain, otherwise the last reading is used as above.
+MAGNET_FIELD_PER_AMP = 4./9     #[T/A] The magnet makes 4T at 9A.
+FAA_INTERNAL_FIELD = 0.05       #[T] Internal field of the FAA salt, for the estimator.
+GUI_UPDATE_INTERVAL = 100       #[ms] How often the new samples are taken from the acquisition thread (by the window, or the main loop when running headless).
+TIMING_WINDOW_UPDATE_INTERVAL = 1000 #[ms] How often the Timing window (cycle, phase and GPIB command timing) is refreshed while it is open.
+REMOTE_ADDRESS = ('localhost', 6000) #Where measurement scripts connect to control the ADR and get the temperatures (see ADRRemote).  None for no remote control.
+LIVE_FEED_FILE = 'ADR_live.bin' #Every sample is put in this shared memory file (in the temp directory) for other programs on this computer to read (see ADRLiveFeed).  None for no live feed.
+LIVE_FEED_LENGTH = 24*60*60     #[samples] How many of the newest samples the live feed keeps.
+GPIB_CACHE_FILE = 'gpib_addresses.json'  #Where the *IDN? of each GPIB address is remembered between runs, so the whole bus doesn't need to be scanned every time (relative to this file)
+LOG_FLUSH_INTERVAL = 10         #[s] The temperature log is written to the file at least this often.  If the program crashes, at most this much data is lost.
+LOG_SYNC_INTERVAL = 60          #[s] ...and forced onto the disk at least this often (and when mag up/regulation start and stop).  If the computer crashes, at most this much data is lost.
+MESSAGE_LOG_LENGTH = 1000       #How many of the newest messages are kept in memory (for the window); all of them go to the log file, which is written at least every LOG_FLUSH_INTERVAL (right away for alerts).
+LOG_BOX_LINES = 200             #Most messages shown in the window's log box at once.
+LOG_BOX_UPDATE_INTERVAL = 250   #[ms] The log box shows new messages at most this often, however many come in.
+HISTORY_RELOAD_TIME = 24*60*60  #[s] How much of the logged history from previous runs is put back in the plot when the program starts.
+CHECKPOINT_INTERVAL = 10        #[s] How often what mag up or regulation is doing is saved in a checkpoint (in FILE_PATH, see ADRCheckpoint), so they can be picked up again if the program dies.
+CHECKPOINT_RESUME = True        #When the program starts, pick up the mag up or regulation that was running when it stopped, if the power supply readings say nothing has changed since.
+CHECKPOINT_MAX_AGE = 600        #[s] ...and the checkpoint is at most this old.
+CHECKPOINT_RESUME_WAIT = 10     #[s] How long to wait for a good reading to check the power supply against before giving up on picking it up again.
+CRYOSTATS = [{}]                #The ADRs run by this program, each with the settings that are different from the ones in this file (see CryostatConfig).  ex: [{'name':'new ADR', 'SIM900Address':'GPIB0::2::INSTR', 'powerSupplyAddress':'GPIB0::5::INSTR'}, {'name':'old ADR', 'oldADR':True, 'lakeshoreAddress':'GPIB0::12::INSTR', 'powerSupplyAddress':'GPIB0::6::INSTR', 'hasSIM900':False, 'filePath':'...', 'remoteAddress':('localhost',6001), 'liveFeedFile':'ADR_live_old.bin'}]
+BUS_REPORT_INTERVAL = 600       #[s] With more than one ADR, how often how much of the GPIB bus each one uses is logged.
 FILE_PATH = 'C:\\Users\\McDermott\\Desktop\\ADR Magnet Controller\\Development\\Python ADRController\\test_temp_log'#'Z:\\mcdermott-group\\ADR_log_files\\NEW_ADR'
 
 import visa, pyvisa
-import matplotlib as mpl
-mpl.use('TkAgg')
-import pylab, numpy
-import time, datetime
-import Tkinter
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
+import numpy
+import time, datetime, os, sys, json, threading, socket, collections, tempfile
 from operator import itemgetter
+from ADRHistory import HISTORY_CHANNELS
+from ADRArchive import MultiResolutionWriter, LogArchive
+from ADRAcquisition import AcquisitionEngine, RuOxScheduler, StaleDataError
+from ADRControl import ControlSettings, MagUpLoop, RegulationLoop, MagnetModel, MagUpPlanner, CONTROL_QUANTITIES
+from ADRTiming import timing, TimedSession
+from ADRPipeline import Write, Query, Done, runTransaction
+from ADRRemote import RemoteServer
+from ADRLiveFeed import LiveFeedWriter, SAMPLE_CHANNELS
+from ADREstimator import FAAEstimator
+from ADRScheduler import BusArbiter
+from ADRCheckpoint import CheckpointFile, checkResume
 
 class GPIBError(Exception):
      def __init__(self, value):
@@ -39,79 +83,222 @@ class GPIBError(Exception):
      def __str__(self):
          return 'Could not create device from string "' + str(self.value) + '"... Make sure all instruments are powered on and try again.'
 
-"""Searches through available devices with *IDN? and returns device with name that includes deviceName."""
-def getGPIB(deviceName):
-    try: # Python 2.7
-        rm = visa.ResourceManager()
-        for address in rm.list_resources():
-            if address[:4]=='GPIB':
-                instrument = rm.get_instrument(address)
-                if instrument.ask('*IDN?').lower().find(deviceName.lower()) >= 0:
-                    return instrument
-    except: pass
-    try: #Python 2.6
-        for address in visa.get_instruments_list():
-            if address[:4]=='GPIB':
-                instrument = visa.instrument(address)
-                if instrument.ask('*IDN?').lower().find(deviceName.lower()) >= 0:
-                    return instrument
-    except: pass
-    raise GPIBError(deviceName)
-    message = 'Cannot find resource with search string "'+deviceName+'".  Make sure to turn all instruments on, and if they already are, try turning them on and off again. \n'
-    log.log(message, alert=True)
-    return None
+""" Finds instruments on the GPIB bus.  The *IDN? string of every address is saved in GPIB_CACHE_FILE, so an
+    instrument is looked up by checking its cached address with a single *IDN?, and the whole bus is only scanned
+    if that fails (the first time, or if the instrument moved or was turned off).  There is only one session per
+    address, which everything that uses that instrument shares.  A resourceManager other than VISA's (ex: the
+    simulated bus in ADRSimulator) can be given, and cacheFile can be None to not remember anything. """
+class GPIBDirectory:
+    def __init__(self, cacheFile, resourceManager=None):
+        self.cacheFile = cacheFile
+        self.identities = {} #address: *IDN? string
+        self.sessions = {}   #address: open instrument
+        self.resourceManager = resourceManager
+        self.lock = threading.RLock()
+        try:
+            with open(self.cacheFile, 'r') as f: self.identities = json.load(f)
+        except (IOError, ValueError, TypeError): pass
+    def save(self):
+        if self.cacheFile is None: return
+        try:
+            with open(self.cacheFile, 'w') as f: json.dump(self.identities, f, indent=1, sort_keys=True)
+        except IOError: pass
+    def listAddresses(self):
+        try: # Python 2.7
+            if self.resourceManager is None: self.resourceManager = visa.ResourceManager()
+            addresses = self.resourceManager.list_resources()
+        except: #Python 2.6
+            self.resourceManager = None
+            addresses = visa.get_instruments_list()
+        return [address for address in addresses if address[:4]=='GPIB']
+    def session(self, address):
+        """The shared session for address, opened if necessary."""
+        if address not in self.sessions:
+            if self.resourceManager is None:
+                try: self.resourceManager = visa.ResourceManager()
+                except: pass
+            if self.resourceManager is not None: instrument = self.resourceManager.get_instrument(address)
+            else: instrument = visa.instrument(address)
+            #every command is timed, see ADRTiming
+            self.sessions[address] = TimedSession(instrument, address, timing)
+        return self.sessions[address]
+    def identify(self, address):
+        """Asks the instrument at address for its *IDN? and remembers it.  Returns None if nothing answers."""
+        try: identity = self.session(address).ask('*IDN?').strip('\x00').strip()
+        except:
+            self.sessions.pop(address, None)
+            self.identities.pop(address, None)
+            return None
+        self.identities[address] = identity
+        fields = identity.split(',')
+        if len(fields) > 1: self.sessions[address].name = fields[1].strip() #the model, ex: SIM900
+        return identity
+    def find(self, deviceName, address=None):
+        """Returns the session of the instrument whose *IDN? includes deviceName (the one at address, if it is
+        given, so several instruments of the same model can be told apart)."""
+        with self.lock:
+            if address is not None:
+                if address in self.sessions and address in self.identities: identity = self.identities[address]
+                else: identity = self.identify(address)
+                self.save()
+                if identity is None or identity.lower().find(deviceName.lower()) < 0: raise GPIBError(deviceName+' at '+address)
+                return self.sessions[address]
+            #check where we last saw it
+            for address, identity in self.identities.items():
+                if identity.lower().find(deviceName.lower()) >= 0:
+                    identity = self.identify(address)
+                    if identity is not None and identity.lower().find(deviceName.lower()) >= 0:
+                        return self.sessions[address]
+            #scan the whole bus, remembering every instrument, not just this one
+            found = None
+            try: addresses = self.listAddresses()
+            except: addresses = []
+            for address in addresses:
+                #instruments that are open and were already checked above are in use and aren't it (and the
+                #SIM900 may be connected through to a module, which would answer instead)
+                if address in self.sessions and address in self.identities: identity = self.identities[address]
+                else: identity = self.identify(address)
+                if found is None and identity is not None and identity.lower().find(deviceName.lower()) >= 0:
+                    found = self.sessions[address]
+            self.save()
+            if found is None: raise GPIBError(deviceName)
+            return found
+
+gpibDirectory = GPIBDirectory( os.path.join(os.path.dirname(os.path.abspath(__file__)), GPIB_CACHE_FILE) )
+
+"""Returns the (shared) instrument session whose *IDN? includes deviceName (at address, if it is given)."""
+def getGPIB(deviceName, address=None):
+    return gpibDirectory.find(deviceName, address)
+
+"""Finds instruments through resourceManager from now on instead of VISA (ex: ADRSimulator.SimulatedADR's).
+Has to be called before any instruments are created."""
+def useResourceManager(resourceManager):
+    global gpibDirectory, _sim900s
+    gpibDirectory = GPIBDirectory(None, resourceManager)
+    _sim900s = {}
+
+""" The SIM900 is the mainframe rack into which all the other modules fit (ex: sim922) and commands must go through it.
+    CONN connects the GPIB session through to one slot until the escape string ("xyz" here) is sent.  This keeps
+    track of which slot is connected and stays connected, so reading the same module again (or reading it several
+    times in one transaction) doesn't need another CONN/escape round trip.  All the modules must share one
+    SIM900Mainframe (see getSIM900) or the connected slot would be wrong.  address is its GPIB address, or None to
+    find it by model.  transactionSteps() is the same
+    transaction as steps for ADRPipeline, so it can run while other instruments are answering. """
+class SIM900Mainframe:
+    def __init__(self, instrument=None, escape='xyz', address=None):
+        if instrument is None: instrument = getGPIB('SIM900', address)
+        self.instrument = instrument
+        self.escape = escape # "xyz" is just an exit code to rever commands to go back to the SIM900
+        self.connectedSlot = None
+    def transaction(self, slot, commands, clear=False):
+        """Sends all the commands to the module in slot in one session, clearing its status first if clear is True.
+        Returns the replies to the queries (commands with a ?) in order."""
+        return runTransaction(self.transactionSteps(slot, commands, clear))
+    def transactionSteps(self, slot, commands, clear=False):
+        try:
+            if self.connectedSlot != slot:
+                if self.connectedSlot is not None:
+                    yield Write(self.instrument, self.escape)
+                    self.connectedSlot = None
+                yield Write(self.instrument, "CONN %d,'%s'" %(slot,self.escape))
+                self.connectedSlot = slot
+            if clear: yield Write(self.instrument, "*CLS")
+            replies = []
+            for command in commands:
+                if '?' in command: replies.append( (yield Query(self.instrument, command)).strip('\x00') )
+                else: yield Write(self.instrument, command)
+        except Exception as e:
+            #we don't know what state the mainframe is in anymore, so try to get back to it
+            self.connectedSlot = None
+            try: yield Write(self.instrument, self.escape)
+            except Exception: pass
+            raise e
+        yield Done(replies)
+
+_sim900s = {} #address (None if found by model): SIM900Mainframe
+"""Returns the SIM900Mainframe at address (or found by model) shared by all the SIM modules in it, creating it the
+first time."""
+def getSIM900(address=None):
+    if address not in _sim900s: _sim900s[address] = SIM900Mainframe(address=address)
+    return _sim900s[address]
 
 """ The SIM922 is a module that fits into the SIM900 mainframe, and in our setup, is used to measure
-    both the temperature diodes (chan 1,2) and the voltage across the magnet (chan 3,4)."""
+    both the temperature diodes (chan 1,2) and the voltage across the magnet (chan 3,4).  slot is SIM922_SLOT unless
+    it is given."""
 class SIM922:
-    def __init__(self):
-        #The SIM900 is the mainframe rack into which all the other modules fit (ex: sim922) and commands must go through it
-        self.SIM900 = getGPIB('SIM900')
+    def __init__(self, sim900=None, slot=None):
+        if sim900 is None: sim900 = getSIM900()
+        self.SIM900 = sim900
+        self.device = sim900 #everything in the mainframe goes through one GPIB address
+        self.slot = slot if slot is not None else SIM922_SLOT
+    def getDiodeTemperaturesAndMagnetVoltage(self):
+        """Reads the diode temperatures and the magnet voltage in one transaction."""
+        return runTransaction(self.diodeTemperaturesAndMagnetVoltageSteps())
     def getDiodeTemperatures(self):
-        self.SIM900.write("CONN %d,'xyz'" % SIM922_SLOT) # "xyz" is just an exit code to rever commands to go back to the SIM900
-        self.SIM900.write("*CLS")
-        diodeMonitorReturnString = self.SIM900.ask("TVAL? 0").strip('\x00')
-        self.SIM900.write("xyz")
+        return runTransaction(self.diodeTemperaturesSteps())
+    def getMagnetVoltage(self):
+        return runTransaction(self.magnetVoltageSteps())
+    def diodeTemperaturesAndMagnetVoltageSteps(self):
+        diodeMonitorReturnString, voltageReturnString = yield self.SIM900.transactionSteps(self.slot, ["TVAL? 0","VOLT? 0"], clear=True)
+        yield Done( (self.parseTemperatures(diodeMonitorReturnString), self.parseMagnetVoltage(voltageReturnString)) )
+    def diodeTemperaturesSteps(self):
+        diodeMonitorReturnString, = yield self.SIM900.transactionSteps(self.slot, ["TVAL? 0"], clear=True)
+        yield Done( self.parseTemperatures(diodeMonitorReturnString) )
+    def magnetVoltageSteps(self):
+        voltageReturnString, = yield self.SIM900.transactionSteps(self.slot, ["VOLT? 0"], clear=True)
+        yield Done( self.parseMagnetVoltage(voltageReturnString) )
+    def parseTemperatures(self, diodeMonitorReturnString):
         temperatures = [float(x) for x in diodeMonitorReturnString.split(',')][:2]
         return temperatures
-    def getMagnetVoltage(self):
-        self.SIM900.write("CONN %d,'xyz'" % SIM922_SLOT)
-        self.SIM900.write("*CLS")
-        diodeMonitorReturnString = self.SIM900.ask("VOLT? 0").strip('\x00')
-        self.SIM900.write("xyz")
-        magnetVoltages = [float(x) for x in diodeMonitorReturnString.split(',')][2:]
+    def parseMagnetVoltage(self, voltageReturnString):
+        magnetVoltages = [float(x) for x in voltageReturnString.split(',')][2:]
         return (abs(magnetVoltages[0])+abs(magnetVoltages[1]))/2
 
 """ This class implements the Lakeshore 218 temperature monitor for measuring the Diode Thermometers
     in the old ADRs."""
 class LakeshoreTemperatureMonitor:
-    def __init__(self):
-        #The SIM900 is the mainframe rack into which all the other modules fit (ex: sim922) and commands must go through it
-        self.lakeshore = getGPIB('Lakeshore')
+    def __init__(self, address=None):
+        self.lakeshore = getGPIB('MODEL218', address) #its *IDN? is LSCI,MODEL218S,...
+        self.device = self.lakeshore
     def getDiodeTemperatures(self):
-        self.lakeshore.write("*CLS")
-        diodeMonitorReturnString = self.lakeshore.ask("KRDG? 0").strip('\x00')
+        return runTransaction(self.diodeTemperaturesSteps())
+    def diodeTemperaturesSteps(self):
+        yield Write(self.lakeshore, "*CLS")
+        diodeMonitorReturnString = (yield Query(self.lakeshore, "KRDG? 0")).strip('\x00')
         temperatures = [float(x) for x in diodeMonitorReturnString.split(',')][6:8]
-        return temperatures
+        yield Done(temperatures)
 		
 """ This class implements both the SIM921 AC Resistance Bridge for measuring the RuOx temperature sensors,
     and the SIM925 Multiplexor to select which channel (read: RuOx detector) to read. The multiplexer clicks
     a lot if you want it to switch back and forth rapidly so as to measure the temperature on the AC bridge
-    for both RuOx thermometers.  Therefore this is set to ignore the 1K stage.  If you want to measure both,
-    change the False to True in the if(False) below """
+    for both RuOx thermometers.  Therefore RuOxScheduler (in ADRAcquisition.py) decides which channel to read
+    and for how long, and only reads the 1K stage (GGG) if it is checked.  The slots are SIM921_SLOT and SIM925_SLOT
+    unless they are given. """
 class RuOxTemperatureMonitor:
-    def __init__(self):
-        self.SIM900 = getGPIB('SIM900')
+    def __init__(self, sim900=None, bridgeSlot=None, multiplexerSlot=None):
+        if sim900 is None: sim900 = getSIM900()
+        self.SIM900 = sim900
+        self.device = sim900
+        self.bridgeSlot = bridgeSlot if bridgeSlot is not None else SIM921_SLOT
+        self.multiplexerSlot = multiplexerSlot if multiplexerSlot is not None else SIM925_SLOT
         self.channel = 0 #channel 2 is the FAA pill.  GGG pill is chan 1
         self.lastTime = time.time()
+        self.timeConstant = None #cached, see getTimeConstant
+        self.timeConstantTime = 0
         self.setChannel(2)
-    def getTimeConstant(self): #returns time constant in ms
-        timeConstCodes = {'-1':'filter off', '0':0.3, '1':1, '2':3, '3':10, '4':30, '5':100, '6':300}
-        self.SIM900.write("CONN %d,'xyz'" %SIM921_SLOT)
-        returnCode = self.SIM900.ask("TCON?").strip('\x00')
-        t = timeConstCodes[returnCode]
-        self.SIM900.write("xyz")
-        return t
+    def getTimeConstant(self): #returns time constant in s
+        """The time constant only changes if someone changes it, so it is cached.  setTimeConstant clears the cache,
+        and it is queried again every RUOX_TIME_CONSTANT_RECHECK in case it was changed on the front panel."""
+        if self.timeConstant is None or time.time() - self.timeConstantTime > RUOX_TIME_CONSTANT_RECHECK:
+            timeConstCodes = {'-1':'filter off', '0':0.3, '1':1, '2':3, '3':10, '4':30, '5':100, '6':300}
+            returnCode, = self.SIM900.transaction(self.bridgeSlot, ["TCON?"])
+            self.timeConstant = timeConstCodes[returnCode]
+            self.timeConstantTime = time.time()
+        return self.timeConstant
+    def setTimeConstant(self, code):
+        """code is the SIM921 TCON code (-1 for filter off, 0 for 0.3s ... 6 for 300s)."""
+        self.SIM900.transaction(self.bridgeSlot, ["TCON %d" %code])
+        self.timeConstant = None
     def getTimeSinceChannelSet(self): #returns the time since the channel was changed in ms
         return time.time() - self.lastTime
     def getChannel(self):
@@ -120,33 +307,30 @@ class RuOxTemperatureMonitor:
         if self.channel != channel:
             self.channel = channel
             #set channel on multiplexer
-            self.SIM900.write("CONN %d,'xyz'" %SIM925_SLOT)
-            self.SIM900.write("CHAN %d" %channel)
-            self.SIM900.write("xyz")
+            self.SIM900.transaction(self.multiplexerSlot, ["CHAN %d" %channel])
             #set curve on AC resistance bridge
-            self.SIM900.write("CONN %d,'xyz'" %SIM921_SLOT)
-            self.SIM900.write("CURV %d" %channel)
-            self.SIM900.write("xyz")
+            self.SIM900.transaction(self.bridgeSlot, ["CURV %d" %channel])
             #set lastTime
             self.lastTime = time.time()
     def getTemperature(self):
-        self.SIM900.write("CONN %d,'xyz'" %SIM921_SLOT)
-        gpibstring = self.SIM900.ask("TVAL?")
-        T = float(gpibstring.strip('\x00')) 
-        self.SIM900.write("xyz")
+        gpibstring, = self.SIM900.transaction(self.bridgeSlot, ["TVAL?"])
+        T = float(gpibstring)
         return T
 		
 """ This class should be able to manage all controls for the power supply.  Setting Voltage and Current works
     just as it would if you were to turn the knobs on the power supply itself.  getObsReg() returns the operating
-    mode of the power supply, ex: Current Control (CC). """
+    mode of the power supply, ex: Current Control (CC).  address is its GPIB address (None to find it by model),
+    and currentLimit is CURRENT_LIMIT unless it is given. """
 class PowerSupply:
-    def __init__(self,log):
+    def __init__(self,log,address=None,currentLimit=None):
         self.log = log
         self.initError = None
-        try: self.instrument = getGPIB('6641A')
+        self.currentLimit = currentLimit if currentLimit is not None else CURRENT_LIMIT
+        try: self.instrument = getGPIB('6641A', address)
         except GPIBError as e:
              self.initError = str(e)
              self.instrument = None
+        self.device = self.instrument
     def instrumentIsConnected(self):
         if self.instrument == None:
             return (False, self.initError)
@@ -155,6 +339,13 @@ class PowerSupply:
         return float(self.instrument.ask('MEAS:CURR?').strip('\x00'))
     def getVoltage(self):
         return float(self.instrument.ask('MEAS:VOLT?').strip('\x00'))
+    def getCurrentAndVoltage(self):
+        return runTransaction(self.currentAndVoltageSteps())
+    def currentAndVoltageSteps(self):
+        """Reads the current and voltage, as steps for ADRPipeline."""
+        I = yield Query(self.instrument, 'MEAS:CURR?')
+        V = yield Query(self.instrument, 'MEAS:VOLT?')
+        yield Done( (float(I.strip('\x00')), float(V.strip('\x00'))) )
     def setCurrent(self,I):
         self.instrument.write('CURR '+'{0:5.6f}'.format(I))
     def setVoltage(self,V):
@@ -176,173 +367,192 @@ class PowerSupply:
         elif CC: return 'CC Mode'
         else: return 'OutputOff'
     def initiate(self):
-        if self.getCurrent()-0.01 >= CURRENT_LIMIT:
+        if self.getCurrent()-0.01 >= self.currentLimit:
             message = 'Current too high! Manually lower before trying to run again. Please quit now.\n'
             self.log.log(message, alert=True)
         else:
             state = self.getOpsReg()
             if state == 'OutputOff':
-                message = 'Output Off. Setting Current to '+str(CURRENT_LIMIT)+' Amps and voltage to 0 Volts.\n'
+                message = 'Output Off. Setting Current to '+str(self.currentLimit)+' Amps and voltage to 0 Volts.\n'
                 self.log.log(message)
                 self.reset()
-                self.setCurrent(CURRENT_LIMIT)
+                self.setCurrent(self.currentLimit)
                 self.setVoltage(0)
                 self.setOutputOn()
             elif state == 'CV Mode':
-                message = 'Starting in CV Mode. Setting Current to '+str(CURRENT_LIMIT)+' Amps.\n'
+                message = 'Starting in CV Mode. Setting Current to '+str(self.currentLimit)+' Amps.\n'
                 self.log.log(message)
-                self.setCurrent( CURRENT_LIMIT )
+                self.setCurrent( self.currentLimit )
             elif state == 'CC Mode':
                 V_now = self.getVoltage()
-                message = 'Starting in CC Mode. Setting Current to '+str(CURRENT_LIMIT)+' Amps and voltage to '+str(V_now)+' Volts.\n'
+                message = 'Starting in CC Mode. Setting Current to '+str(self.currentLimit)+' Amps and voltage to '+str(V_now)+' Volts.\n'
                 self.log.log(message)
                 V_now = self.getVoltage()
                 self.setVoltage( V_now )
-                self.setCurrent( CURRENT_LIMIT )
-
-"""Inherited from the Tkinter Entry widget, this just turns red when a limit is reached"""
-class EntryWithAlert(Tkinter.Entry):
-    def __init__(self, *args, **kwargs):
-        self.upper_limit = kwargs.pop('upper_limit',False)
-        self.lower_limit = kwargs.pop('lower_limit',False)
-        self.variable = kwargs['textvariable']
-        self.variable.trace('w',self.callback)
-        Tkinter.Entry.__init__(self,*args,**kwargs)
-        self.naturalBGColor = self.cget('disabledbackground')
-    def callback(self,*dummy):
-        if self.upper_limit != False or self.lower_limit != False:
-            x = self.variable.get()
-            if x == '' or float(x) > float(self.upper_limit) or float(x) < float(self.lower_limit):
-                self.configure(disabledbackground='red')
-            else:
-                self.configure(disabledbackground=self.naturalBGColor)
+                self.setCurrent( self.currentLimit )
 
-"""This class inherits a Tkinter Text widget to make a simple log box.  It will log an entry,
-and set the color to red if alert is set to True.  A time stamp is automatically added."""
-class LogBox(Tkinter.Text):
-    def __init__(self, *args, **kwargs):
-        self.dateAppend = kwargs.pop('date_append','')
-        Tkinter.Text.__init__(self,*args,**kwargs)
-        self.tag_config("redAlert", background="red")
-        self.configure(state=Tkinter.DISABLED)
+"""The message log.  Every message gets a time stamp and a number, and the newest length of them are kept in
+entries (a ring) as (number, message with time stamp, alert).  They are all written to the log file, which is
+kept open and buffered: it is flushed right after an alert, and otherwise at least every flushInterval (by
+poll(), so a quiet log doesn't sit in the buffer).  Views (ex: the LogBox in the window) are only told that
+there are new messages, and take them from entries when they are ready to show them; without any views the
+messages are printed, so a headless controller still shows them on the console (after name, if there is one,
+so the messages of several cryostats can be told apart).  The log file is in filePath (FILE_PATH if it isn't
+given)."""
+class ControllerLog:
+    def __init__(self, dateAppend='', length=1000, flushInterval=10, filePath=None, name=''):
+        self.dateAppend = dateAppend
+        self.filePath = filePath
+        self.name = name
+        self.views = []
+        self.entries = collections.deque(maxlen=length)
+        self.count = 0 #messages logged so far, the number of the next one
+        self.flushInterval = flushInterval
+        self.lastFlush = time.time()
+        self.logFile = None
     def log(self, message, alert=False):
         dt = datetime.datetime.now()
-        messageWithTimeStamp = dt.strftime("[%m/%d/%y %H:%M:%S] ") + message
-        self.configure(state=Tkinter.NORMAL)
-        self.insert(1.0,messageWithTimeStamp)
-        if alert: self.tag_add("redAlert", '1.0', '1.end')
-        self.configure(state=Tkinter.DISABLED)
-        with open(FILE_PATH+'\\log'+self.dateAppend+'.txt', 'a') as f:
-            f.write( messageWithTimeStamp + '\n' )
+        messageWithTimeStamp = dt.strftime("[%m/%d/%y %H:%M:%S] ") + message.rstrip('\n')
+        self.entries.append( (self.count, messageWithTimeStamp, alert) )
+        self.count += 1
+        for view in self.views: view.messageLogged()
+        if len(self.views) == 0: print (self.name+': ' if self.name else '') + ('ALERT ' if alert else '') + messageWithTimeStamp
+        try:
+            if self.logFile is None: self.logFile = open(os.path.join(self.filePath or FILE_PATH, 'log'+self.dateAppend+'.txt'), 'a')
+            self.logFile.write( messageWithTimeStamp + '\n' )
+        except IOError as e:
+            print 'Could not write to the log file: '+str(e)
+            self.logFile = None
+        if alert: self.flush()
+        else: self.poll()
+    def getEntries(self, after=-1, alertsOnly=False, limit=None):
+        """The entries numbered after after (only the alerts if alertsOnly), oldest first, at most the newest
+        limit of them."""
+        entries = []
+        for entry in reversed(self.entries):
+            if entry[0] <= after or (limit is not None and len(entries) >= limit): break
+            if entry[2] or not alertsOnly: entries.append(entry)
+        entries.reverse()
+        return entries
+    def poll(self):
+        """Flushes the log file if it hasn't been for flushInterval."""
+        if time.time() - self.lastFlush > self.flushInterval: self.flush()
+    def flush(self):
+        self.lastFlush = time.time()
+        if self.logFile is None: return
+        try: self.logFile.flush()
+        except IOError as e:
+            print 'Could not write to the log file: '+str(e)
+            self.logFile = None
+    def close(self):
+        if self.logFile is not None: self.logFile.close()
 
-class ADRController(Tkinter.Tk):
-    def __init__(self,parent, diodeTempMonitor=None, ruoxTempMonitor=None, magnetVoltageMonitor=None):
-        Tkinter.Tk.__init__(self,parent)
-        self.parent = parent
+""" The settings of one cryostat (ADR): which instruments it has and where, its limits and magnet, and where its
+    files, remote control and live feed are.  They are the constants at the top of this file unless they are
+    given (CRYOSTATS lists the ones that are different for each cryostat).  With several cryostats on one bus, each
+    one needs the addresses of its own instruments (otherwise they are found by model, and would be the same
+    ones), and its own filePath, remoteAddress and liveFeedFile.  oldADR is for the old ADRs, which read the diodes
+    with a Lakeshore 218; hasSIM900 is False if there is no SIM900 (then there are no RuOx or magnet voltage
+    readings). """
+class CryostatConfig:
+    def __init__(self, **settings):
+        self.name = 'ADR'
+        self.oldADR = False
+        self.hasSIM900 = True
+        self.SIM900Address = None
+        self.SIM922Slot = SIM922_SLOT
+        self.SIM921Slot = SIM921_SLOT
+        self.SIM925Slot = SIM925_SLOT
+        self.lakeshoreAddress = None
+        self.powerSupplyAddress = None
+        self.currentLimit = CURRENT_LIMIT
+        self.voltageLimit = VOLTAGE_LIMIT
+        self.magnetVoltageLimit = MAGNET_VOLTAGE_LIMIT
+        self.magnetInductance = MAGNET_INDUCTANCE
+        self.magnetResistance = MAGNET_RESISTANCE
+        self.magnetDiodeDrop = MAGNET_DIODE_DROP
+        self.filePath = FILE_PATH
+        self.remoteAddress = REMOTE_ADDRESS
+        self.liveFeedFile = LIVE_FEED_FILE
+        for name, value in settings.items():
+            if not hasattr(self, name): raise ValueError('Unknown cryostat setting '+name)
+            setattr(self, name, value)
+    def controlSettings(self):
+        """The limits and gains for the control laws in ADRControl."""
+        return ControlSettings(self.currentLimit, self.voltageLimit, self.magnetVoltageLimit, MAG_UP_dV, dIdt_MAGUP_LIMIT,
+                               dIdt_REGULATE_LIMIT, dVdT_LIMIT, PID_KP, PID_KD, PID_KI)
+
+"""The limits and gains set at the top of this file, for the control laws in ADRControl."""
+def defaultControlSettings():
+    return CryostatConfig().controlSettings()
+
+""" Everything the ADR Controller does except show it: the instruments, the acquisition thread, the temperature
+    log, mag up and regulation, and remote control.  It doesn't need Tkinter or matplotlib, so it can run on its
+    own on a computer without a screen (run this file with --headless), and measurement scripts can still
+    control it and get the temperatures through ADRRemote, or read them from the live feed (ADRLiveFeed).  The window (ADRWindow) is a view of it: views are
+    added with addView before start(), and are told about new messages (messageLogged), the samples recorded every
+    poll (showSamples) and mag up or regulation starting or stopping (controlChanged).  poll() has to be called
+    every GUI_UPDATE_INTERVAL, by the window or by run() when headless.  config is the cryostat's CryostatConfig
+    (the constants in this file if it isn't given), and bus the BusArbiter it shares with other cryostats, if it
+    does (see CryostatGroup).  Its state is saved in a checkpoint every CHECKPOINT_INTERVAL, and a mag up or
+    regulation that was running when the last run stopped is picked up again (see ADRCheckpoint). """
+class ADRCore:
+    def __init__(self, config=None, bus=None):
+        self.config = config if config is not None else CryostatConfig()
+        self.bus = bus
+        self.lastBusReport = time.time()
         self.newTemps = [numpy.NaN,numpy.NaN,numpy.NaN,numpy.NaN]
-        self.timeStamps = numpy.array([])
+        self.views = []
         # vars used during each measurement cycle
         self.isRegulating = False
         self.isMaggingUp = False
+        self.controlSettings = self.config.controlSettings()
+        self.controlLoop = None #the MagUpLoop or RegulationLoop running, if any
+        self.regulateTemperature = REGULATE_TEMPERATURE
+        self.readGGG, self.readFAA = False, True #which RuOx channels are read (regulating always reads the FAA)
         self.cycle = 0
-        self.GGGTemp = numpy.nan
-        self.FAATemp = numpy.nan
-        self.ruoxChan = 'FAA'
         self.startTime = time.time()
+        self.lastPowerSupplyCheck = None
         dt = datetime.datetime.now()
         self.dateAppend = dt.strftime("_%y%m%d_%H%M")
-        #initialize and start measurement loop
-        self.initializeWindow()
+        self.log = ControllerLog(self.dateAppend, MESSAGE_LOG_LENGTH, LOG_FLUSH_INTERVAL, self.config.filePath,
+                                 self.config.name if bus is not None else '')
+        self.acquisition = None
+        self.remote = None
+        self.liveFeed = None
+        self.temperatureLog = None
+        self.closed = False
+        self.checkpoint = CheckpointFile(self.config.filePath)
+        self.lastCheckpoint = None
+        self.checkpointFailed = False
+        self.resumeState = None #the last run's checkpoint, until it has been picked up again
+        self.resumeDeadline = None
+        self.loadCheckpoint()
+    def addView(self, view):
+        self.views.append(view)
+        self.log.views.append(view)
+    def start(self, diodeTempMonitor=None, ruoxTempMonitor=None, magnetVoltageMonitor=None):
+        """Opens the log, finds the instruments and starts the acquisition thread and remote control."""
+        self.openTemperatureLog()
         self.initializeInstruments(diodeTempMonitor, ruoxTempMonitor, magnetVoltageMonitor)
+        #from here on, only the acquisition thread talks to the instruments
+        ruoxScheduler = None
+        if self.ruoxTempMonitor is not None:
+            ruoxScheduler = RuOxScheduler(self.ruoxTempMonitor, RUOX_SETTLE_TIME_CONSTANTS, RUOX_MIN_DWELL, RUOX_PRIORITY_INTERVAL)
+        estimator = FAAEstimator(MAGNET_FIELD_PER_AMP, FAA_INTERNAL_FIELD) if FAA_ESTIMATOR else None
+        self.acquisition = AcquisitionEngine(self.diodeTempMonitor, self.ruoxTempMonitor, self.magnetVoltageMonitor, self.ps,
+                                             period=STEP_LENGTH/1000., ruoxScheduler=ruoxScheduler, phaseLock=SIM922_PHASE_LOCK,
+                                             estimator=estimator, newDataWait=SIM922_NEW_DATA_WAIT/1000., newDataPollInterval=SIM922_NEW_DATA_POLL/1000.,
+                                             bus=self.bus, name=self.config.name)
+        self.startLiveFeed()
+        self.acquisition.start()
         self.executeExternalCommands()
-        self.after(100, self.measurementCycle)
-        self.after(200, self.renewPowerSupply)
-    def initializeWindow(self):
-        root = self
-        #set up window
-        self.wm_title('ADR Magnet Controller')
-        w, h = self.winfo_screenwidth(), self.winfo_screenheight()
-        self.geometry("%dx%d+0+0" % (w/2, 0.9*h))
-        #error/message box log
-        self.log = LogBox(master=root, height=5, date_append=self.dateAppend)
-        self.log.pack(side=Tkinter.TOP, fill=Tkinter.X)
-        # temp plot
-        fig = pylab.figure()
-        self.ax = fig.add_subplot(111)
-        #self.ax2 = self.ax.twinx()
-        self.ax.set_title('Realtime Temperature Readout\n\n\n')
-        self.ax.set_xlabel('Time [s]')
-        self.ax.set_ylabel('Temparture [K]')
-        self.stage60K, = self.ax.plot([],[])
-        self.stage03K, = self.ax.plot([],[])
-        self.stageGGG, = self.ax.plot([],[])
-        self.stageFAA, = self.ax.plot([],[])
-        self.canvas = FigureCanvasTkAgg(fig, master=root)
-        self.canvas.show()
-        self.canvas.get_tk_widget().pack(side=Tkinter.TOP, fill=Tkinter.BOTH, expand=1)
-        #temp plot toolbar at bottom
-        self.toolbar = NavigationToolbar2TkAgg( self.canvas, root )
-        self.toolbar.update()
-        #self.toolbar.pack(side=Tkinter.BOTTOM, fill=Tkinter.X)
-        self.canvas._tkcanvas.pack(side=Tkinter.TOP, fill=Tkinter.BOTH, expand=1)
-        #which temp plots should I show? (checkboxes)
-        tempSelectFrame = Tkinter.Frame(root)
-        tempSelectFrame.pack(side=Tkinter.TOP)
-        self.t60K = Tkinter.IntVar()
-        self.t3K = Tkinter.IntVar()
-        self.tGGG = Tkinter.IntVar()
-        self.tFAA = Tkinter.IntVar()
-        self.t60K.set(0)
-        self.t3K.set(1)
-        self.tGGG.set(0)
-        self.tFAA.set(1)
-        t1checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '60K Stage', variable=self.t60K, fg='blue')
-        t1checkbox.pack(side=Tkinter.LEFT)
-        t2checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '3K Stage', variable=self.t3K, fg='forest green')
-        t2checkbox.pack(side=Tkinter.LEFT)
-        t3checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '1K Stage (GGG)', variable=self.tGGG, fg='red')
-        t3checkbox.pack(side=Tkinter.LEFT)
-        t4checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '50mK Stage (FAA)', variable=self.tFAA, fg='dark turquoise')
-        t4checkbox.pack(side=Tkinter.LEFT)
-        #scale to adjust time shown in temp plot
-        self.wScale = Tkinter.Scale(master=root,label="60*Cycles=Minutes Displayed (1 cycle ~ 1 sec)", from_=1, to=1440,sliderlength=30,length=500, orient=Tkinter.HORIZONTAL)
-        self.wScale.set(1440)
-        self.wScale.pack(side=Tkinter.TOP)
-        #frame for mag up and regulate controls
-        magControlsFrame = Tkinter.Frame(root)
-        magControlsFrame.pack(side=Tkinter.TOP)
-        #mag up button
-        self.magUpButton = Tkinter.Button(master=magControlsFrame, text='Mag Up', command=self.magUp)
-        self.magUpButton.pack(side=Tkinter.LEFT)
-        #regulate button and temp field
-        self.regulateButton = Tkinter.Button(master=magControlsFrame, text='Regulate', command=self.regulate)
-        self.regulateButton.pack(side=Tkinter.LEFT)
-        Tkinter.Label(magControlsFrame, text=" at ").pack(side=Tkinter.LEFT)
-        self.regulateTempField = Tkinter.Entry(magControlsFrame)
-        self.regulateTempField.pack(side=Tkinter.LEFT)
-        self.regulateTempField.insert(0, "0.1")
-        Tkinter.Label(magControlsFrame, text="K").pack(side=Tkinter.LEFT)
-        #shows current values for backEMF, current, voltage
-        monitorFrame = Tkinter.Frame(root)
-        monitorFrame.pack(side=Tkinter.TOP)
-        self.currentBackEMF = Tkinter.StringVar() #current as in now, not as in amps
-        self.currentI = Tkinter.StringVar()
-        self.currentV = Tkinter.StringVar()
-        Tkinter.Label(monitorFrame, text="Back EMF = ").pack(side=Tkinter.LEFT)
-        backEMFField = EntryWithAlert(monitorFrame, textvariable=self.currentBackEMF, state=Tkinter.DISABLED, upper_limit=MAGNET_VOLTAGE_LIMIT)
-        backEMFField.pack(side=Tkinter.LEFT)
-        Tkinter.Label(monitorFrame, text="(V)   I = ").pack(side=Tkinter.LEFT)
-        currentIField = EntryWithAlert(monitorFrame, textvariable=self.currentI, state=Tkinter.DISABLED, upper_limit=CURRENT_LIMIT)
-        currentIField.pack(side=Tkinter.LEFT)
-        Tkinter.Label(monitorFrame, text="(A)   V = ").pack(side=Tkinter.LEFT)
-        currentVField = EntryWithAlert(monitorFrame, textvariable=self.currentV, state=Tkinter.DISABLED, upper_limit=VOLTAGE_LIMIT)
-        currentVField.pack(side=Tkinter.LEFT)
-        Tkinter.Label(monitorFrame, text="(V)").pack(side=Tkinter.LEFT)
-        #X BUTTON
-        self.protocol("WM_DELETE_WINDOW", self._quit)
+        self.resumeDeadline = time.time() + CHECKPOINT_RESUME_WAIT
     def initializeInstruments(self, diodeTempMonitor, ruoxTempMonitor, magnetVoltageMonitor):
-        """This method simply creates the instances of the power suply, sim922, and ruox temperature monitor."""
-        self.ps = PowerSupply(self.log)
+        """This method simply creates the instances of the power suply, sim922, and ruox temperature monitor (the
+        ones that aren't given), at the addresses and slots in config."""
+        config = self.config
+        self.ps = self.newPowerSupply(self.log)
         con, err = self.ps.instrumentIsConnected()
         if con == False:
             self.log.log(err, alert=True)
@@ -350,285 +560,375 @@ class ADRController(Tkinter.Tk):
             self.log.log(message, alert=True)
         else:
             self.ps.initiate()
-        if ruoxTempMonitor == None:
-            try: ruoxTempMonitor = RuOxTemperatureMonitor()
+        sim900 = None
+        if config.hasSIM900 and None in (ruoxTempMonitor, diodeTempMonitor, magnetVoltageMonitor):
+            try: sim900 = getSIM900(config.SIM900Address)
             except GPIBError as e: self.log.log(str(e),alert=True)
+        if ruoxTempMonitor == None and sim900 is not None:
+            ruoxTempMonitor = RuOxTemperatureMonitor(sim900, config.SIM921Slot, config.SIM925Slot)
         if diodeTempMonitor == None:
-            try: diodeTempMonitor = SIM922()
-            except GPIBError as e: self.log.log(str(e),alert=True)
+            if config.oldADR:
+                try: diodeTempMonitor = LakeshoreTemperatureMonitor(config.lakeshoreAddress)
+                except GPIBError as e: self.log.log(str(e),alert=True)
+            elif sim900 is not None: diodeTempMonitor = SIM922(sim900, config.SIM922Slot)
         if magnetVoltageMonitor == None:
-            try: magnetVoltageMonitor = SIM922()
-            except GPIBError as e: self.log.log(str(e),alert=True)
+            #one SIM922 reads both, so the temperatures and voltage can be read in one transaction
+            if isinstance(diodeTempMonitor, SIM922): magnetVoltageMonitor = diodeTempMonitor
+            elif sim900 is not None: magnetVoltageMonitor = SIM922(sim900, config.SIM922Slot)
         self.ruoxTempMonitor = ruoxTempMonitor
         self.diodeTempMonitor = diodeTempMonitor
         self.magnetVoltageMonitor = magnetVoltageMonitor
-    def measurementCycle(self):
-        """ This takes care of the real time temperature plotting. It starts immediately upon starting the program, and never stops. """
-        i = self.cycle
-        cycleStartTime = time.time()
-        #update current and voltage data
-        self.currentBackEMF.set( "{0:.3f}".format(self.magnetVoltageMonitor.getMagnetVoltage()) )
-        if self.ps.instrumentIsConnected()[0] == True:
-            try:
-                self.currentI.set( "{0:.3f}".format(self.ps.getCurrent()) )
-                self.currentV.set( "{0:.3f}".format(self.ps.getVoltage()) )
-            except:
-                self.currentI.set('')
-                self.currentV.set('')
-        else:
-            self.currentI.set('')
-            self.currentV.set('')
-        #append diode temp data
-        self.newTemps = self.diodeTempMonitor.getDiodeTemperatures()
-        #append the ruox temps, but can only measure every once in a while b/c of time constant
-        if self.ruoxTempMonitor.getTimeSinceChannelSet() >= 10*self.ruoxTempMonitor.getTimeConstant():
-            if self.ruoxChan == 'GGG': self.GGGTemp = self.ruoxTempMonitor.getTemperature()
-            elif self.ruoxChan == 'FAA': self.FAATemp = self.ruoxTempMonitor.getTemperature()
-            if self.tGGG.get() == 1 and self.tFAA.get() == 1:
-                if self.ruoxChan == 'GGG':
-                    self.ruoxTempMonitor.setChannel(2)
-                    self.ruoxChan = 'FAA'
-                elif self.ruoxChan == 'FAA':
-                    self.ruoxTempMonitor.setChannel(1)
-                    self.ruoxChan = 'GGG'
-            elif self.tGGG.get() == 1 and self.tFAA.get() == 0:
-                self.ruoxTempMonitor.setChannel(1)
-                self.ruoxChan = 'GGG'
-            elif self.tGGG.get() == 0 and self.tFAA.get() == 1:
-                self.ruoxTempMonitor.setChannel(2)
-                self.ruoxChan = 'FAA'
-        if self.tGGG.get() == 0 or self.GGGTemp == 20.0: self.GGGTemp = numpy.nan
-        if self.tFAA.get() == 0 or self.FAATemp == 45.0: self.FAATemp = numpy.nan
-        self.newTemps += [self.GGGTemp,self.FAATemp]
-        #append temp array to tempHistory, soon have it save to file
-        self.timeStamps = numpy.append(self.timeStamps,time.time() - self.startTime)
+    def setRuOxChannels(self, GGG, FAA):
+        """Which RuOx channels to read and record (ex: the checkboxes in the window)."""
+        self.readGGG, self.readFAA = GGG, FAA
+    def poll(self):
+        """ Takes the new samples from the acquisition thread, records them and hands them to the views, and runs
+        whatever has to happen on this thread (remote commands, mag up or regulation finishing). """
+        #tell the acquisition thread which RuOx channels to read (regulating always needs the FAA, and gets priority)
+        priority = 'FAA' if self.isRegulating else None
+        self.acquisition.setRuOxChannels(GGG=self.readGGG, FAA=self.readFAA or self.isRegulating, priority=priority)
+        for message, alert in self.acquisition.messageLog.getMessages():
+            self.log.log(message, alert=alert)
+        self.log.poll()
+        #the control loop runs on the acquisition thread, and may have finished
+        if self.controlLoop is not None and self.controlLoop.finished:
+            self.controlFinished()
+        if self.resumeState is not None: self.resumeControl()
+        if self.lastCheckpoint is None or time.time() - self.lastCheckpoint > CHECKPOINT_INTERVAL:
+            self.saveCheckpoint()
+        self.runRemoteCommands()
+        if self.lastPowerSupplyCheck is None or time.time() - self.lastPowerSupplyCheck > 60:
+            self.renewPowerSupply()
+        records = [self.recordSample(sample) for sample in self.acquisition.getSamples()]
+        if len(records) > 0:
+            for view in self.views: view.showSamples(records)
+        if self.bus is not None and time.time() - self.lastBusReport > BUS_REPORT_INTERVAL:
+            self.lastBusReport = time.time()
+            self.log.log('GPIB bus use of the cryostats:\n'+self.bus.summary()+'\n')
+    def run(self):
+        """Runs without a window until Ctrl+C."""
+        try:
+            while True:
+                self.poll()
+                time.sleep(GUI_UPDATE_INTERVAL/1000.)
+        except KeyboardInterrupt: pass
+        finally: self.close()
+    def recordSample(self, sample):
+        """Saves the readings of one sample in the temperature file.  Returns (sample, time stamp from the start
+        of the run, the values recorded) for the views."""
+        self.newTemps = list(sample.temps)
+        if not self.readGGG: self.newTemps[2] = numpy.nan
+        if not self.readFAA: self.newTemps[3] = numpy.nan
+        timeStamp = sample.timeStamp - self.startTime
+        values = self.newTemps + [sample.backEMF, sample.current, sample.voltage]
+        logged = values
+        if not sample.fresh:
+            #the SIM922 hadn't measured again, so its readings would just be repeated
+            logged = [numpy.nan, numpy.nan] + values[2:4] + [numpy.nan] + values[5:]
         #save temps in file
-        with open(FILE_PATH+'\\temperatures'+self.dateAppend+'.txt','a') as f:
-            f.write(str(self.timeStamps[-1]) + '\t' + '\t'.join(map(str,self.newTemps))+'\n')
-        #set x limits
-        xCyclesMin = max(0,i-60*self.wScale.get())
-        if self.wScale.get() == 1440: xCyclesMin = 0
-        xMin = self.timeStamps[xCyclesMin]
-        #change data to plot
-        self.stage60K.set_xdata(self.timeStamps)
-        self.stage60K.set_ydata(numpy.append(self.stage60K.get_ydata(),self.newTemps[0]))
-        self.stage03K.set_xdata(self.timeStamps)
-        self.stage03K.set_ydata(numpy.append(self.stage03K.get_ydata(),self.newTemps[1]))
-        self.stageGGG.set_xdata(self.timeStamps)
-        self.stageGGG.set_ydata(numpy.append(self.stageGGG.get_ydata(),self.newTemps[2]))
-        self.stageFAA.set_xdata(self.timeStamps)
-        self.stageFAA.set_ydata(numpy.append(self.stageFAA.get_ydata(),self.newTemps[3]))
-        #rescale axes, with the x being scaled by the slider
-        if self.toolbar._active == 'HOME' or self.toolbar._active == None:
-            ymin,ymax = 10000000, -10000000
-            lineAndVar = {self.stage60K:self.t60K, self.stage03K:self.t3K, self.stageGGG:self.tGGG, self.stageFAA:self.tFAA}
-            for line in lineAndVar.keys():
-                if lineAndVar[line].get() == 0: line.set_visible(False)
-                else:
-                    line.set_visible(True)
-                    ydata = line.get_ydata()[xCyclesMin:-1]
-                    try:
-                        ymin = min(ymin, numpy.nanmin(ydata))
-                        ymax = max(ymax, numpy.nanmax(ydata))
-                    except ValueError as e: pass
-            if len(self.timeStamps)>1: 
-                self.ax.set_xlim(xMin,self.timeStamps[-1])
-                self.ax.set_ylim(ymin - (ymax-ymin)/10, ymax + (ymax-ymin)/10)
-        self.updateLegend()
-        self.canvas.draw()
+        if self.temperatureLog is not None:
+            try:
+                #a restart in the same minute appends to the same file, whose time stamps are from its first run
+                with timing.phase('log'): self.temperatureLog.write(sample.timeStamp - self.temperatureLog.raw.startTime, logged)
+            except (IOError, OSError) as e: self.temperatureLogFailed(e)
         self.cycle += 1
-        cycleLength = int(1000*(time.time() - cycleStartTime))
-        self.after(max(0,STEP_LENGTH-cycleLength),self.measurementCycle)
-    def updateLegend(self):
-        """creates the legend at the top of the temperature plot."""
-        labelOrder = ['60K','3K ','GGG','FAA']
-        lines = [self.stage60K,self.stage03K,self.stageGGG,self.stageFAA]
-        labels = [labelOrder[l]+' ['+"{0:.3f}".format(self.newTemps[l])+'K]' for l in range(len(labelOrder))]
-        labels = [s.replace('1.#QOK','OoR') for s in labels]
-        #self.ax.legend(lines,labels,loc=0)#,bbox_to_anchor=(1.01, 1)) #legend in upper right
-        self.ax.legend(lines,labels,bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
-           ncol=4, mode="expand", borderaxespad=0.) #legend on top (if not using this, delete \n in title)
+        return sample, timeStamp, values
+    def reloadHistory(self, history):
+        """Puts the last HISTORY_RELOAD_TIME of logged temperatures from previous runs into history, so the
+        plot doesn't start out empty after a restart.  Their time stamps are negative (before this run started)."""
+        try:
+            archive = LogArchive(self.config.filePath, tMin=self.startTime - HISTORY_RELOAD_TIME, tMax=self.startTime)
+            data = archive.load(self.startTime - HISTORY_RELOAD_TIME, self.startTime, channels=history.channels)
+            archive.close()
+        except Exception as e:
+            self.log.log('Could not reload the temperature history: '+str(e)+'\n')
+            return
+        if len(data) > 0:
+            history.extend(data.t - self.startTime, data.mean.T)
+            self.log.log('Reloaded '+str(len(data))+' logged samples from previous runs.\n')
+    def openTemperatureLog(self):
+        """Opens the binary temperature log for this run, along with its 10s/1min/10min levels (see ADRArchive).
+        ADRLogFile.py can convert it to the old text format."""
+        path = os.path.join(self.config.filePath, 'temperatures'+self.dateAppend+'.bin')
+        try: self.temperatureLog = MultiResolutionWriter(path, HISTORY_CHANNELS, self.startTime, flushInterval=LOG_FLUSH_INTERVAL, syncInterval=LOG_SYNC_INTERVAL)
+        except (IOError, OSError) as e:
+            self.temperatureLog = None
+            message = 'Could not open the temperature log '+path+': '+str(e)+'. Temperatures are not being saved. Restart the program once the file can be accessed.\n'
+            self.log.log(message, alert=True)
+    def syncTemperatureLog(self):
+        """Makes sure the temperature log is on the disk.  Called at safe points, like starting or stopping
+        mag up or regulation."""
+        if self.temperatureLog is not None:
+            try: self.temperatureLog.sync()
+            except (IOError, OSError) as e: self.temperatureLogFailed(e)
+    def temperatureLogFailed(self, e):
+        """Writing the temperature log failed.  Keep running (this can happen while magging up or regulating), but
+        say so."""
+        self.temperatureLog = None
+        message = 'Could not write to the temperature log: '+str(e)+'. Temperatures are no longer being saved. Restart the program once the file can be accessed.\n'
+        self.log.log(message, alert=True)
+    def exportTiming(self):
+        """Saves the timing of the cycles, their phases and every GPIB command (see ADRTiming) to a file."""
+        path = os.path.join(self.config.filePath, 'timing'+datetime.datetime.now().strftime("_%y%m%d_%H%M%S")+'.json')
+        try:
+            timing.export(path)
+            self.log.log('Saved the timing statistics to '+path+'\n')
+        except IOError as e: self.log.log('Could not save the timing statistics: '+str(e)+'\n', alert=True)
+    def loadCheckpoint(self):
+        """Puts back the regulation temperature and RuOx channels from the last run's checkpoint, and if mag up or
+        regulation was running when the program died (not when it was closed), has poll() pick it up again."""
+        state = self.checkpoint.load()
+        if state is None: return
+        self.regulateTemperature = state.get('regulateTemperature', self.regulateTemperature)
+        self.readGGG, self.readFAA = state.get('readGGG', self.readGGG), state.get('readFAA', self.readFAA)
+        if CHECKPOINT_RESUME and state.get('control') is not None and not state.get('clean'): self.resumeState = state
+    def checkpointState(self, clean=False):
+        """What goes in the checkpoint: what is running and its control loop's state, the settings from the
+        window, the newest power supply readings (for ADRCheckpoint.checkResume), and whether the program is
+        being closed (clean), in which case nothing is picked up again."""
+        control, loopState = None, None
+        if self.controlLoop is not None:
+            control = 'magUp' if self.isMaggingUp else 'regulate'
+            loopState = self.controlLoop.state()
+        sample = self.acquisition.hub.latest if self.acquisition is not None else None
+        readings = None
+        if sample is not None and not numpy.isnan(sample.current) and not numpy.isnan(sample.voltage):
+            readings = {'time':sample.timeStamp, 'I':sample.current, 'V':sample.voltage}
+        return {'name':self.config.name, 'time':time.time(), 'control':control, 'loop':loopState, 'sample':readings, 'clean':clean,
+                'regulateTemperature':self.regulateTemperature, 'readGGG':self.readGGG, 'readFAA':self.readFAA}
+    def saveCheckpoint(self, clean=False):
+        """Saves checkpointState(clean), unless the last run's checkpoint is still to be picked up."""
+        if self.resumeState is not None: return
+        self.lastCheckpoint = time.time()
+        try: self.checkpoint.save(self.checkpointState(clean))
+        except (IOError, OSError) as e:
+            if not self.checkpointFailed:
+                message = 'Could not save the checkpoint: '+str(e)+'. If the program stops, mag up or regulation will not be picked up again when it is restarted.\n'
+                self.log.log(message, alert=True)
+            self.checkpointFailed = True
+            return
+        self.checkpointFailed = False
+    def resumeControl(self):
+        """Picks up the mag up or regulation in the last run's checkpoint again, as soon as there is a good reading
+        to check the power supply against (see ADRCheckpoint.checkResume).  Gives up after CHECKPOINT_RESUME_WAIT."""
+        state = self.resumeState
+        name = 'mag up' if state['control'] == 'magUp' else 'regulation'
+        try: sample = self.acquisition.hub.getSample(CONTROL_MAX_SAMPLE_AGE, required=CONTROL_QUANTITIES)
+        except StaleDataError as e:
+            if time.time() < self.resumeDeadline: return
+            reason = str(e).rstrip('.')
+        else: reason = checkResume(state, sample, self.controlSettings, CHECKPOINT_MAX_AGE, CHECKPOINT_INTERVAL)
+        self.resumeState = None
+        if reason is not None:
+            message = 'Not picking up the '+name+' that was running when the program stopped: '+reason+'. Start it again by hand if it is safe.\n'
+            self.log.log(message, alert=True)
+            self.saveCheckpoint()
+            return
+        self.log.log('Picking up the '+name+' that was running when the program stopped (checkpoint from %.0f s ago).\n' %(time.time() - state['time']))
+        if state['control'] == 'magUp': self.magUp(state['loop'])
+        else: self.regulate(state['loop']['T_target'], state['loop'])
     def renewPowerSupply(self):
         """This runs once a minute and checks if the power supply has since been
             turned on or off, and refreshes the instance of it."""
+        self.lastPowerSupplyCheck = time.time()
+        self.acquisition.submit(self.reconnectPowerSupply)
+    def reconnectPowerSupply(self):
+        """Run on the acquisition thread by renewPowerSupply."""
         alreadyConnected,err = self.ps.instrumentIsConnected()
-        self.ps = PowerSupply(self.log)
-        if alreadyConnected == False and self.ps.instrumentIsConnected()[0] == True:
-            self.ps.initiate()
-        self.after(60*1000, self.renewPowerSupply)
+        ps = self.newPowerSupply(self.acquisition.messageLog)
+        if alreadyConnected == False and ps.instrumentIsConnected()[0] == True:
+            ps.initiate()
+        self.ps = ps
+        self.acquisition.ps = ps
+    def newPowerSupply(self, log):
+        return PowerSupply(log, self.config.powerSupplyAddress, self.config.currentLimit)
+    def startLiveFeed(self):
+        """Publishes every sample in the shared memory file config.liveFeedFile, straight from the acquisition thread."""
+        if self.config.liveFeedFile is None: return
+        path = os.path.join(tempfile.gettempdir(), self.config.liveFeedFile)
+        try: self.liveFeed = LiveFeedWriter(path, SAMPLE_CHANNELS, LIVE_FEED_LENGTH)
+        except EnvironmentError as e: #IOError, OSError or mmap.error
+            self.log.log('Could not start the live feed '+path+': '+str(e)+'\n', alert=True)
+            return
+        if self.liveFeed.path != path:
+            self.log.log('The live feed is in '+self.liveFeed.path+' this time, since a reader still has '+path+' open.\n', alert=True)
+        self.acquisition.addListener(self.liveFeed.sampleReady)
     def executeExternalCommands(self):
-        """Commands:
-                ['magup'] - mags up to 9A
-                ['magdown'] - mags all the way down, with temp goal of 0
-                ['regulate'] - regulates at the temp already entered
-                ['regulate',0.15] - regulates at 150mK
-                ['gettemp'] - returns the temperature of the cold stage
-        """
-        address = ('localhost', 6000)     # family is deduced to be 'AF_INET'
-        #listener = Listener(address, authkey='secret password')
-        #conn = listener.accept()
-        #print 'connection accepted from', listener.last_accepted
-        """while True:
-            msg = conn.recv()
-            # do something with msg
-            if msg == 'close':
-                conn.close()
-                break
-        listener.close()"""
-    def magUp(self):
+        """Starts the remote control server on config.remoteAddress.  Commands (one per line, see ADRRemote):
+                magup - mags up to 9A
+                magdown - mags all the way down, with temp goal of 0
+                regulate - regulates at the temp already entered
+                regulate 0.15 - regulates at 150mK
+                stop - stops magging up or regulating
+                gettemp - returns the temperatures
+                subscribe - sends every new reading as soon as it is made
+        The ones that start or stop mag up or regulation are run by runRemoteCommands."""
+        self.remote = None
+        if self.config.remoteAddress is None: return
+        try: self.remote = RemoteServer(self.acquisition.hub, self.config.remoteAddress)
+        except socket.error as e:
+            self.log.log('Could not start remote control on '+str(self.config.remoteAddress)+': '+str(e)+'\n', alert=True)
+            return
+        self.acquisition.addListener(self.remote.sampleReady)
+        self.remote.start()
+    def runRemoteCommands(self):
+        """Runs the remote commands that start or stop mag up or regulation, and replies to them."""
+        if self.remote is None: return
+        for request in self.remote.getRequests():
+            self.log.log('Remote command from '+request.client.address[0]+': '+' '.join([request.command]+[str(a) for a in request.args])+'\n')
+            if request.command == 'stop':
+                if self.controlLoop is None: request.reply(False, 'Not magging up or regulating')
+                else:
+                    self.stopControl()
+                    request.reply()
+                continue
+            if self.controlLoop is not None:
+                request.reply(False, self.controlLoop.name+' is already running')
+                continue
+            if request.command == 'magup': error = self.magUp()
+            elif request.command == 'magdown': error = self.regulate(0.)
+            else: error = self.regulate(*request.args)
+            if error is None: request.reply()
+            else: request.reply(False, error.strip())
+    def magUp(self, loopState=None):
          """ The magging up method, as per the HPD Manual, involves increasing the voltage in steps of MAG_UP_dV volts
          every cycle of the loop.  This cycle happens once every STEP_LENGTH seconds, nominally 1s (since the voltage
          monitor reads once a second).  Each cycle, the voltage across the magnet is read to get the backEMF.  If it
          is greater than the MAGNET_VOLTAGE_LIMIT, the voltage will not be raised until the next cycle for which the
-         backEMF < MAGNET_VOLTAGE_LIMIT. Called when Mag Up button is pressed. """
-         self.log.log('Beginning to mag up to '+str(CURRENT_LIMIT)+' Amps.\n')
+         backEMF < MAGNET_VOLTAGE_LIMIT. Called when Mag Up button is pressed.  The steps are run by the
+         acquisition thread right after each reading (see ADRControl.MagUpLoop), which carries on from loopState
+         if it is given (from a checkpoint).  Returns the message if it can't start. """
+         self.log.log('Beginning to mag up to '+str(self.controlSettings.currentLimit)+' Amps.\n')
          if self.ps.instrumentIsConnected()[0] == False:
              message = 'Cannot mag up: Power Supply not connected. Please turn it on and wait a minute or two.\n'
              self.log.log(message, alert=True)
-             return
+             return message
+         try: firstSample = self.acquisition.hub.getSample(CONTROL_MAX_SAMPLE_AGE, required=CONTROL_QUANTITIES)
+         except StaleDataError as e:
+             message = 'Cannot mag up: '+str(e)+'\n'
+             self.log.log(message, alert=True)
+             return message
+         planner = None
+         if MAG_UP_PLANNER:
+             planner = MagUpPlanner(MagnetModel(self.config.magnetInductance, self.config.magnetResistance, self.config.magnetDiodeDrop))
+             self.log.log('Magging up should take about %.0f minutes.\n' %(planner.timeToFull(self.controlSettings, firstSample.current, STEP_LENGTH/1000.)/60))
          self.isMaggingUp = True
-         class local:
-             _job = ''
-             lastI = self.ps.getCurrent()
-             lastTime = time.time()
-         def cancelMagUp():
-             if local._job is not None:
-                 self.after_cancel(local._job)
-                 local._job = None
-                 self.isMaggingUp = False
-             self.magUpButton.configure(text='Mag Up', command=self.magUp)
-             self.regulateButton.configure(state=Tkinter.NORMAL)
-             message = 'Magging up stopped at a current of '+str(self.ps.getCurrent())+' Amps.\n'
-             self.log.log(message)
-         def increaseV():
-             if self.isMaggingUp:
-                 startTime = time.time()
-                 I_now = self.ps.getCurrent()
-                 dI = I_now-local.lastI
-                 dt = time.time() - local.lastTime
-                 if dt == 0: dt = 0.0000000001 #to prevent divide by zero error
-                 local.lastI = I_now
-                 local.lastTime = time.time()
-                 if I_now < CURRENT_LIMIT:
-                     if self.magnetVoltageMonitor.getMagnetVoltage() < MAGNET_VOLTAGE_LIMIT and abs(dI/dt) < dIdt_MAGUP_LIMIT:
-                         newVoltage = self.ps.getVoltage() + MAG_UP_dV
-                         if newVoltage < VOLTAGE_LIMIT:
-                             self.ps.setVoltage(newVoltage)
-                         else: self.ps.setVoltage(VOLTAGE_MAX)
-                         #newCurrent = ps.getCurrent() + 0.005
-                         #ps.setCurrent(newCurrent)
-                     cycleLength = int(1000*(time.time() - startTime))
-                     local._job = self.after(max(0,STEP_LENGTH-cycleLength), increaseV)
-                 else:
-                     self.magUpButton.configure(text='Mag Up', command=self.magUp)
-                     self.regulateButton.configure(state=Tkinter.NORMAL)
-                     message = 'Finished magging up. '+str(self.ps.getCurrent())+' Amps reached.\n'
-                     self.log.log(message)
-         self.magUpButton.configure(text='Stop Magging Up', command=cancelMagUp)
-         self.regulateButton.configure(state=Tkinter.DISABLED)
-         increaseV()
-    def regulate(self):
+         self.syncTemperatureLog()
+         self.controlLoop = MagUpLoop(self.controlSettings, CONTROL_MAX_SAMPLE_AGE, self.acquisition.messageLog, firstSample, planner)
+         if loopState is not None: self.controlLoop.restore(loopState)
+         self.acquisition.startControl(self.controlLoop)
+         self.saveCheckpoint()
+         for view in self.views: view.controlChanged()
+    def regulate(self, T_target=None, loopState=None):
         """ This function is almost equivalent to the old code that Steve Sendelbach had implemented in LabVIEW.  It is
         based on a PID controller.  I also added a VOLTAGE_LIMIT case.  The basics of it is that a new voltage V+dV is
         proposed.  dV is then limited as necessary, and the new voltage is set. As with magging up, regulate runs a cycle
-        at approximately once per second. Called when regulate button is pressed. """
-        T_target = float(self.regulateTempField.get())
+        at approximately once per second. Called when regulate button is pressed.  The cycles are run by the
+        acquisition thread right after each reading (see ADRControl.RegulationLoop).  Regulates at T_target if
+        it is given, otherwise at regulateTemperature (the one entered in the window, or the last one used), and
+        carries on from loopState if it is given (from a checkpoint).  Returns the message if it can't start. """
+        if T_target is None: T_target = self.regulateTemperature
+        self.regulateTemperature = T_target
         if self.ps.instrumentIsConnected()[0] == False:
             message = 'Cannot regulate: Power Supply not connected.  Please turn it on and wait a minute or two.\n'
             self.log.log(message, alert=True)
-            return
-        message = 'Starting regulation cycle from '+str(self.ps.getCurrent())+' Amps.\n'
+            return message
+        try: firstSample = self.acquisition.hub.getSample(CONTROL_MAX_SAMPLE_AGE, required=CONTROL_QUANTITIES)
+        except StaleDataError as e:
+            message = 'Cannot regulate: '+str(e)+'\n'
+            self.log.log(message, alert=True)
+            return message
+        message = 'Starting regulation cycle from '+str(firstSample.current)+' Amps.\n'
         self.log.log(message)
         self.isRegulating = True
+        self.syncTemperatureLog()
         print 'beginning regulation'
-        print 'V\tbackEMF\tdV/dT\tdV'
-        class local:
-            _job = ''
-            lastTime = time.time()
-            lastMagnetV = 0
-            lastI = self.ps.getCurrent()
-            FAATemp = self.ruoxTempMonitor.getTemperature()
-            if FAATemp == numpy.nan: FAATemp = self.newTemps[1]
-        def cancelRegulate():
-            if local._job is not None:
-                self.after_cancel(local._job)
-                local._job = None
-            self.regulateButton.configure(text='Regulate', command=self.regulate)
-            self.magUpButton.configure(state=Tkinter.NORMAL)
-            message = 'Regulation stopped at a current of '+str(self.ps.getCurrent())+' Amps.\n'
-            self.log.log(message)
-            self.isRegulating = False
-        def oneRegCycle():
-            if self.isRegulating:
-                startTime = time.time()
-                backEMF = self.magnetVoltageMonitor.getMagnetVoltage()
-                V_now = self.ps.getVoltage()
-                I_now = self.ps.getCurrent()
-                dI = I_now - local.lastI
-                local.lastI = I_now
-                if self.ruoxTempMonitor.getChannel() == 2: local.FAATemp = self.ruoxTempMonitor.getTemperature()
-                if local.FAATemp == numpy.nan: local.FAATemp = self.newTemps[1]
-                print str(V_now)+'\t'+str(backEMF)+'\t',
-                #propose new voltage
-                dV = PID_KP*(T_target-local.FAATemp)-backEMF*PID_KD
-                dT = time.time()-local.lastTime
-                if dT == 0: dT = 0.0000000001 #to prevent divide by zero error
-                local.lastTime = time.time()
-                #hard current limit
-                if self.ps.getCurrent() > CURRENT_LIMIT:
-                    if dV>0: dV=0
-                #hard voltage limit
-                if V_now + dV > VOLTAGE_LIMIT:
-                    dV = VOLTAGE_LIMIT - V_now
-                # steady state limit
-                if dV < 0:
-                    dV = max(dV,backEMF-MAGNET_VOLTAGE_LIMIT)
-                    if dV > 0: dV = 0
-                if dV > 0:
-                    dV = min(dV, MAGNET_VOLTAGE_LIMIT-backEMF)
-                    if dV < 0: dV = 0
-                lastMagnetV = backEMF
-                # limit by hard voltage increase limit
-                if abs(dV/dT) > dVdT_LIMIT:
-                    print str(dV/dT)+'\t',
-                    dV = dVdT_LIMIT*dT*(dV/abs(dV))
-                # limit by hard current increase limit
-                if abs(dI/dT) > dIdt_REGULATE_LIMIT:
-                    dV = 0
-                # will voltage go negative?
-                runCycleAgain = True
-                if V_now+dV <= 0:
-                    self.ps.setVoltage(0)
-                    V_now = 0
-                    dV = 0
-                    runCycleAgain = False
-                print str(dV)
-                self.ps.setVoltage(V_now + dV)
-                cycleTime = int(1000*(time.time() - startTime))
-                if runCycleAgain: local._job = self.after(max(0,STEP_LENGTH-cycleTime), oneRegCycle)
-                else:
-                    self.regulateButton.configure(text='Regulate', command=self.regulate)
-                    self.magUpButton.configure(state=Tkinter.NORMAL)
-                    message = 'Regulation has completed. Mag up and try again.\n'
-                    self.log.log(message)
-        self.regulateButton.configure(text='Stop Regulating', command=cancelRegulate)
-        self.magUpButton.configure(state=Tkinter.DISABLED)
-        oneRegCycle()
-    def _quit(self):
-        """ called when the window is closed."""
-        self.quit()     # stops mainloop
-        self.destroy()  # this is necessary on Windows to prevent
-                        # Fatal Python Error: PyEval_RestoreThread: NULL tstate
+        print 'V\tbackEMF\tdV'
+        self.controlLoop = RegulationLoop(self.controlSettings, T_target, CONTROL_MAX_SAMPLE_AGE, REGULATE_MAX_FAA_AGE, self.acquisition.messageLog,
+                                          firstSample, REGULATE_MAX_FAA_UNCERTAINTY)
+        if loopState is not None: self.controlLoop.restore(loopState)
+        self.acquisition.startControl(self.controlLoop)
+        self.saveCheckpoint()
+        for view in self.views: view.controlChanged()
+    def stopControl(self):
+        """Called when the Stop Magging Up or Stop Regulating button is pressed."""
+        self.acquisition.stopControl()
+        if self.controlLoop is None: return
+        message = self.controlLoop.name+' stopped at a current of '+str(self.acquisition.hub.latest.current)+' Amps.\n'
+        self.log.log(message)
+        self.controlFinished()
+    def controlFinished(self):
+        """Tells the views once mag up or regulation has stopped or finished."""
+        self.controlLoop = None
+        self.isMaggingUp = False
+        self.isRegulating = False
+        for view in self.views: view.controlChanged()
+        self.syncTemperatureLog()
+        self.saveCheckpoint()
+    def close(self):
+        """Stops everything and closes the files."""
+        if self.closed: return
+        self.closed = True
+        #closing it on purpose stops mag up or regulation: only a crash leaves them to be picked up again
+        self.resumeState = None
+        if self.acquisition is not None: self.saveCheckpoint(clean=True)
+        if self.acquisition is not None:
+            self.acquisition.stop()
+            self.acquisition.join(2*STEP_LENGTH/1000.)
+        if self.remote is not None: self.remote.stop()
+        if self.liveFeed is not None:
+            #the acquisition thread may not have stopped yet
+            self.acquisition.removeListener(self.liveFeed.sampleReady)
+            self.liveFeed.close()
+        if self.temperatureLog is not None: self.temperatureLog.close()
+        self.log.close()
+
+""" Several cryostats run by one process: an ADRCore for each CryostatConfig, whose acquisition threads share the
+    GPIB bus through one BusArbiter (see ADRScheduler), so their transactions take turns instead of colliding and
+    each cycle gets the bus in the order of the deadlines.  Each core logs how much of the bus each cryostat uses
+    every BUS_REPORT_INTERVAL.  The cores are polled by run() when headless, or by their windows. """
+class CryostatGroup:
+    def __init__(self, configs):
+        for setting in ('name', 'filePath', 'remoteAddress', 'liveFeedFile'):
+            values = [getattr(config, setting) for config in configs if getattr(config, setting) is not None]
+            if len(set(values)) < len(values): raise ValueError('Each cryostat needs its own '+setting+'.')
+        self.bus = BusArbiter(period=STEP_LENGTH/1000.) if len(configs) > 1 else None
+        self.cores = [ADRCore(config, self.bus) for config in configs]
+    def start(self):
+        for core in self.cores: core.start()
+    def run(self):
+        """Runs without windows until Ctrl+C."""
+        try:
+            while True:
+                for core in self.cores: core.poll()
+                time.sleep(GUI_UPDATE_INTERVAL/1000.)
+        except KeyboardInterrupt: pass
+        finally: self.close()
+    def close(self):
+        for core in self.cores: core.close()
 
 if __name__ == "__main__":
-    """Define your instruments here.  This allows for easy exchange between different
-    devices to monitor temperature, etc.  For example, the new and old ADR's use two
-    different instruments to measure temperature: The SRS module and the Lakeview 218."""
-    try: ruoxTempMonitor = RuOxTemperatureMonitor()
-    except GPIBError as e: ruoxTempMonitor = None
-    try: diodeTempMonitor = SIM922()
-    except GPIBError as e: diodeTempMonitor = None
-    magnetVoltageMonitor = diodeTempMonitor
-    app = ADRController(None, diodeTempMonitor, ruoxTempMonitor, magnetVoltageMonitor)
-    app.title('ADR Controller')
-    app.mainloop()
+    """The ADRs to run, and the instruments each one uses, are in CRYOSTATS (see CryostatConfig).  For example, the
+    new and old ADR's use two different instruments to measure temperature: The SRS module and the Lakeview 218.
+    Run with --simulate to use simulated ADRs (see ADRSimulator.py) instead of the real instruments, and with
+    --headless to run without the windows (Tkinter and matplotlib are then never imported)."""
+    configs = [CryostatConfig(**settings) for settings in CRYOSTATS]
+    if '--simulate' in sys.argv:
+        from ADRSimulator import SimulatedBus
+        useResourceManager(SimulatedBus(configs).resourceManager)
+    group = CryostatGroup(configs)
+    if '--headless' in sys.argv:
+        group.start()
+        group.run()
+    else:
+        from ADRWindow import ADRWindow
+        apps = []
+        for core in group.cores:
+            app = ADRWindow(None, core, blit=PLOT_BLITTING, updateInterval=GUI_UPDATE_INTERVAL, timingUpdateInterval=TIMING_WINDOW_UPDATE_INTERVAL,
+                            logLines=LOG_BOX_LINES, logUpdateInterval=LOG_BOX_UPDATE_INTERVAL)
+            app.title('ADR Controller' if len(group.cores) == 1 else 'ADR Controller - '+core.config.name)
+            apps.append(app)
+        group.start()
+        #one event loop runs all the windows; closing any of them stops it
+        apps[0].mainloop()
+        group.close()
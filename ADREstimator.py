@@ -0,0 +1,96 @@
+"""
+An estimate of the FAA temperature for every cycle, not just the cycles the RuOx is read on.  The multiplexer
+is shared with the GGG and has to settle for several time constants after each switch, so the FAA readings
+come in bursts with long gaps, and regulation used to act on the last one however old it was.
+
+The salt pill's state is x = sqrt(B^2+b^2)/T (b is the pill's internal field; see ADRSimulator.SaltPill): it
+doesn't change when the field is changed adiabatically, and only drifts slowly as the heat leak warms the pill.
+The field is known every cycle from the magnet current, so T = sqrt(B^2+b^2)/x follows every change of the
+current right away.  FAAEstimator is a Kalman filter on x and its drift rate: each cycle it moves x along the
+drift (and the uncertainty grows), and each RuOx reading, turned into a measurement of x with the current field,
+corrects them.  The bridge filters its readings (with the time constant set by TCON), so a reading is
+compared with the same filter applied to the field, not with the field right now.  A reading that is far off the estimate (ex: the heat switch was closed, which the model doesn't
+know about) starts it over from that reading.  Everything is a few multiplications per cycle.
+"""
+
+import math
+
+""" The Kalman filter.  fieldPerAmp [T/A] and internalField [T] describe the magnet and the pill,
+    relativeNoise is the RuOx reading noise as a fraction of the temperature, and driftNoise and stateNoise are
+    how fast (per sqrt(s)) the drift rate and x itself change unpredictably, as fractions of x.  A reading more
+    than outlierSigmas standard deviations off starts it over.  update() is called every cycle; estimate()
+    gives (T, standard deviation) or None before the first reading. """
+class FAAEstimator:
+    def __init__(self, fieldPerAmp, internalField, relativeNoise=0.002, driftNoise=1e-7, stateNoise=1e-5, outlierSigmas=10.):
+        self.fieldPerAmp = fieldPerAmp
+        self.internalField = internalField
+        self.relativeNoise = relativeNoise
+        self.driftNoise = driftNoise
+        self.stateNoise = stateNoise
+        self.outlierSigmas = outlierSigmas
+        self.reset()
+    def reset(self):
+        self.x = None      #sqrt(B^2+b^2)/T [T/K]
+        self.drift = 0.    #dx/dt [T/K/s]
+        self.P = None      #covariance of (x, drift)
+        self.time = None
+        self.current = 0.
+        self.filteredField = None #the field through the bridge's filter
+        self.fieldTime = None
+    def field(self, current):
+        return math.sqrt((self.fieldPerAmp*current)**2 + self.internalField**2)
+    def predict(self, t):
+        """Moves the state forward to time t."""
+        dt = t - self.time
+        self.time = t
+        if dt <= 0: return
+        Pxx, Pxd, Pdd = self.P[0][0], self.P[0][1], self.P[1][1]
+        #x += drift*dt, with the drift rate doing a random walk and x a little of one
+        self.x += self.drift*dt
+        qd = (self.driftNoise*self.x)**2
+        qx = (self.stateNoise*self.x)**2
+        Pxx += 2*dt*Pxd + dt*dt*Pdd + qx*dt + qd*dt**3/3
+        Pxd += dt*Pdd + qd*dt**2/2
+        Pdd += qd*dt
+        self.P = [[Pxx, Pxd], [Pxd, Pdd]]
+    def correct(self, T):
+        """Corrects the state with a RuOx reading T at the current field."""
+        y = self.filteredField/T #the reading as a measurement of x
+        R = (y*self.relativeNoise)**2
+        Pxx, Pxd, Pdd = self.P[0][0], self.P[0][1], self.P[1][1]
+        S = Pxx + R
+        innovation = y - self.x
+        if abs(innovation) > self.outlierSigmas*math.sqrt(S):
+            self.start(self.time, T)
+            return
+        Kx, Kd = Pxx/S, Pxd/S
+        self.x += Kx*innovation
+        self.drift += Kd*innovation
+        self.P = [[(1-Kx)*Pxx, (1-Kx)*Pxd], [(1-Kx)*Pxd, Pdd - Kd*Pxd]]
+    def filterField(self, t, filterTimeConstant):
+        field = self.field(self.current)
+        if self.filteredField is None or filterTimeConstant <= 0: self.filteredField = field
+        else: self.filteredField += (field - self.filteredField)*(1 - math.exp(-(t - self.fieldTime)/filterTimeConstant))
+        self.fieldTime = t
+    def update(self, t, current, T=None, filterTimeConstant=0.):
+        """One cycle at time t (seconds, any clock) with the magnet current, and the RuOx reading T if there is a
+        new one, filtered by the bridge with filterTimeConstant.  A current or T that is NaN is ignored."""
+        if not math.isnan(current): self.current = current
+        self.filterField(t, filterTimeConstant)
+        good = T is not None and not math.isnan(T) and T > 0
+        if self.x is None:
+            if good: self.start(t, T)
+            return
+        self.predict(t)
+        if good: self.correct(T)
+    def start(self, t, T):
+        """Starts from the reading T, knowing nothing about the drift."""
+        self.x = self.filteredField/T
+        self.drift = 0.
+        self.P = [[(self.x*self.relativeNoise)**2, 0.], [0., (self.x*1e-4)**2]]
+        self.time = t
+    def estimate(self):
+        """(FAA temperature, its standard deviation) in K, or None if there hasn't been a reading yet."""
+        if self.x is None or self.x <= 0: return None
+        T = self.field(self.current)/self.x
+        return T, T*math.sqrt(max(self.P[0][0], 0.))/self.x
@@ -0,0 +1,334 @@
+"""
+History storage for the ADR Controller.  Everything that is measured once per cycle (time stamps, the four
+temperature stages, the magnet back EMF and the power supply current and voltage) is kept here in preallocated
+numpy arrays so that adding a sample does not copy the whole record like numpy.append does.  The plot asks it
+for the extremes and a min/max decimation of the window it shows every cycle, which come from an index
+(MinMaxIndex) kept alongside the data instead of from scanning the window.
+
+Run this file directly to benchmark the per-cycle cost of appending out to a week of 1Hz samples, or with
+"autoscale" to benchmark the plot's per-cycle decimation and autoscaling with and without the index.
+"""
+
+import numpy, time, sys
+
+HISTORY_CHANNELS = ['60K','3K','GGG','FAA','backEMF','I','V']
+DEFAULT_CAPACITY = 24*60*60     #one day of 1s cycles is preallocated to begin with
+INDEX_FANOUT = 4                #each level of a MinMaxIndex has a block for every this many blocks of the level below
+
+""" A NaN-aware min/max index of all the channels of a HistoryBuffer, so the extremes of any range of samples,
+    and a min/max decimation of it, can be found without scanning the samples.  Level 0 holds the min and max
+    (and the columns they are in) of every block of INDEX_FANOUT columns, level 1 of every INDEX_FANOUT level 0
+    blocks, and so on up to one block for the whole storage.  update() only recomputes the blocks columns were
+    added to since the last time, so keeping it costs O(1) per sample (amortized).  Any range is made of at
+    most 2*(INDEX_FANOUT-1) blocks per level, so extremes() is O(log n) whatever the range, and changing the
+    range (ex: with the slider) doesn't need a rescan.  Columns are storage columns of the HistoryBuffer; a
+    block is only used when the range covers all of it, so columns outside the data never count. """
+class MinMaxIndex:
+    def __init__(self, nChannels):
+        self.nChannels = nChannels
+        self.levels = []   #(mins, minColumns, maxs, maxColumns) of every level, each nChannels x blocks
+        self.capacity = 0
+        self.end = 0       #columns indexed so far
+    def reset(self):
+        """Forgets everything (ex: the data was moved), so the next update() indexes it all again."""
+        self.end = 0
+    def allocate(self, capacity):
+        if capacity == self.capacity: return
+        self.levels = []
+        nBlocks = capacity
+        while nBlocks > 1:
+            nBlocks = -(-nBlocks//INDEX_FANOUT)
+            shape = (self.nChannels, nBlocks)
+            self.levels.append( (numpy.empty(shape), numpy.zeros(shape, dtype=int), numpy.empty(shape), numpy.zeros(shape, dtype=int)) )
+        self.capacity = capacity
+        self.end = 0
+    def update(self, data, end):
+        """Indexes the columns of data (nChannels x storage columns) up to end."""
+        self.allocate(data.shape[1])
+        start = self.end if end >= self.end else 0
+        self.end = end
+        if start >= end: return
+        below, nBelow = (data, None, data, None), end #nBelow: how many columns (or blocks) of the level below have data
+        for level in self.levels:
+            j0, j1 = start//INDEX_FANOUT, -(-nBelow//INDEX_FANOUT)
+            for i, lowest in ((0, True), (2, False)):
+                extremes, columns = blockExtremes(below[i], below[i+1], j0*INDEX_FANOUT, nBelow, lowest)
+                level[i][:,j0:j1] = extremes
+                level[i+1][:,j0:j1] = columns
+            below, nBelow, start = level, j1, j0
+    def pieces(self, data, i0, i1):
+        """The blocks (and single columns at the ends) that make up columns i0 to i1, as a list of
+        (mins, minColumns, maxs, maxColumns), a row per channel."""
+        pieces = []
+        a, b = i0, i1
+        levels = [(data, None, data, None)] + self.levels
+        for n, level in enumerate(levels):
+            if a >= b: break
+            #the ends that don't make up a whole block of the level above are taken from this one
+            if n == len(levels)-1: aUp, bDown = b, b
+            else:
+                aUp = min(b, -(-a//INDEX_FANOUT)*INDEX_FANOUT)
+                bDown = max(aUp, b//INDEX_FANOUT*INDEX_FANOUT)
+            for c0, c1 in ((a, aUp), (bDown, b)):
+                if c1 <= c0: continue
+                if level[1] is None:
+                    columns = numpy.tile(numpy.arange(c0, c1), (self.nChannels,1))
+                    pieces.append( (data[:,c0:c1], columns, data[:,c0:c1], columns) )
+                else: pieces.append( tuple(x[:,c0:c1] for x in level) )
+            a, b = aUp//INDEX_FANOUT, bDown//INDEX_FANOUT
+        return pieces
+    def extremes(self, data, i0, i1):
+        """(mins, minColumns, maxs, maxColumns) of every channel over columns i0 to i1.  The min and max are NaN
+        for a channel that has no data there."""
+        pieces = self.pieces(data, i0, i1)
+        if len(pieces) == 0:
+            nan = numpy.empty( (self.nChannels,1) )
+            nan.fill(numpy.nan)
+            pieces = [(nan, numpy.zeros(nan.shape, dtype=int), nan, numpy.zeros(nan.shape, dtype=int))]
+        joined = [numpy.hstack([piece[i] for piece in pieces]) for i in range(4)]
+        n = joined[0].shape[1]
+        mins, minColumns = blockExtremes(joined[0], joined[1], 0, n, True, n)
+        maxs, maxColumns = blockExtremes(joined[2], joined[3], 0, n, False, n)
+        return mins[:,0], minColumns[:,0], maxs[:,0], maxColumns[:,0]
+    def decimate(self, data, i0, i1, nBuckets):
+        """Min/max decimation of columns i0 to i1 (like ADRPlotting.minMaxDecimate) from the index.  Returns the
+        columns to plot, a row per channel, with the min and max of every bucket in the order they happened.
+        The buckets are made of whole blocks of the biggest level that still fits in a bucket twice, plus the
+        odd columns at either end, so this is O(nBuckets + log n) however long the range is.  A bucket with no
+        data points to a NaN, so gaps stay gaps."""
+        n = i1 - i0
+        nBuckets = max(1, int(nBuckets))
+        if n <= 2*nBuckets: return numpy.tile(numpy.arange(i0, i1), (self.nChannels,1))
+        levels = [(data, None, data, None)] + self.levels
+        level, blockSize = 0, 1
+        while level+1 < len(levels) and 2*blockSize*INDEX_FANOUT <= n//nBuckets:
+            level += 1
+            blockSize *= INDEX_FANOUT
+        blocks = levels[level]
+        j0, j1 = -(-i0//blockSize), i1//blockSize
+        perBucket = -(-(j1-j0)//nBuckets)
+        minColumns, maxColumns = [], []
+        if j0*blockSize > i0:
+            mins, mn, maxs, mx = self.extremes(data, i0, j0*blockSize)
+            minColumns.append(mn[:,None])
+            maxColumns.append(mx[:,None])
+        minColumns.append( blockExtremes(blocks[0], blocks[1], j0, j1, True, perBucket)[1] )
+        maxColumns.append( blockExtremes(blocks[2], blocks[3], j0, j1, False, perBucket)[1] )
+        if i1 > j1*blockSize:
+            mins, mn, maxs, mx = self.extremes(data, j1*blockSize, i1)
+            minColumns.append(mn[:,None])
+            maxColumns.append(mx[:,None])
+        minColumns, maxColumns = numpy.hstack(minColumns), numpy.hstack(maxColumns)
+        columns = numpy.empty( (self.nChannels, 2*minColumns.shape[1]), dtype=int )
+        columns[:,0::2] = numpy.minimum(minColumns, maxColumns)
+        columns[:,1::2] = numpy.maximum(minColumns, maxColumns)
+        return columns
+
+def blockExtremes(values, columns, c0, c1, lowest, blockSize=INDEX_FANOUT):
+    """The min (or max if not lowest) of every block of blockSize columns of values[:,c0:c1], ignoring NaNs,
+    and the column it came from: columns[row, c] if columns is given, otherwise c itself.  A block that is all
+    NaN gives NaN (and its first column)."""
+    nRows, n = values.shape[0], c1 - c0
+    nBlocks = -(-n//blockSize)
+    padded = numpy.empty( (nRows, nBlocks*blockSize) )
+    padded[:,n:] = numpy.nan
+    padded[:,:n] = values[:,c0:c1]
+    padded = padded.reshape(nRows, nBlocks, blockSize)
+    isNaN = numpy.isnan(padded)
+    if lowest: k = numpy.where(isNaN, numpy.inf, padded).argmin(axis=2)
+    else: k = numpy.where(isNaN, -numpy.inf, padded).argmax(axis=2)
+    picked = c0 + numpy.arange(nBlocks)*blockSize + k
+    rows = numpy.arange(nRows)[:,None]
+    extremes = values[rows, picked]
+    if columns is not None: picked = columns[rows, picked]
+    return extremes, picked
+
+""" HistoryBuffer stores the time stamps and a fixed list of channels in a single 2D numpy array, one row per
+    channel, so every channel is contiguous in memory.  append() just writes one column, so it is O(1).  When the
+    array is full it is reallocated at twice the size (still O(1) amortized), unless maxLength is given, in which
+    case the buffer acts as a ring that keeps the newest maxLength samples: the storage is 2*maxLength long and
+    the newest samples are moved back to the front once the end is reached, so every window is still one
+    contiguous slice.  All accessors return views, not copies.  A view is only good until the next append, since
+    the storage can be reallocated or compacted underneath it.  The MinMaxIndex for extremes() and decimate()
+    is only made the first time one of them is used. """
+class HistoryBuffer:
+    def __init__(self, channels=HISTORY_CHANNELS, capacity=DEFAULT_CAPACITY, maxLength=None):
+        self.channels = list(channels)
+        self.channelIndex = dict( (name,n+1) for n,name in enumerate(self.channels) )
+        self.maxLength = maxLength
+        if maxLength is not None: capacity = 2*maxLength
+        self.data = numpy.empty( (len(self.channels)+1, max(1,capacity)) )
+        self.data.fill(numpy.nan)
+        self.start = 0
+        self.end = 0
+        self.index = None
+    def __len__(self):
+        return self.end - self.start
+    def capacity(self):
+        return self.data.shape[1]
+    def _makeRoom(self, n):
+        """Makes sure there are n free columns at the end of the storage, either by growing it or, for a ring,
+        by dropping the oldest samples and moving the rest to the front."""
+        if self.end + n <= self.data.shape[1]: return
+        length = self.end - self.start
+        if self.maxLength is None:
+            newCapacity = self.data.shape[1]
+            while newCapacity < length + n: newCapacity *= 2
+            newData = numpy.empty( (self.data.shape[0], newCapacity) )
+            newData[:,length:].fill(numpy.nan)
+            newData[:,:length] = self.data[:,self.start:self.end]
+            self.data = newData
+        else:
+            keep = max(0, min(length, self.maxLength - n))
+            if n > self.data.shape[1]: #more new samples than would ever fit, only the newest will be kept
+                self.data = numpy.empty( (self.data.shape[0], n) )
+            self.data[:,:keep] = self.data[:,self.end-keep:self.end]
+            length = keep
+            if self.index is not None: self.index.reset()
+        self.start = 0
+        self.end = length
+    def append(self, timeStamp, values):
+        """Adds one sample.  values must be in the same order as self.channels."""
+        if self.end == self.data.shape[1]: self._makeRoom(1)
+        column = self.data[:,self.end]
+        column[0] = timeStamp
+        column[1:] = values
+        self.end += 1
+        if self.maxLength is not None and self.end - self.start > self.maxLength:
+            self.start += 1
+    def extend(self, timeStamps, values):
+        """Adds many samples at once.  values is a 2D array with one row per channel (same order as
+        self.channels) and one column per time stamp."""
+        timeStamps = numpy.asarray(timeStamps, dtype=float)
+        n = len(timeStamps)
+        if n == 0: return
+        self._makeRoom(n)
+        self.data[0,self.end:self.end+n] = timeStamps
+        self.data[1:,self.end:self.end+n] = values
+        self.end += n
+        if self.maxLength is not None and self.end - self.start > self.maxLength:
+            self.start = self.end - self.maxLength
+    def clear(self):
+        self.start = 0
+        self.end = 0
+        if self.index is not None: self.index.reset()
+    def times(self):
+        """View of all the time stamps."""
+        return self.data[0,self.start:self.end]
+    def column(self, name, window=None):
+        """View of one channel.  window is an optional slice (see windowSlice) relative to the oldest sample."""
+        values = self.data[self.channelIndex[name],self.start:self.end]
+        if window is not None: return values[window]
+        return values
+    def latest(self, name=None):
+        """Newest value of a channel, or the newest time stamp if no channel name is given."""
+        if self.end == self.start: return numpy.nan
+        if name is None: return self.data[0,self.end-1]
+        return self.data[self.channelIndex[name],self.end-1]
+    def indexOfTime(self, t):
+        """Index of the first sample at or after time t.  Time stamps are always increasing, so this
+        is a binary search."""
+        return int(numpy.searchsorted(self.times(), t, side='left'))
+    def windowSlice(self, tMin, tMax=None):
+        """Slice selecting the samples with tMin <= t <= tMax.  Use it with column()."""
+        i0 = self.indexOfTime(tMin)
+        if tMax is None: i1 = len(self)
+        else: i1 = int(numpy.searchsorted(self.times(), tMax, side='right'))
+        return slice(i0, i1)
+    def lastN(self, n):
+        """Slice selecting the newest n samples."""
+        return slice(max(0, len(self)-n), len(self))
+    def extremes(self, window=None):
+        """(mins, maxs) of every channel (in the order of self.channels) over window (a slice, see windowSlice),
+        ignoring NaNs.  They come from the index, so the window isn't scanned."""
+        i0, i1 = self.storageRange(window)
+        mins, minColumns, maxs, maxColumns = self.updateIndex().extremes(self.data[1:], i0, i1)
+        return mins, maxs
+    def decimate(self, window, nBuckets):
+        """Min/max decimation of every channel over window, for plotting (see MinMaxIndex.decimate).  Returns
+        (times, values), a row per channel (in the order of self.channels)."""
+        i0, i1 = self.storageRange(window)
+        columns = self.updateIndex().decimate(self.data[1:], i0, i1, nBuckets)
+        return self.data[0][columns], self.data[1:][numpy.arange(len(self.channels))[:,None], columns]
+    def storageRange(self, window):
+        if window is None: window = slice(0, len(self))
+        i0, i1, step = window.indices(len(self))
+        return self.start+i0, self.start+max(i0,i1)
+    def updateIndex(self):
+        if self.index is None: self.index = MinMaxIndex(len(self.channels))
+        self.index.update(self.data[1:], self.end)
+        return self.index
+
+def benchmark(days=7, blockSize=3600):
+    """Appends a week of 1Hz samples and prints the average time each append takes in hour long blocks.
+    The per-cycle cost should stay flat no matter how long the record is.  numpy.append, which this replaces,
+    is timed for comparison on a shorter record since it gets slow very quickly."""
+    nSamples = int(days*24*60*60)
+    values = [300., 3., 1., 0.1, 0.01, 9., 1.7]
+    history = HistoryBuffer()
+    blockTimes = []
+    worst = 0
+    for block in range(nSamples//blockSize):
+        blockStart = time.time()
+        for n in range(block*blockSize, (block+1)*blockSize):
+            t0 = time.time()
+            history.append(n, values)
+            worst = max(worst, time.time()-t0)
+        blockTimes.append( (time.time()-blockStart)/blockSize )
+    print 'HistoryBuffer: %d samples, final capacity %d' %(len(history), history.capacity())
+    for day in range(days):
+        dayBlocks = blockTimes[day*24:(day+1)*24]
+        print '    day %d: %.2f us/append (mean over the day)' %(day+1, 1e6*sum(dayBlocks)/len(dayBlocks))
+    print '    worst single append (includes reallocations): %.2f ms' %(1000*worst)
+    #the old way, per-cycle numpy.append of the time stamps and four plotted lines
+    print 'numpy.append (old measurementCycle):'
+    timeStamps = numpy.array([])
+    lines = [numpy.array([]) for x in range(4)]
+    for n in range(4*blockSize):
+        if n % blockSize == 0: blockStart = time.time()
+        timeStamps = numpy.append(timeStamps, n)
+        for l in range(4): lines[l] = numpy.append(lines[l], values[l])
+        if n % blockSize == blockSize-1:
+            print '    hour %d: %.2f us/cycle' %(n//blockSize+1, 1e6*(time.time()-blockStart)/blockSize)
+
+def autoscaleBenchmark(lengths=(60*60, 24*60*60, 7*24*60*60), cycles=200, nBuckets=1000):
+    """Times what the plot does every cycle, append a sample and then decimate and find the y range of the four
+    temperatures over the whole record, on records of different lengths: by scanning the window (minMaxDecimate
+    and nanmin/nanmax, as before) and from the index.  The index should cost the same whatever the length."""
+    from ADRPlotting import minMaxDecimate
+    values = numpy.array([300., 3., 1., 0.1, 0.01, 9., 1.7])
+    noise = numpy.random.RandomState(0)
+    print '%-10s %18s %18s %22s' %('record', 'scan ms/cycle', 'index ms/cycle', 'index slider move ms')
+    for length in lengths:
+        data = values[:,None]*(1 + 0.01*noise.randn(len(values), length))
+        data[2,::2] = numpy.nan #the GGG isn't read half the time
+        scanHistory, indexHistory = HistoryBuffer(), HistoryBuffer()
+        for history in (scanHistory, indexHistory):
+            history.extend(numpy.arange(length), data)
+        indexHistory.extremes() #the index is built once, when the plot is first drawn
+        times = []
+        for history, indexed in ((scanHistory, False), (indexHistory, True)):
+            startTime = time.time()
+            for n in range(cycles):
+                history.append(length+n, values)
+                window = slice(0, len(history))
+                if indexed:
+                    history.decimate(window, nBuckets)
+                    history.extremes(window)
+                else:
+                    for channel in ['60K','3K','GGG','FAA']:
+                        x, y = minMaxDecimate(history.times()[window], history.column(channel, window), nBuckets)
+                        numpy.nanmin(y), numpy.nanmax(y)
+            times.append( (time.time()-startTime)/cycles )
+        #moving the slider changes the window without any new samples
+        startTime = time.time()
+        for n in range(cycles):
+            window = indexHistory.lastN( (n+1)*length//cycles )
+            indexHistory.decimate(window, nBuckets)
+            indexHistory.extremes(window)
+        sliderTime = (time.time()-startTime)/cycles
+        print '%-10s %18.2f %18.2f %22.2f' %('%.0f h' %(length/3600.), 1000*times[0], 1000*times[1], 1000*sliderTime)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'autoscale': autoscaleBenchmark()
+    else: benchmark()
@@ -0,0 +1,218 @@
+"""
+A live feed of the ADR Controller's readings for other programs on the same computer (measurement scripts,
+dashboards), through shared memory instead of tailing the temperature log.  The controller writes every sample
+into a ring of fixed size records in a memory mapped file, and any number of readers map the same file and read
+the newest sample, or every sample since the last one they read, without any system calls and without the
+controller ever waiting for them.
+
+The file is a header followed by the ring:
+    MAGIC, then <I version, header size, record size, capacity, number of channels>, <d creation time>,
+    <Q count> (how many records have been written), then the channels as JSON, padded to the header size.
+    Each record is <Q sequence> followed by a <d for every channel.
+There is only one writer.  Record n goes in slot n % capacity: its sequence is set to 2n+1 (odd: being
+written), then the values are written, then the sequence is set to 2n+2, and then the count to n+1.  A reader
+checks the sequence before and after copying a record, so a record that was being overwritten while it was
+read is thrown away instead of being returned half old and half new.  A reader that falls more than capacity
+records behind just misses the oldest ones.  If the controller is restarted it writes a new creation time
+and starts the count over, and readers start over with it (unless the capacity changed, which needs a new file
+that readers have to open again).  The stores are made in that order by one thread, which x86 processors (like
+the lab computers) keep in order for the other processes too.
+
+LiveFeedReader is the reader library.  Run this file to benchmark the writer and a reader in another process.
+"""
+
+import mmap, struct, json, os, sys, time, tempfile, threading, numpy
+
+MAGIC = 'ADRLIVE1'
+VERSION = 1
+HEADER_SIZE = 4096
+HEADER_FORMAT = struct.Struct('<8sIIIIIdQ')
+COUNT_OFFSET = HEADER_FORMAT.size - 8
+SEQUENCE_FORMAT = struct.Struct('<Q')
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'ADR_live.bin')
+SAMPLE_CHANNELS = ['time','60K','3K','GGG','FAA','backEMF','I','V','FAAEstimate','FAAUncertainty','fresh']
+
+def sampleValues(sample):
+    """The values of an ADRAcquisition.Sample in the order of SAMPLE_CHANNELS (NaN if there is no FAA estimate,
+    fresh is 1 or 0)."""
+    estimate = sample.FAAEstimate if sample.FAAEstimate is not None else (numpy.nan, numpy.nan)
+    return [sample.timeStamp] + sample.values() + list(estimate) + [float(sample.fresh)]
+
+def recordType(channels):
+    """numpy dtype of one record."""
+    return numpy.dtype([('sequence','<u8'), ('values','<f8',(len(channels),))])
+
+""" The writer (the controller).  The file is made (or remade, if it is left over from another run) with room
+    for capacity records.  If the old file can't be removed because a reader still has it open (Windows doesn't
+    allow that), the feed goes in a new file with the process id in its name instead, and path says where.
+    sampleReady can be given to AcquisitionEngine.addListener; once the writer is closed it does nothing, so a
+    sample that comes in while it is being closed doesn't write to a closed file. """
+class LiveFeedWriter:
+    def __init__(self, path=DEFAULT_PATH, channels=SAMPLE_CHANNELS, capacity=24*60*60):
+        self.path = path
+        self.channels = list(channels)
+        self.capacity = capacity
+        self.valuesFormat = struct.Struct('<%dd' %len(self.channels))
+        self.recordSize = SEQUENCE_FORMAT.size + self.valuesFormat.size
+        schema = json.dumps(self.channels)
+        if HEADER_FORMAT.size + len(schema) > HEADER_SIZE: raise ValueError('Too many channels for the live feed header.')
+        size = HEADER_SIZE + capacity*self.recordSize
+        #reuse the file if it is the right size, so readers that still have it mapped see the new run; otherwise
+        #make a new one (shrinking a file someone has mapped would crash them)
+        if os.path.exists(path) and os.path.getsize(path) == size: self.file = open(path, 'r+b')
+        else:
+            try:
+                if os.path.exists(path): os.remove(path)
+            except OSError:
+                root, extension = os.path.splitext(path)
+                self.path = path = root+'_'+str(os.getpid())+extension
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+        self.memory = mmap.mmap(self.file.fileno(), size)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.count = 0
+        #the count is zeroed before anything else changes, so a reader never believes the old records are new
+        HEADER_FORMAT.pack_into(self.memory, 0, '\0'*8, VERSION, HEADER_SIZE, self.recordSize, capacity, len(self.channels), time.time(), 0)
+        for n in range(capacity): SEQUENCE_FORMAT.pack_into(self.memory, HEADER_SIZE + n*self.recordSize, 0)
+        self.memory[HEADER_FORMAT.size:HEADER_SIZE] = schema.ljust(HEADER_SIZE - HEADER_FORMAT.size, '\0')
+        self.memory[0:8] = MAGIC
+    def write(self, values):
+        """Adds one record, values in the order of channels."""
+        n = self.count
+        offset = HEADER_SIZE + (n % self.capacity)*self.recordSize
+        SEQUENCE_FORMAT.pack_into(self.memory, offset, 2*n+1)
+        self.valuesFormat.pack_into(self.memory, offset + SEQUENCE_FORMAT.size, *values)
+        SEQUENCE_FORMAT.pack_into(self.memory, offset, 2*n+2)
+        self.count = n+1
+        SEQUENCE_FORMAT.pack_into(self.memory, COUNT_OFFSET, self.count)
+    def sampleReady(self, sample):
+        with self.lock:
+            if not self.closed: self.write(sampleValues(sample))
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.memory.close()
+            self.file.close()
+
+class LiveFeedError(Exception):
+    pass
+
+""" A reader.  count() is how many records have been written, latest() is the newest one as a dict, and
+    read(start) returns every record from number start on that is still in the ring, as numpy arrays.
+    follow() yields the records as dicts as they are written. """
+class LiveFeedReader:
+    def __init__(self, path=DEFAULT_PATH):
+        self.file = open(path, 'rb')
+        self.memory = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, headerSize, self.recordSize, self.capacity, nChannels, self.created, count = HEADER_FORMAT.unpack_from(self.memory, 0)
+        if magic != MAGIC or version != VERSION: raise LiveFeedError(path+' is not an ADR live feed (or the controller is still making it).')
+        self.headerSize = headerSize
+        schema = self.memory[HEADER_FORMAT.size:headerSize].rstrip('\0')
+        self.channels = json.loads(schema)
+        self.valuesFormat = struct.Struct('<%dd' %nChannels)
+        self.ring = numpy.frombuffer(self.memory, dtype=recordType(self.channels), count=self.capacity, offset=headerSize)
+        self.next = 0 #the next record follow() returns
+    def restarted(self):
+        """True (once) if the controller has started over since the last check."""
+        created = struct.unpack_from('<d', self.memory, COUNT_OFFSET-8)[0]
+        if created == self.created: return False
+        self.created = created
+        self.next = 0
+        return True
+    def count(self):
+        return SEQUENCE_FORMAT.unpack_from(self.memory, COUNT_OFFSET)[0]
+    def record(self, n):
+        """The values of record n, or None if it isn't in the ring (anymore)."""
+        offset = self.headerSize + (n % self.capacity)*self.recordSize
+        if SEQUENCE_FORMAT.unpack_from(self.memory, offset)[0] != 2*n+2: return None
+        values = self.valuesFormat.unpack_from(self.memory, offset + SEQUENCE_FORMAT.size)
+        if SEQUENCE_FORMAT.unpack_from(self.memory, offset)[0] != 2*n+2: return None
+        return values
+    def latest(self):
+        """The newest record as {channel: value}, or None if there isn't one yet."""
+        for attempt in range(10):
+            count = self.count()
+            if count == 0: return None
+            values = self.record(count-1)
+            if values is not None: return dict(zip(self.channels, values))
+        return None
+    def read(self, start=0):
+        """(numbers, values) of the records from number start on that are still in the ring, oldest first:
+        numbers is an array of the record numbers (a gap means records were missed) and values has a row per
+        record and a column per channel."""
+        end = self.count()
+        start = max(start, end - self.capacity)
+        if start >= end: return numpy.zeros(0, dtype=int), numpy.zeros( (0,len(self.channels)) )
+        slots = numpy.arange(start, end) % self.capacity
+        records = self.ring[slots] #a copy
+        numbers = numpy.arange(start, end)
+        #keep only the records that were complete, and still not overwritten once they were copied
+        good = (records['sequence'] == 2*numbers+2) & (self.ring['sequence'][slots] == 2*numbers+2)
+        return numbers[good], records['values'][good]
+    def follow(self, pollInterval=0.05):
+        """Yields every new record as {channel: value}, waiting for them (also sets 'number')."""
+        while True:
+            self.restarted()
+            numbers, values = self.read(self.next)
+            for number, row in zip(numbers, values):
+                record = dict(zip(self.channels, row))
+                record['number'] = number
+                yield record
+            if len(numbers) > 0: self.next = numbers[-1] + 1
+            else: time.sleep(pollInterval)
+    def close(self):
+        del self.ring
+        self.memory.close()
+        self.file.close()
+
+def readerProcess(path, duration, results):
+    """Reads everything from the feed at path for duration seconds, for the benchmark."""
+    reader = LiveFeedReader(path)
+    nextRecord, received, missed, reads = 0, 0, 0, 0
+    startTime = time.time()
+    while time.time() - startTime < duration:
+        numbers, values = reader.read(nextRecord)
+        reads += 1
+        if len(numbers) > 0:
+            missed += numbers[-1] + 1 - nextRecord - len(numbers)
+            received += len(numbers)
+            nextRecord = numbers[-1] + 1
+        latestTime = time.time()
+        reader.latest()
+        latestTime = time.time() - latestTime
+    results.put( (received, missed, reads, latestTime) )
+    reader.close()
+
+def benchmark(records=1000000, capacity=10000):
+    """Writes records as fast as possible while a reader in another process reads them all, and prints how long
+    each write takes (the cost to the acquisition thread) and how many records the reader got."""
+    import multiprocessing
+    path = os.path.join(tempfile.gettempdir(), 'ADR_live_benchmark.bin')
+    writer = LiveFeedWriter(path, SAMPLE_CHANNELS, capacity)
+    values = [time.time(), 300., 3., 1., 0.1, 0.01, 9., 1.7, 0.1, 0.0001, 1.]
+    startTime = time.time()
+    for n in range(1000): writer.write(values)
+    writeTime = (time.time() - startTime)/1000
+    duration = 1.5*records*writeTime
+    results = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=readerProcess, args=(path, duration+0.5, results))
+    reader.start()
+    time.sleep(0.5)
+    startTime = time.time()
+    written = 0
+    while time.time() - startTime < duration:
+        for n in range(1000): writer.write(values)
+        written += 1000
+    writtenTime = time.time() - startTime
+    received, missed, reads, latestTime = results.get()
+    reader.join()
+    writer.close()
+    os.remove(path)
+    print 'write: %.2f us per record on its own, %.0f records/s with a reader running' %(1e6*writeTime, written/writtenTime)
+    print 'reader: %d of %d records (%d missed when the writer lapped it) in %d reads, latest() %.1f us' %(
+          received, writer.count, missed, reads, 1e6*latestTime)
+    print 'one sample a second is %.4f%% of a core for the writer' %(100*writeTime)
+
+if __name__ == "__main__":
+    benchmark()
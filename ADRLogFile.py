@@ -0,0 +1,124 @@
+"""
+Binary temperature log files for the ADR Controller.  Each cycle is saved as one fixed size record (the time
+stamp as a double, then every channel as a float) behind a short header that says what the channels are, so
+the files are about half the size of the old text logs and can be read straight into numpy.  The file is kept
+open and records are buffered and written in blocks instead of opening and closing the file every cycle.
+
+Durability: records are written to the OS at least every flushInterval seconds (or every bufferSize bytes),
+and fsync'ed at least every syncInterval seconds, when sync() is called (ex: when mag up or regulation starts
+or stops) and when the file is closed.  So if the program crashes at most flushInterval seconds of data are
+lost, and if the computer crashes or loses power at most syncInterval seconds.  A record that was only half
+written is ignored when the file is read.
+
+Run this file with the name of a log to convert it to the old tab separated text format:
+    python ADRLogFile.py temperatures_141124_1530.bin [temperatures_141124_1530.txt]
+"""
+
+import numpy, json, struct, time, os, sys
+
+MAGIC = 'ADRLOG01'
+
+def recordType(channels):
+    """numpy dtype of one record."""
+    return numpy.dtype([('t','<f8'), ('values','<f4',(len(channels),))])
+
+""" Writes a binary log file.  If the file already exists (ex: after a restart) new records are added to the
+    end of it, as long as it has the same channels. """
+class BinaryLogWriter:
+    def __init__(self, path, channels, startTime, flushInterval=10., syncInterval=60., bufferSize=64*1024, extraHeader={}):
+        self.path = path
+        self.channels = list(channels)
+        self.startTime = startTime
+        self.flushInterval = flushInterval
+        self.syncInterval = syncInterval
+        self.bufferSize = bufferSize
+        self.recordFormat = struct.Struct('<d%df' %len(self.channels))
+        self.buffer = []
+        self.bufferedBytes = 0
+        self.lastFlush = time.time()
+        self.lastSync = time.time()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            header, offset = readHeader(path)
+            if header['channels'] != self.channels:
+                raise ValueError('%s already exists and has different channels.' %path)
+            self.startTime = header['startTime']
+            self.file = open(path, 'r+b')
+            #drop a half written record at the end, if there is one
+            size = os.path.getsize(path)
+            self.file.truncate( size - (size-offset) % self.recordFormat.size )
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, 'wb')
+            header = {'channels':self.channels, 'startTime':startTime, 'format':'<f8 time, <f4 channels'}
+            header.update(extraHeader)
+            headerString = json.dumps(header)
+            self.file.write( MAGIC + struct.pack('<I',len(headerString)) + headerString )
+            self.sync()
+    def write(self, timeStamp, values):
+        """Adds one record.  timeStamp is in seconds since startTime, values is in the order of channels."""
+        self.buffer.append( self.recordFormat.pack(timeStamp, *values) )
+        self.bufferedBytes += self.recordFormat.size
+        now = time.time()
+        if self.bufferedBytes >= self.bufferSize or now - self.lastFlush >= self.flushInterval:
+            self.flush()
+    def flush(self):
+        """Writes the buffered records to the file (the OS may still hold them in memory)."""
+        if len(self.buffer) > 0:
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self.bufferedBytes = 0
+            self.file.write(data)
+        self.file.flush()
+        self.lastFlush = time.time()
+        if self.lastFlush - self.lastSync >= self.syncInterval:
+            self.sync()
+    def sync(self):
+        """Makes sure everything written so far is on the disk."""
+        if len(self.buffer) > 0: self.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.lastSync = time.time()
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+def readHeader(path):
+    """Returns (header dict, offset of the first record) of a binary log file."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC: raise ValueError('%s is not an ADR log file.' %path)
+        headerLength, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(headerLength))
+    header['channels'] = [str(c) for c in header['channels']]
+    return header, len(MAGIC)+4+headerLength
+
+def readLog(path, memoryMap=False):
+    """Reads a binary log file.  Returns (header, records), where records['t'] are the time stamps and
+    records['values'] is a 2D array with one column per channel.  With memoryMap=True the records are
+    memory mapped instead of read, so only the parts that are used are loaded from the disk."""
+    header, offset = readHeader(path)
+    dtype = recordType(header['channels'])
+    nRecords = (os.path.getsize(path) - offset) // dtype.itemsize
+    if nRecords == 0: return header, numpy.zeros(0, dtype=dtype)
+    if memoryMap: records = numpy.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(nRecords,))
+    else:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            records = numpy.fromfile(f, dtype=dtype, count=nRecords)
+    return header, records
+
+def convertToTSV(path, tsvPath=None, channels=('60K','3K','GGG','FAA')):
+    """Writes a binary log as the tab separated text the ADR Controller used to write: the time stamp and then
+    the 60K, 3K, GGG and FAA temperatures on each line."""
+    if tsvPath is None: tsvPath = os.path.splitext(path)[0]+'.txt'
+    header, records = readLog(path)
+    columns = [header['channels'].index(c) for c in channels]
+    with open(tsvPath, 'w') as f:
+        for record in records:
+            values = record['values']
+            f.write(str(record['t']) + '\t' + '\t'.join(str(values[c]) for c in columns)+'\n')
+    return tsvPath
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2: print __doc__
+    else: print 'Wrote', convertToTSV(*sys.argv[1:3])
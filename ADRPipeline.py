@@ -0,0 +1,116 @@
+"""
+Pipelined GPIB transactions.  Each instrument only answers one query at a time, but different instruments can
+all be working at once: a query can be written to the power supply, and while it measures, the SIM900 can be
+asked for its readings, and then both replies read.  So a cycle takes about as long as the slowest instrument
+instead of the sum of all of them.
+
+A transaction is written as a generator that yields the steps it needs:
+    Write(instrument, command)  - writes command
+    Query(instrument, command)  - writes command; the reply is sent back into the generator by the yield
+    Call(function)              - runs function() right away (ex: something that uses the bus the old way);
+                                  what it returns is sent back
+    another transaction         - runs it like a subroutine; its result is sent back
+    Done(value)                 - the transaction is finished and its result is value
+If a step fails, the exception is raised inside the generator at the yield, so it can clean up (or not catch it).
+
+runPipelined() runs several transactions, each on a device: the transactions on the same device run one after
+the other, and transactions on different devices are interleaved so that every device has a query outstanding
+while the others are being read.  runTransaction() runs one on its own.
+"""
+
+import types
+
+class Write:
+    def __init__(self, instrument, command):
+        self.instrument = instrument
+        self.command = command
+
+class Query(Write):
+    pass
+
+class Call:
+    def __init__(self, function):
+        self.function = function
+
+class Done:
+    def __init__(self, value=None):
+        self.value = value
+
+def callSteps(function):
+    """A transaction that just calls function (so it can be put in line with the others on its device)."""
+    value = yield Call(function)
+    yield Done(value)
+
+""" The transactions of one device and how far along they are.  stack is the current transaction and the
+    subroutines it is running. """
+class DeviceQueue:
+    def __init__(self):
+        self.transactions = [] #(name, generator) waiting to run
+        self.name = None
+        self.stack = []
+        self.pending = None    #the Query whose reply hasn't been read yet
+    def advance(self, results, value=None, error=None):
+        """Runs the current transaction (and the ones after it) until a query is outstanding, putting the results
+        of the ones that finish in results.  Returns False once this device has nothing left to do."""
+        self.pending = None
+        while True:
+            if len(self.stack) == 0:
+                if len(self.transactions) == 0: return False
+                self.name, generator = self.transactions.pop(0)
+                self.stack = [generator]
+                value, error = None, None
+            try:
+                if error is not None: step = self.stack[-1].throw(error)
+                else: step = self.stack[-1].send(value)
+            except StopIteration: step = Done(None)
+            except Exception as e:
+                #not handled by this generator, pass it up to the one that called it
+                self.stack.pop()
+                value, error = None, e
+                if len(self.stack) == 0: results[self.name] = e
+                continue
+            value, error = None, None
+            if isinstance(step, types.GeneratorType):
+                self.stack.append(step)
+            elif isinstance(step, Done):
+                self.stack.pop().close()
+                value = step.value
+                if len(self.stack) == 0: results[self.name] = value
+            else:
+                try:
+                    if isinstance(step, Call): value = step.function()
+                    else:
+                        step.instrument.write(step.command)
+                        if isinstance(step, Query):
+                            self.pending = step
+                            return True
+                except Exception as e: error = e
+
+def runPipelined(transactions):
+    """Runs the transactions, a list of (name, device, generator), and returns {name: result}.  A transaction
+    that failed has the exception as its result.  device can be anything that identifies the instrument the
+    transaction talks to; transactions on the same device run in the order given."""
+    devices = []
+    byDevice = {}
+    for name, device, generator in transactions:
+        if device not in byDevice:
+            byDevice[device] = DeviceQueue()
+            devices.append(byDevice[device])
+        byDevice[device].transactions.append( (name, generator) )
+    results = {}
+    #get a query going on every device, then keep reading whichever replies are due in turn
+    waiting = [device for device in devices if device.advance(results)]
+    while len(waiting) > 0:
+        stillWaiting = []
+        for device in waiting:
+            try: reply, error = device.pending.instrument.read(), None
+            except Exception as e: reply, error = None, e
+            if device.advance(results, reply, error): stillWaiting.append(device)
+        waiting = stillWaiting
+    return results
+
+def runTransaction(generator):
+    """Runs one transaction and returns its result, raising the exception if it failed."""
+    result = runPipelined([(None, None, generator)])[None]
+    if isinstance(result, Exception): raise result
+    return result
@@ -0,0 +1,103 @@
+"""
+Helpers for drawing the ADR Controller temperature plot.  The history can be much longer than the plot is
+wide (a 1440 minute window is 86400 points per line), so the data is decimated down to about one min/max
+pair per pixel before it is handed to matplotlib, and the plot is blitted so that only the lines and the legend
+are redrawn every cycle.
+"""
+
+import numpy, time
+
+""" Reduces (x,y) to at most 2*nBuckets points.  The samples are split into nBuckets consecutive buckets and
+    the minimum and maximum of each bucket are kept, in the order they happened, so spikes and quenches still
+    show up at full height no matter how far out the plot is zoomed.  NaNs are ignored, and a bucket that is
+    all NaN stays NaN so gaps in the data (ex: a RuOx channel that was switched off) stay gaps. """
+def minMaxDecimate(x, y, nBuckets):
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    n = len(y)
+    nBuckets = max(1, int(nBuckets))
+    if n <= 2*nBuckets: return x, y
+    bucketSize = -(-n//nBuckets) #ceiling division
+    nBuckets = -(-n//bucketSize)
+    padded = numpy.empty(nBuckets*bucketSize)
+    padded[n:] = numpy.nan
+    padded[:n] = y
+    buckets = padded.reshape(nBuckets, bucketSize)
+    isNaN = numpy.isnan(buckets)
+    iMin = numpy.where(isNaN, numpy.inf, buckets).argmin(axis=1)
+    iMax = numpy.where(isNaN, -numpy.inf, buckets).argmax(axis=1)
+    rows = numpy.arange(nBuckets)
+    allNaN = isNaN.all(axis=1)
+    #keep the min and max in time order so the line is drawn the way the data went
+    first = numpy.minimum(iMin, iMax)
+    second = numpy.maximum(iMin, iMax)
+    indices = numpy.empty(2*nBuckets, dtype=int)
+    indices[0::2] = rows*bucketSize + first
+    indices[1::2] = rows*bucketSize + second
+    indices = numpy.minimum(indices, n-1)
+    xOut = x[indices]
+    yOut = y[indices].astype(float)
+    yOut[numpy.repeat(allNaN, 2)] = numpy.nan
+    return xOut, yOut
+
+""" Sticky axis limits.  Returns the current limits if the needed range still fits inside them without leaving
+    more than slack empty, otherwise the proposed limits.  Used to keep the axis limits (and so the cached
+    background) from changing every cycle as new data comes in. """
+def stickyLimits(current, needed, proposed, slack):
+    lo, hi = needed
+    curLo, curHi = current
+    if curLo <= lo and hi <= curHi and (curHi-curLo) - (hi-lo) <= slack:
+        return current
+    return proposed
+
+""" Draws the figure either the plain way (canvas.draw() every time) or, with blit=True, by caching everything
+    except the animated artists (the lines and the legend) and only redrawing those on top of the cached
+    background each cycle.  A full draw only happens when the axis limits change, the plot is resized or
+    something else (ex: the toolbar) draws the canvas.  The time taken by each update is kept so the frame
+    time can be shown in the window. """
+class PlotRenderer:
+    def __init__(self, canvas, animatedArtists, blit=True, nFrameTimes=100):
+        self.canvas = canvas
+        self.figure = canvas.figure
+        self.artists = list(animatedArtists)
+        self.blit = blit
+        self.background = None
+        self.limits = None
+        self.frameTimes = []
+        self.nFrameTimes = nFrameTimes
+        self.fullDraws = 0
+        self.blits = 0
+        if blit:
+            for artist in self.artists: artist.set_animated(True)
+            canvas.mpl_connect('draw_event', self.onDraw)
+            canvas.mpl_connect('resize_event', self.onResize)
+    def onDraw(self, event):
+        """Called after every full draw of the canvas.  Grabs the new background (which doesn't include the
+        animated artists) and then draws the animated artists on top."""
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.limits = self.axesLimits()
+        self.drawArtists()
+    def onResize(self, event):
+        self.background = None
+    def axesLimits(self):
+        return tuple( tuple(ax.get_xlim())+tuple(ax.get_ylim()) for ax in self.figure.axes )
+    def drawArtists(self):
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+    def update(self):
+        """Puts the current state of the plot on the screen, blitting if possible."""
+        startTime = time.time()
+        if not self.blit or self.background is None or self.axesLimits() != self.limits:
+            self.canvas.draw()
+            self.fullDraws += 1
+        else:
+            self.canvas.restore_region(self.background)
+            self.drawArtists()
+            self.canvas.blit(self.figure.bbox)
+            self.blits += 1
+        self.frameTimes.append(time.time() - startTime)
+        if len(self.frameTimes) > self.nFrameTimes: del self.frameTimes[0]
+    def frameTimeStats(self):
+        """Returns (mean, max) frame time in ms over the last nFrameTimes updates."""
+        if len(self.frameTimes) == 0: return (numpy.nan, numpy.nan)
+        return (1000*sum(self.frameTimes)/len(self.frameTimes), 1000*max(self.frameTimes))
@@ -0,0 +1,231 @@
+"""
+Remote control of the ADR Controller over TCP, so measurement scripts can mag up, regulate and read the
+temperatures without anyone at the window.  Each command is one line of text, and each reply is one line of
+JSON:
+    magup           - mags up to CURRENT_LIMIT
+    magdown         - mags all the way down (regulates with a temperature goal of 0)
+    regulate [T]    - regulates at T in K, or at the temperature entered in the window
+    stop            - stops magging up or regulating
+    gettemp         - the newest reading of all the temperatures, the back EMF, I and V (and the FAA estimate)
+    subscribe       - from now on, every new reading is sent as soon as it is made
+    unsubscribe     - stops sending them
+Replies are {"ok": true, ...} or {"ok": false, "error": "..."}, and the readings sent to subscribers are
+{"sample": {...}} (without "ok"), in the same format as gettemp's.  Anything that couldn't be read is null.
+
+The server runs on its own thread with select(), so any number of clients can be connected at once and a slow
+one can't hold up the others (a subscriber that falls too far behind is unsubscribed, and a client that stops
+reading its replies is disconnected).  Commands that start or stop mag up or regulation have to be run by the thread
+that polls the ADRCore (the window's, since Tkinter can only be used from its own thread, or the main thread
+when headless), so they are queued for it (see getRequests) and it replies.
+gettemp is answered from the SampleHub right away, and the readings are pushed to subscribers straight from
+the acquisition thread, so neither waits for the window.  RemoteClient is a small client for scripts.
+"""
+
+import socket, select, threading, Queue, json, math
+
+WINDOW_COMMANDS = ['magup', 'magdown', 'regulate', 'stop'] #run by the window
+MAX_LINE_LENGTH = 1024
+MAX_CLIENT_BACKLOG = 1000000 #[bytes] a subscriber that is this far behind is unsubscribed, and a client twice this far behind is disconnected
+
+def sampleDict(sample):
+    """The readings of a Sample as a dict for JSON, NaN as None."""
+    def clean(x):
+        if x is None or (isinstance(x, float) and math.isnan(x)): return None
+        return float(x)
+    values = {'time':sample.timeStamp, 'fresh':sample.fresh, 'readTimes':dict( (name, clean(t)) for name, t in sample.readTimes.items() )}
+    for name, value in zip(['60K','3K','GGG','FAA','backEMF','I','V'], sample.values()):
+        values[name] = clean(value)
+    if sample.FAAEstimate is not None:
+        values['FAAEstimate'], values['FAAUncertainty'] = [clean(x) for x in sample.FAAEstimate]
+    return values
+
+class RemoteError(Exception):
+    pass
+
+""" A command from a client for the window to run.  reply() sends the answer back (from any thread). """
+class RemoteRequest:
+    def __init__(self, server, client, command, args):
+        self.server = server
+        self.client = client
+        self.command = command
+        self.args = args
+    def reply(self, ok=True, error=None, **values):
+        self.server.reply(self.client, ok, error, **values)
+
+""" One connection, with what it has sent that isn't a whole line yet and what is waiting to be sent to it. """
+class RemoteConnection:
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.received = ''
+        self.toSend = ''
+        self.subscribed = False
+        self.dropped = False #too far behind: disconnected by the server thread once it has tried to send the error
+
+""" The server (see above).  hub is the acquisition thread's SampleHub.  Call sampleReady with every new sample
+    (AcquisitionEngine.addListener does that). """
+class RemoteServer(threading.Thread):
+    def __init__(self, hub, address=('localhost', 6000)):
+        threading.Thread.__init__(self, name='ADR remote control')
+        self.daemon = True
+        self.hub = hub
+        self.requests = Queue.Queue()
+        self.clients = {} #socket: RemoteConnection
+        self.lock = threading.Lock() #for clients and what is waiting to be sent to them
+        self.stopEvent = threading.Event()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(5)
+        self.listener.setblocking(0)
+        self.address = self.listener.getsockname()
+        #other threads wake select() up by sending a byte to this (Windows has no pipes to select on)
+        self.wakeSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.wakeSocket.bind(('127.0.0.1', 0))
+        self.wakeSocket.setblocking(0)
+        self.wakeAddress = self.wakeSocket.getsockname()
+        self.wakeSender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def stop(self):
+        self.stopEvent.set()
+        self.wake()
+    def wake(self):
+        try: self.wakeSender.sendto('x', self.wakeAddress)
+        except socket.error: pass
+    def getRequests(self):
+        """Takes all the commands waiting for the window, oldest first."""
+        requests = []
+        while True:
+            try: requests.append( self.requests.get_nowait() )
+            except Queue.Empty: return requests
+    def send(self, client, data, push=False):
+        """Queues data to be sent to client by the server thread.  Safe from any thread.  A reading pushed to a
+        subscriber (push) that is too far behind unsubscribes it instead.  A reply is never dropped: a client that
+        doesn't read them is disconnected, so it doesn't wait forever for one that was thrown away."""
+        with self.lock:
+            if client.dropped: return
+            if push and len(client.toSend) > MAX_CLIENT_BACKLOG:
+                if not client.subscribed: return
+                client.subscribed = False
+                data = json.dumps({'ok':False, 'error':'Unsubscribed: the readings were not being read fast enough'})+'\n'
+            elif len(client.toSend) > 2*MAX_CLIENT_BACKLOG:
+                #what is left of the backlog is thrown away, the line it was in the middle of ended
+                client.subscribed = False
+                client.dropped = True
+                client.toSend = '\n'+json.dumps({'ok':False, 'error':'Disconnected: the replies were not being read'})+'\n'
+                data = ''
+            client.toSend += data
+        self.wake()
+    def reply(self, client, ok=True, error=None, **values):
+        values['ok'] = ok
+        if error is not None: values['error'] = error
+        self.send(client, json.dumps(values)+'\n')
+    def sampleReady(self, sample):
+        """Sends sample to every subscriber.  Called from the acquisition thread."""
+        with self.lock: subscribers = [client for client in self.clients.values() if client.subscribed]
+        if len(subscribers) == 0: return
+        line = json.dumps({'sample':sampleDict(sample)})+'\n'
+        for client in subscribers: self.send(client, line, push=True)
+    def run(self):
+        while not self.stopEvent.is_set():
+            with self.lock:
+                dropped = [client for client in self.clients.values() if client.dropped]
+            for client in dropped:
+                self.flush(client)
+                self.disconnect(client.connection)
+            with self.lock:
+                connections = self.clients.keys()
+                writing = [s for s, client in self.clients.items() if len(client.toSend) > 0]
+            readable, writable, broken = select.select([self.listener, self.wakeSocket]+connections, writing, connections)
+            for s in broken: self.disconnect(s)
+            for s in readable:
+                if s is self.listener: self.accept()
+                elif s is self.wakeSocket:
+                    try:
+                        while True: self.wakeSocket.recv(64)
+                    except socket.error: pass
+                elif s in self.clients: self.receive(self.clients[s])
+            for s in writable:
+                if s in self.clients: self.flush(self.clients[s])
+        for s in self.clients.keys(): self.disconnect(s)
+        self.listener.close()
+        self.wakeSocket.close()
+        self.wakeSender.close()
+    def accept(self):
+        try: connection, address = self.listener.accept()
+        except socket.error: return
+        connection.setblocking(0)
+        with self.lock: self.clients[connection] = RemoteConnection(connection, address)
+    def disconnect(self, s):
+        with self.lock: client = self.clients.pop(s, None)
+        if client is not None: client.subscribed = False
+        try: s.close()
+        except socket.error: pass
+    def receive(self, client):
+        try: data = client.connection.recv(4096)
+        except socket.error: data = ''
+        if data == '':
+            self.disconnect(client.connection)
+            return
+        client.received += data
+        while '\n' in client.received:
+            line, client.received = client.received.split('\n', 1)
+            self.execute(client, line.strip())
+        if len(client.received) > MAX_LINE_LENGTH:
+            client.received = ''
+            self.reply(client, False, 'Command too long')
+    def flush(self, client):
+        with self.lock:
+            try: sent = client.connection.send(client.toSend)
+            except socket.error: sent = None
+            if sent is not None: client.toSend = client.toSend[sent:]
+        if sent is None: self.disconnect(client.connection)
+    def execute(self, client, line):
+        words = line.split()
+        if len(words) == 0: return
+        command, args = words[0].lower(), words[1:]
+        if command in WINDOW_COMMANDS:
+            if command == 'regulate' and len(args) > 0:
+                try: args = [float(args[0])]
+                except ValueError:
+                    self.reply(client, False, 'Not a temperature: '+args[0])
+                    return
+            self.requests.put( RemoteRequest(self, client, command, args) )
+        elif command == 'gettemp':
+            sample = self.hub.latest
+            if sample is None: self.reply(client, False, 'Nothing has been read yet')
+            else: self.reply(client, sample=sampleDict(sample))
+        elif command == 'subscribe':
+            client.subscribed = True
+            self.reply(client)
+        elif command == 'unsubscribe':
+            client.subscribed = False
+            self.reply(client)
+        else: self.reply(client, False, 'Unknown command '+command)
+
+""" A client for scripts: command() sends a command and returns the reply (raising RemoteError if it failed),
+    and samples() subscribes and yields the readings as they come. """
+class RemoteClient:
+    def __init__(self, address=('localhost', 6000), timeout=30.):
+        self.connection = socket.create_connection(address, timeout)
+        self.file = self.connection.makefile('r')
+    def readLine(self):
+        line = self.file.readline()
+        if line == '': raise RemoteError('The ADR Controller closed the connection')
+        return json.loads(line)
+    def command(self, command):
+        self.connection.sendall(command+'\n')
+        while True:
+            reply = self.readLine()
+            if 'ok' not in reply: continue #a reading from a subscription
+            if not reply['ok']: raise RemoteError(reply['error'])
+            return reply
+    def getTemperatures(self):
+        return self.command('gettemp')['sample']
+    def samples(self):
+        self.command('subscribe')
+        while True:
+            reply = self.readLine()
+            if 'ok' not in reply: yield reply['sample']
+    def close(self):
+        self.file.close()
+        self.connection.close()
@@ -0,0 +1,166 @@
+"""
+Cycle scheduling for the ADR Controller's acquisition thread.  Cycles are run on absolute deadlines
+(start + n*period) of a monotonic clock, so they don't drift no matter how long each one takes or how the
+system clock is changed, and a cycle that is missed is skipped instead of being run late and piling up.
+The deadlines can be shifted, which PhaseLock uses to keep the readings just after the SIM922's once a second
+update.  When several cryostats are run by one process, their acquisition threads share the GPIB bus through a
+BusArbiter, which gives it to whichever cycle is due first.
+"""
+
+import time, sys, ctypes, ctypes.util, threading, heapq, itertools
+
+def _monotonicClock():
+    """Returns a function giving seconds on a clock that never goes backwards.  Python 2 has no time.monotonic,
+    so: time.clock on Windows (QueryPerformanceCounter), clock_gettime(CLOCK_MONOTONIC) elsewhere, and
+    time.time if neither can be had."""
+    if sys.platform == 'win32': return time.clock
+    try:
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        t = timespec()
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0: return time.time()
+            return t.tv_sec + t.tv_nsec*1e-9
+        monotonic()
+        return monotonic
+    except (OSError, AttributeError, TypeError):
+        return time.time
+
+monotonic = _monotonicClock()
+
+""" Hands out the deadlines start, start+period, start+2*period, ...  next() returns the next one, except that
+    if the clock is already more than a period past it, the deadlines that were missed are skipped (and
+    counted) and the newest one that has passed is returned, so the caller runs once, right away, and is back
+    on schedule. """
+class DeadlineScheduler:
+    def __init__(self, period, clock=monotonic, start=None):
+        self.period = period
+        self.clock = clock
+        if start is None: start = clock()
+        self.deadline = start
+        self.skipped = 0
+    def next(self):
+        late = self.clock() - self.deadline
+        if late >= self.period:
+            missed = int(late//self.period)
+            self.deadline += missed*self.period
+            self.skipped += missed
+        deadline = self.deadline
+        self.deadline += self.period
+        return deadline
+    def shift(self, seconds):
+        """Moves all the coming deadlines by seconds (later if positive)."""
+        self.deadline += seconds
+
+""" Keeps the cycles of a DeadlineScheduler just after an instrument's own periodic update (the SIM922 measures
+    once a second on its own clock).  update() is told after each reading whether it was new: if it wasn't, the
+    instrument hadn't updated yet, so the deadlines move later by lateStep periods.  If it was, they creep
+    earlier by earlyStep periods, so they follow the instrument's clock and stay within about lateStep of its
+    update (at the cost of reading before the update about once every lateStep/earlyStep cycles). """
+class PhaseLock:
+    def __init__(self, scheduler, lateStep=0.1, earlyStep=0.002):
+        self.scheduler = scheduler
+        self.lateStep = lateStep
+        self.earlyStep = earlyStep
+        self.staleReadings = 0
+    def update(self, new):
+        if new: self.scheduler.shift(-self.earlyStep*self.scheduler.period)
+        else:
+            self.staleReadings += 1
+            self.scheduler.shift(self.lateStep*self.scheduler.period)
+
+""" Shares one GPIB bus between the acquisition threads of several cryostats.  Each thread holds the bus through
+    its own BusClient for one group of transactions at a time (a cycle's readings, a command, setting the
+    voltage), so the pipelined queries of one cryostat are never interleaved with another's.  When several are
+    waiting, the bus goes to the one with the earliest deadline (in the order they asked if they are the same),
+    so a cycle that is due is never held up by cycles of another cryostat that aren't, and the cryostats take
+    turns.  A cycle holds the bus for a few tens of ms, so as long as the cycles of all the cryostats together
+    take less than a period, every one of them is done within its period.  How much of the time each client held
+    the bus, how long it waited and how often it only got the bus after its deadline had gone by a whole period
+    (so the cycle was late) are kept for summary(). """
+class BusArbiter:
+    def __init__(self, clock=monotonic, period=1.0):
+        self.clock = clock
+        self.period = period
+        self.condition = threading.Condition()
+        self.holder = None
+        self.waiting = [] #heap of (deadline, ticket, client)
+        self.tickets = itertools.count()
+        self.clients = []
+        self.startTime = clock()
+    def client(self, name):
+        client = BusClient(self, name)
+        self.clients.append(client)
+        return client
+    def acquire(self, client):
+        with self.condition:
+            if self.holder is client:
+                client.depth += 1
+                return
+            waitStart = self.clock()
+            deadline = client.deadline if client.deadline is not None else waitStart
+            entry = (deadline, next(self.tickets), client)
+            heapq.heappush(self.waiting, entry)
+            while self.holder is not None or self.waiting[0] is not entry: self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.holder = client
+            client.depth = 1
+            client.heldSince = self.clock()
+            client.addWait(client.heldSince - waitStart, client.heldSince - deadline > self.period)
+    def release(self, client):
+        with self.condition:
+            client.depth -= 1
+            if client.depth > 0: return
+            client.busy += self.clock() - client.heldSince
+            self.holder = None
+            self.condition.notify_all()
+    def reset(self):
+        with self.condition:
+            self.startTime = self.clock()
+            for client in self.clients: client.clear()
+    def utilization(self):
+        """{client name: fraction of the time it held the bus} since the start (or reset)."""
+        with self.condition:
+            elapsed = max(self.clock() - self.startTime, 1e-9)
+            return dict( (client.name, client.busy/elapsed) for client in self.clients )
+    def summary(self):
+        """A text table of the bus use of every client."""
+        utilization = self.utilization()
+        lines = ['%-20s %7s %8s %10s %9s %6s' %('Bus use', '%', 'holds', 'wait ms', 'max ms', 'late')]
+        with self.condition:
+            for client in self.clients:
+                lines.append('%-20s %7.2f %8d %10.2f %9.2f %6d' %(client.name[:20], 100*utilization[client.name], client.holds,
+                             1000*client.waited/max(client.holds,1), 1000*client.maxWait, client.late))
+        lines.append('%-20s %7.2f' %('total', 100*sum(utilization.values())))
+        return '\n'.join(lines)
+
+""" One user of a BusArbiter (one cryostat's acquisition thread).  It is used like a lock (with client: ...), and
+    can be held again by the thread holding it.  deadline is the time (on the arbiter's clock) the work it is
+    waiting to do is due; None is right away. """
+class BusClient:
+    def __init__(self, arbiter, name):
+        self.arbiter = arbiter
+        self.name = name
+        self.deadline = None
+        self.depth = 0
+        self.heldSince = None
+        self.clear()
+    def clear(self):
+        self.busy = 0.
+        self.holds = 0
+        self.waited = 0.
+        self.maxWait = 0.
+        self.late = 0
+    def addWait(self, seconds, late):
+        self.holds += 1
+        self.waited += seconds
+        if seconds > self.maxWait: self.maxWait = seconds
+        if late: self.late += 1
+    def __enter__(self):
+        self.arbiter.acquire(self)
+    def __exit__(self, *exception):
+        self.arbiter.release(self)
@@ -0,0 +1,683 @@
+"""
+A simulated ADR, for running and benchmarking the ADR Controller without a cryostat.  The simulated instruments
+answer the same GPIB commands as the real ones (the SIM900 mainframe with its SIM922, SIM921 and SIM925
+modules, the 6641A power supply and the Lakeshore 218), and they sit on a simulated bus that replaces VISA (see
+ADRController.useResourceManager), so all of the real instrument classes can be used with them.
+
+Behind the instruments is a model of the magnet and the pills (ADRModel).  The magnet is an inductance L with
+a lead resistance R (and optionally the protection diode drop) in series with the power supply, so the current
+lags the voltage and the back EMF is L dI/dt.  The pills are paramagnetic salts whose entropy only depends on
+sqrt(B^2+b^2)/T (b is the internal field), so with the heat switch open the temperature follows the field, and
+a small heat leak slowly warms them.  With the heat switch closed they are tied to the 3K stage.
+
+Everything is driven by a clock.  By default it is the real time, but with a SimulationClock time only moves
+when it is told to, so hours of mag up and regulation can be run in seconds.
+
+Run this file to mag up and regulate the simulated ADR through the real instrument classes and control laws,
+or with "acquisition" to compare reading the instruments one after the other with reading them in parallel,
+with "newdata" to compare how soon each SIM922 measurement gets into a sample polling blindly, phase locked,
+and phase locked and waiting for new data, with "cryostats" to run several ADRs sharing the bus in one process,
+with "magup" to compare magging up by stepping the voltage with the ramp planner, or with "startup" to compare
+how long the controller takes to start, and how much memory it uses, with and without the window.
+"""
+
+import numpy, time, math, re, sys, os
+
+""" A clock for the simulation that only moves when told to: sleep() advances it instead of waiting.  It has
+    the same time() and sleep() as the time module, which is the clock used if none is given. """
+class SimulationClock:
+    def __init__(self, startTime=None):
+        if startTime is None: startTime = time.time()
+        self.now = float(startTime)
+    def time(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now += max(0, seconds)
+
+""" One paramagnetic salt pill.  With the high temperature entropy S = S0 - a*(B^2+b^2)/T^2, the state is kept as
+    s = (B^2+b^2)/T^2, which doesn't change when the field does unless heat flows: dQ = T dS = -a T ds.  a sets
+    the heat capacity (in J/K), heatLeak is the parasitic heat load in W and switchConductance is the heat switch
+    conductance to the bath in W/K. """
+class SaltPill:
+    def __init__(self, internalField, a, heatLeak, switchConductance, T):
+        self.internalField = internalField
+        self.a = a
+        self.heatLeak = heatLeak
+        self.switchConductance = switchConductance
+        self.s = None
+        self.T = T
+    def setField(self, B):
+        """Adiabatic change of the field."""
+        self.fieldSquared = B**2+self.internalField**2
+        if self.s is None: self.s = self.fieldSquared/self.T**2
+        self.T = math.sqrt(self.fieldSquared/self.s)
+    def heatCapacity(self):
+        return 2*self.a*self.s
+    def exchangeHeat(self, dt, bathTemperature, switchClosed):
+        if switchClosed:
+            #relax towards the bath with the time constant C/G, exactly, so long steps stay stable
+            tau = self.heatCapacity()/self.switchConductance
+            self.T += (bathTemperature-self.T)*(1-math.exp(-dt/tau))
+            self.s = self.fieldSquared/self.T**2
+        self.s = max(self.s - self.heatLeak*dt/(self.a*self.T), 1e-12)
+        self.T = math.sqrt(self.fieldSquared/self.s)
+
+""" The magnet, the power supply output and the two pills.  update() moves the model forward to the time of
+    the clock; the instruments call it before every reading or setting. """
+class ADRModel:
+    def __init__(self, clock=time, inductance=10., resistance=0.19, diodeDrop=0., fieldPerAmp=4./9,
+                 stage60K=55., stage3K=3.2, heatSwitchClosed=True):
+        self.clock = clock
+        self.inductance = inductance   #[H]
+        self.resistance = resistance   #[Ohm] leads and joints
+        self.diodeDrop = diodeDrop     #[V] external protection diode box, if there is one
+        self.fieldPerAmp = fieldPerAmp #[T/A]
+        self.stage60K = stage60K       #[K]
+        self.stage3K = stage3K         #[K]
+        self.heatSwitchClosed = heatSwitchClosed
+        self.GGG = SaltPill(internalField=0.5, a=1.0, heatLeak=50e-6, switchConductance=0.01, T=stage3K)
+        self.FAA = SaltPill(internalField=0.05, a=0.2, heatLeak=1e-6, switchConductance=0.01, T=stage3K)
+        #power supply
+        self.outputOn = False
+        self.voltageSetting = 0.
+        self.currentSetting = 0.
+        self.current = 0.
+        self.outputVoltage = 0.
+        self.backEMF = 0.
+        self.constantCurrent = False
+        self.lastUpdate = clock.time()
+        self.setField()
+    def setField(self):
+        for pill in (self.GGG, self.FAA): pill.setField(self.fieldPerAmp*self.current)
+    def update(self):
+        now = self.clock.time()
+        dt = now - self.lastUpdate
+        if dt <= 0: return
+        self.lastUpdate = now
+        #the current relaxes exponentially towards (V-Vdiode)/R with the time constant L/R
+        V = self.voltageSetting if self.outputOn else 0.
+        drive = max(V - self.diodeDrop, 0.)
+        finalCurrent = drive/self.resistance
+        decay = math.exp(-dt*self.resistance/self.inductance)
+        current = finalCurrent + (self.current-finalCurrent)*decay
+        self.constantCurrent = self.outputOn and current >= self.currentSetting
+        if self.constantCurrent: current = self.currentSetting
+        self.current = max(current, 0.)
+        if self.constantCurrent: self.outputVoltage = self.current*self.resistance + self.diodeDrop*(self.current>0)
+        else: self.outputVoltage = V
+        self.backEMF = 0. if self.constantCurrent else (drive - self.current*self.resistance)
+        if not self.outputOn: self.backEMF = -self.current*self.resistance
+        self.setField()
+        for pill in (self.GGG, self.FAA):
+            pill.exchangeHeat(dt, self.stage3K, self.heatSwitchClosed)
+    def temperatures(self):
+        """60K, 3K, GGG and FAA temperatures."""
+        self.update()
+        return [self.stage60K, self.stage3K, self.GGG.T, self.FAA.T]
+
+class SimulatedInstrumentError(Exception):
+    pass
+
+""" The part of every simulated instrument that looks like a VISA session: write(), read() and ask().  Each
+    operation takes latency seconds on the clock, like a GPIB round trip, and the reply to a query is only ready
+    queryTime seconds after it was written (the instrument is measuring), so a read before then waits.
+    Subclasses answer commands in handle(), returning the reply to a query or None. """
+class SimulatedInstrument:
+    identity = ''
+    def __init__(self, model, latency=0.):
+        self.model = model
+        self.clock = model.clock
+        self.latency = latency
+        self.queryTime = 0.
+        self.readyTime = 0.
+        self.replies = []
+        self.random = numpy.random.RandomState(0)
+    def write(self, command):
+        self.clock.sleep(self.latency)
+        command = command.strip()
+        if command == '*CLS' or command == '': return
+        if command == '*IDN?': reply = self.identity
+        else: reply = self.handle(command)
+        if reply is not None:
+            self.replies.append(reply)
+            self.readyTime = self.clock.time() + self.queryTime
+        elif command.endswith('?') or '? ' in command: raise SimulatedInstrumentError('No reply to '+command)
+    def read(self):
+        self.clock.sleep(max(0, self.readyTime - self.clock.time()) + self.latency)
+        if len(self.replies) == 0: raise SimulatedInstrumentError('Timeout: nothing to read.')
+        return self.replies.pop(0)
+    def ask(self, command):
+        self.write(command)
+        return self.read()
+    def noise(self, size):
+        return self.random.normal(0, size)
+    def handle(self, command):
+        raise SimulatedInstrumentError('Unknown command '+command)
+
+""" The SIM922 diode monitor.  Like the real one it measures once a second (every period seconds of the
+    clock, which can be set a little off to have its clock drift against the computer's): every reading in
+    between is the same.  measurementTime is when it last measured.  Channels 1 and 2 are the 60K and 3K diodes, 3 and 4 the two ends of the
+    magnet. """
+class SimulatedSIM922(SimulatedInstrument):
+    identity = 'Stanford_Research_Systems,SIM922,s/n000001,ver2.5'
+    def __init__(self, model, latency=0., period=1.):
+        SimulatedInstrument.__init__(self, model, latency)
+        self.period = period
+        self.measurementTime = None
+    def measure(self):
+        measurementTime = self.period*math.floor(self.clock.time()/self.period)
+        if measurementTime != self.measurementTime:
+            self.measurementTime = measurementTime
+            T60K, T3K, GGG, FAA = self.model.temperatures()
+            self.temperatures = [T60K+self.noise(0.05), T3K+self.noise(0.002), 0, 0]
+            magnetVoltage = self.model.backEMF + self.noise(1e-5)
+            self.voltages = [1.05+self.noise(1e-5), 1.54+self.noise(1e-5), magnetVoltage/2, -magnetVoltage/2]
+    def handle(self, command):
+        if command == 'TVAL? 0':
+            self.measure()
+            return ','.join('%+.6E' %T for T in self.temperatures)
+        if command == 'VOLT? 0':
+            self.measure()
+            return ','.join('%+.6E' %V for V in self.voltages)
+        return SimulatedInstrument.handle(self, command)
+
+""" The SIM925 multiplexer, which picks which RuOx thermometer (1 GGG, 2 FAA) the SIM921 reads. """
+class SimulatedSIM925(SimulatedInstrument):
+    identity = 'Stanford_Research_Systems,SIM925,s/n000002,ver1.2'
+    def __init__(self, model, latency=0.):
+        SimulatedInstrument.__init__(self, model, latency)
+        self.channel = 1
+        self.switchTime = self.clock.time()
+    def handle(self, command):
+        match = re.match(r'CHAN (\d)$', command)
+        if match:
+            self.channel = int(match.group(1))
+            self.switchTime = self.clock.time()
+            return None
+        if command == 'CHAN?': return str(self.channel)
+        return SimulatedInstrument.handle(self, command)
+
+""" The SIM921 AC resistance bridge, reading the RuOx thermometer picked by the multiplexer.  Its output is
+    filtered with the time constant set by TCON, so after the multiplexer switches it takes several time
+    constants to get to the new temperature.  Off the end of a calibration curve it reads a fixed value. """
+class SimulatedSIM921(SimulatedInstrument):
+    identity = 'Stanford_Research_Systems,SIM921,s/n000003,ver3.0'
+    timeConstants = {-1:0, 0:0.3, 1:1, 2:3, 3:10, 4:30, 5:100, 6:300}
+    curves = {1:(10., 20.0), 2:(4., 45.0)} #curve: (highest temperature, what it reads above that)
+    def __init__(self, model, multiplexer, latency=0.):
+        SimulatedInstrument.__init__(self, model, latency)
+        self.multiplexer = multiplexer
+        self.timeConstantCode = 2
+        self.curve = 2
+        self.filtered = None
+        self.filterTime = self.clock.time()
+    def trueTemperature(self):
+        temperatures = self.model.temperatures()
+        return temperatures[2] if self.multiplexer.channel == 1 else temperatures[3]
+    def handle(self, command):
+        if command == 'TVAL?':
+            T = self.trueTemperature()*(1+self.noise(0.001))
+            now = self.clock.time()
+            tau = self.timeConstants[self.timeConstantCode]
+            if self.filtered is None or tau == 0: self.filtered = T
+            else: self.filtered += (T-self.filtered)*(1-math.exp(-(now-self.filterTime)/tau))
+            self.filterTime = now
+            highest, outOfRange = self.curves.get(self.curve, self.curves[2])
+            if self.filtered > highest: return '%.6E' %outOfRange
+            return '%.6E' %self.filtered
+        if command == 'TCON?': return str(self.timeConstantCode)
+        match = re.match(r'TCON (-?\d)$', command)
+        if match:
+            self.timeConstantCode = int(match.group(1))
+            return None
+        match = re.match(r'CURV (\d)$', command)
+        if match:
+            self.curve = int(match.group(1))
+            #the bridge starts measuring the new channel from where the filter was
+            self.filterTime = self.clock.time()
+            return None
+        return SimulatedInstrument.handle(self, command)
+
+""" The SIM900 mainframe.  CONN connects the session through to the module in a slot until the escape string
+    is written. """
+class SimulatedSIM900(SimulatedInstrument):
+    identity = 'Stanford_Research_Systems,SIM900,s/n000000,ver3.6'
+    def __init__(self, model, modules, latency=0.):
+        SimulatedInstrument.__init__(self, model, latency)
+        self.modules = modules #slot: SimulatedInstrument
+        self.connected = None
+        self.escape = None
+    def write(self, command):
+        if self.connected is not None:
+            self.clock.sleep(self.latency)
+            if command == self.escape:
+                self.connected = None
+                return
+            self.connected.write(command)
+            if len(self.connected.replies) > 0: self.readyTime = self.clock.time() + self.queryTime
+            self.replies.extend(self.connected.replies)
+            self.connected.replies = []
+        else: SimulatedInstrument.write(self, command)
+    def handle(self, command):
+        match = re.match(r"CONN (\d),'(\w+)'$", command)
+        if match:
+            slot = int(match.group(1))
+            if slot not in self.modules: raise SimulatedInstrumentError('No module in slot '+str(slot))
+            self.connected = self.modules[slot]
+            self.escape = match.group(2)
+            return None
+        return SimulatedInstrument.handle(self, command)
+
+""" The Agilent 6641A power supply driving the magnet.  It is in constant voltage mode unless the current
+    reaches the current setting. """
+class SimulatedPowerSupply(SimulatedInstrument):
+    identity = 'HEWLETT-PACKARD,6641A,0,A.00.01'
+    def handle(self, command):
+        model = self.model
+        model.update()
+        if command == 'MEAS:CURR?':
+            #in constant current mode the current is regulated much better than it can be measured
+            if model.constantCurrent: return '%+.6E' %model.current
+            return '%+.6E' %(model.current*(1+self.noise(1e-5)))
+        if command == 'MEAS:VOLT?': return '%+.6E' %(model.outputVoltage+self.noise(1e-5))
+        if command == 'STAT:OPER:COND?':
+            if not model.outputOn: return '0'
+            return '1024' if model.constantCurrent else '256'
+        if command == '*RST':
+            model.outputOn = False
+            model.voltageSetting = 0.
+            model.currentSetting = 0.
+            return None
+        if command == 'OUTP ON' or command == 'OUTP OFF':
+            model.outputOn = command == 'OUTP ON'
+            return None
+        match = re.match(r'(VOLT|CURR) ([-+.\deE]+)$', command)
+        if match:
+            if match.group(1) == 'VOLT': model.voltageSetting = max(0, float(match.group(2)))
+            else: model.currentSetting = max(0, float(match.group(2)))
+            return None
+        return SimulatedInstrument.handle(self, command)
+
+""" The Lakeshore 218 monitor the old ADRs use for the diodes.  Inputs 7 and 8 are the 60K and 3K stages. """
+class SimulatedLakeshore(SimulatedInstrument):
+    identity = 'LSCI,MODEL218S,000000,011003'
+    def handle(self, command):
+        if command == 'KRDG? 0':
+            T60K, T3K, GGG, FAA = self.model.temperatures()
+            return ','.join('%+.3E' %T for T in [0,0,0,0,0,0,T60K+self.noise(0.05),T3K+self.noise(0.002)])
+        return SimulatedInstrument.handle(self, command)
+
+""" Stands in for visa.ResourceManager: list_resources() and get_instrument() on a dict of simulated
+    instruments by GPIB address. """
+class SimulatedResourceManager:
+    def __init__(self, instruments):
+        self.instruments = instruments
+    def list_resources(self):
+        return tuple(sorted(self.instruments))
+    def get_instrument(self, address):
+        if address not in self.instruments: raise SimulatedInstrumentError('Nothing at '+address)
+        return self.instruments[address]
+    open_resource = get_instrument
+
+""" A whole simulated ADR on its own bus: the power supply, and either the SIM900 with its modules (new ADR) or
+    the Lakeshore 218 (old ADR).  latency is the time each GPIB write or read takes, and queryTime (or
+    powerSupplyQueryTime for the power supply) how long the instruments take to answer a query, and SIM922Period
+    how often the SIM922 measures.  Pass resourceManager to ADRController.useResourceManager before creating the
+    instruments.  addresses can move the instruments to other GPIB addresses ({'powerSupply':..., 'SIM900':...,
+    'lakeshore':...}), and instruments has them all by address. """
+class SimulatedADR:
+    def __init__(self, clock=time, oldADR=False, latency=0., slots=(5,1,6), queryTime=0., powerSupplyQueryTime=None,
+                 SIM922Period=1., addresses={}, **modelParameters):
+        self.clock = clock
+        self.model = ADRModel(clock, **modelParameters)
+        self.powerSupply = SimulatedPowerSupply(self.model, latency)
+        instruments = {addresses.get('powerSupply', 'GPIB0::5::INSTR'): self.powerSupply}
+        if oldADR:
+            instruments[addresses.get('lakeshore', 'GPIB0::12::INSTR')] = SimulatedLakeshore(self.model, latency)
+        else:
+            SIM922Slot, SIM921Slot, SIM925Slot = slots
+            #the modules answer through the mainframe, which takes the GPIB time
+            multiplexer = SimulatedSIM925(self.model)
+            self.SIM922 = SimulatedSIM922(self.model, period=SIM922Period)
+            modules = {SIM922Slot: self.SIM922,
+                       SIM921Slot: SimulatedSIM921(self.model, multiplexer),
+                       SIM925Slot: multiplexer}
+            instruments[addresses.get('SIM900', 'GPIB0::2::INSTR')] = SimulatedSIM900(self.model, modules, latency)
+        for instrument in instruments.values(): instrument.queryTime = queryTime
+        if powerSupplyQueryTime is not None: self.powerSupply.queryTime = powerSupplyQueryTime
+        self.instruments = instruments
+        self.resourceManager = SimulatedResourceManager(instruments)
+
+""" A simulated ADR for each ADRController.CryostatConfig, all on one bus, with their instruments at the
+    addresses in the configs (the usual ones if they aren't given).  parameters are passed on to every
+    SimulatedADR. """
+class SimulatedBus:
+    def __init__(self, configs, clock=time, **parameters):
+        self.ADRs = []
+        instruments = {}
+        for config in configs:
+            addresses = {}
+            for instrument, address in (('powerSupply', config.powerSupplyAddress), ('SIM900', config.SIM900Address), ('lakeshore', config.lakeshoreAddress)):
+                if address is not None: addresses[instrument] = address
+            slots = (config.SIM922Slot, config.SIM921Slot, config.SIM925Slot)
+            adr = SimulatedADR(clock, oldADR=config.oldADR and not config.hasSIM900, slots=slots, addresses=addresses, **parameters)
+            for address in adr.instruments:
+                if address in instruments: raise ValueError('Two simulated instruments at '+address)
+            instruments.update(adr.instruments)
+            self.ADRs.append(adr)
+        self.resourceManager = SimulatedResourceManager(instruments)
+
+""" Prints the messages meant for the LogBox. """
+class PrintLog:
+    def log(self, message, alert=False):
+        print ('ALERT: ' if alert else '')+message.strip()
+
+def benchmark(T_target=0.1, soakTime=30*60, maxRegulationTime=24*60*60, latency=0.):
+    """Mags up the simulated ADR, waits soakTime with the heat switch closed, opens it and regulates at T_target
+    until the magnet is at zero current, all through the real instrument classes and control laws, one cycle
+    every STEP_LENGTH of simulated time.  Prints how long each part took and how well the temperature was held."""
+    import ADRController
+    from ADRController import SIM922, RuOxTemperatureMonitor, PowerSupply, STEP_LENGTH, defaultControlSettings
+    from ADRControl import magUpStep, regulationStep
+    from ADRAcquisition import RuOxScheduler
+    clock = SimulationClock()
+    adr = SimulatedADR(clock, latency=latency)
+    ADRController.useResourceManager(adr.resourceManager)
+    sim922 = SIM922()
+    ruox = RuOxTemperatureMonitor()
+    ps = PowerSupply(PrintLog())
+    ps.initiate()
+    settings = defaultControlSettings()
+    step = STEP_LENGTH/1000.
+    class cycle:
+        deadline = clock.time()
+        count = 0
+    def read():
+        """One cycle's readings, on the next cycle deadline."""
+        cycle.deadline += step
+        clock.sleep(cycle.deadline - clock.time())
+        t = clock.time()
+        temps, backEMF = sim922.getDiodeTemperaturesAndMagnetVoltage()
+        reading = (t, ps.getCurrent(), ps.getVoltage(), backEMF, ruox.getTemperature())
+        cycle.count += 1
+        return reading
+    wallStart = time.time()
+    simStart = clock.time()
+    #mag up
+    last = read()
+    while True:
+        reading = read()
+        t, I, V, backEMF, T = reading
+        dIdt = (I-last[1])/(t-last[0])
+        newVoltage, finished = magUpStep(settings, V, I, backEMF, dIdt)
+        last = reading
+        if finished: break
+        if newVoltage is not None: ps.setVoltage(newVoltage)
+    magUpTime = clock.time() - simStart
+    print 'Mag up: %.1f A reached in %.1f min (%.0f cycles)' %(I, magUpTime/60, cycle.count)
+    #soak, then open the heat switch
+    while clock.time() - simStart < magUpTime + soakTime: last = read()
+    adr.model.heatSwitchClosed = False
+    print 'Soaked %.0f min at %.3f K, heat switch opened' %(soakTime/60., last[4])
+    #regulate
+    regulationStart = clock.time()
+    temperatures = []
+    reachedTarget = None
+    while clock.time() - regulationStart < maxRegulationTime:
+        reading = read()
+        t, I, V, backEMF, T = reading
+        if T == RuOxScheduler.outOfRange['FAA']: continue #hold the voltage, like the controller does
+        newVoltage, finished = regulationStep(settings, V, I, backEMF, I-last[1], t-last[0], T, T_target)
+        last = reading
+        ps.setVoltage(newVoltage)
+        if reachedTarget is None and abs(T-T_target) < 0.005*T_target: reachedTarget = t - regulationStart
+        if reachedTarget is not None: temperatures.append(T)
+        if finished: break
+    holdTime = clock.time() - regulationStart - (reachedTarget or 0)
+    wallTime = time.time() - wallStart
+    simTime = clock.time() - simStart
+    if reachedTarget is None: print 'Regulation: never reached %.3f K' %T_target
+    else:
+        temperatures = numpy.array(temperatures)
+        print 'Regulation: reached %.3f K after %.1f min, held for %.1f h' %(T_target, reachedTarget/60, holdTime/3600)
+        print '    FAA temperature while held: %.2f mK rms from the target, %.2f mK peak' %(
+              1000*numpy.sqrt(numpy.mean((temperatures-T_target)**2)), 1000*numpy.max(numpy.abs(temperatures-T_target)))
+    print '%.1f h simulated in %.1f s (%.0fx real time, %.0f cycles, %.0f us per cycle)' %(
+          simTime/3600, wallTime, simTime/wallTime, cycle.count, 1e6*wallTime/cycle.count)
+
+def acquisitionBenchmark(cycles=300, latency=0.002, queryTime=0.01, powerSupplyQueryTime=0.05):
+    """Times AcquisitionEngine.acquire() on the simulated ADR with the queries run one after the other and
+    pipelined.  The times are simulated GPIB time, from the given latency and query times."""
+    import ADRController
+    from ADRController import SIM922, RuOxTemperatureMonitor, PowerSupply
+    from ADRAcquisition import AcquisitionEngine
+    from ADRTiming import TimingStats
+    for pipelined in (False, True):
+        clock = SimulationClock()
+        adr = SimulatedADR(clock, latency=latency, queryTime=queryTime, powerSupplyQueryTime=powerSupplyQueryTime)
+        ADRController.useResourceManager(adr.resourceManager)
+        sim922 = SIM922()
+        ps = PowerSupply(PrintLog())
+        ps.initiate()
+        engine = AcquisitionEngine(sim922, RuOxTemperatureMonitor(), sim922, ps, clock=clock.time, timing=TimingStats(),
+                                   pipelined=pipelined)
+        durations = []
+        for n in range(cycles):
+            startTime = clock.time()
+            sample = engine.acquire()
+            durations.append(clock.time() - startTime)
+            clock.sleep(1.)
+        durations = numpy.array(durations)
+        print '%-10s %.1f ms mean, %.1f ms max per cycle (last: %.3f A, %.3f K)' %(
+              'pipelined' if pipelined else 'sequential', 1000*numpy.mean(durations), 1000*numpy.max(durations),
+              sample.current, sample.temps[1])
+
+def newDataBenchmark(cycles=3600, warmUp=600, SIM922Period=1.0001, wakeUpJitter=0.005, latency=0.002, queryTime=0.01):
+    """Runs the acquisition cycles on the simulated ADR, with the SIM922's clock a little off from the
+    computer's and the cycles waking up a little late (half normal, wakeUpJitter), polling blindly every second,
+    phase locked, and phase locked and waiting for new data.  Prints how many samples were stale, how many of
+    the SIM922's measurements never made it into a sample, and how long it took from each measurement to the
+    first sample that had it (when the control loop can act on it), after warmUp cycles for the phase lock to
+    find the SIM922's update."""
+    import ADRController
+    from ADRController import SIM922, RuOxTemperatureMonitor, PowerSupply
+    from ADRAcquisition import AcquisitionEngine
+    from ADRTiming import TimingStats
+    print '%-20s %8s %9s %11s %11s %11s' %('', 'stale', 'missed', 'latency', 'p99', 'max')
+    startTime = time.time()
+    for name, phaseLock, newDataWait in (('blind', False, 0.), ('phase locked', True, 0.), ('phase locked, wait', True, 0.25)):
+        clock = SimulationClock(startTime)
+        adr = SimulatedADR(clock, latency=latency, queryTime=queryTime, SIM922Period=SIM922Period)
+        ADRController.useResourceManager(adr.resourceManager)
+        sim922 = SIM922()
+        ps = PowerSupply(PrintLog())
+        ps.initiate()
+        engine = AcquisitionEngine(sim922, RuOxTemperatureMonitor(), sim922, ps, clock=clock.time, timing=TimingStats(),
+                                   phaseLock=phaseLock, newDataWait=newDataWait, sleep=clock.sleep)
+        random = numpy.random.RandomState(1)
+        stale = 0
+        latencies = {} #measurement time: seconds to the first sample with it
+        for n in range(warmUp + cycles):
+            if n == warmUp:
+                stale = 0
+                latencies = {}
+                measuredFrom = clock.time()
+            deadline = engine.scheduler.next()
+            clock.sleep(deadline - clock.time() + abs(random.normal(0, wakeUpJitter)))
+            sample, firstReadingIsNew = engine.takeSample()
+            if engine.phaseLock is not None: engine.phaseLock.update(firstReadingIsNew)
+            if not sample.fresh: stale += 1
+            elif adr.SIM922.measurementTime not in latencies: latencies[adr.SIM922.measurementTime] = clock.time() - adr.SIM922.measurementTime
+        measurements = int(clock.time()//SIM922Period - measuredFrom//SIM922Period)
+        latencies = numpy.array(latencies.values())
+        print '%-20s %7.2f%% %9d %8.0f ms %8.0f ms %8.0f ms' %(name, 100.*stale/cycles, measurements - len(latencies),
+              1000*numpy.mean(latencies), 1000*numpy.percentile(latencies, 99), 1000*numpy.max(latencies))
+
+def magUp(settings, planner=None, maxTime=3*60*60, averageTime=10., **modelParameters):
+    """Mags the simulated ADR up through the real instrument classes, with magUpStep or the planner, one cycle
+    every STEP_LENGTH of simulated time.  Returns (time to the current limit, highest dI/dt over averageTime
+    (so the current measurement noise doesn't count), highest back EMF)."""
+    import ADRController
+    from ADRController import SIM922, PowerSupply, STEP_LENGTH
+    from ADRControl import magUpStep
+    clock = SimulationClock()
+    adr = SimulatedADR(clock, **modelParameters)
+    ADRController.useResourceManager(adr.resourceManager)
+    sim922 = SIM922()
+    ps = PowerSupply(PrintLog())
+    ps.initiate()
+    step = STEP_LENGTH/1000.
+    startTime = clock.time()
+    last = (clock.time(), ps.getCurrent())
+    readings = [last]
+    maxdIdt, maxBackEMF = 0., 0.
+    while clock.time() - startTime < maxTime:
+        clock.sleep(step)
+        temps, backEMF = sim922.getDiodeTemperaturesAndMagnetVoltage()
+        t, I, V = clock.time(), ps.getCurrent(), ps.getVoltage()
+        dIdt = (I-last[1])/(t-last[0])
+        if planner is not None: newVoltage, finished = planner.step(settings, V, I, backEMF, dIdt, t-last[0])
+        else: newVoltage, finished = magUpStep(settings, V, I, backEMF, dIdt)
+        last = (t, I)
+        readings.append(last)
+        while readings[0][0] < t - averageTime: readings.pop(0)
+        maxdIdt = max(maxdIdt, (I-readings[0][1])/(t-readings[0][0]))
+        maxBackEMF = max(maxBackEMF, backEMF)
+        if finished: return t - startTime, maxdIdt, maxBackEMF
+        if newVoltage is not None: ps.setVoltage(newVoltage)
+    return float('inf'), maxdIdt, maxBackEMF
+
+def magUpBenchmark():
+    """Compares magging up with magUpStep (raising the voltage by MAG_UP_dV and pausing) and with MagUpPlanner,
+    on magnets that are and aren't what the planner's model says."""
+    import ADRController
+    from ADRController import defaultControlSettings, MAGNET_INDUCTANCE, MAGNET_RESISTANCE, MAGNET_DIODE_DROP
+    from ADRControl import MagnetModel, MagUpPlanner
+    settings = defaultControlSettings()
+    print 'Limits: dI/dt %.2f mA/s (%.1f min to %g A), back EMF %.3f V' %(1000*settings.dIdtMagUpLimit,
+          settings.currentLimit/settings.dIdtMagUpLimit/60, settings.currentLimit, settings.magnetVoltageLimit)
+    print '%-38s %-9s %9s %14s %14s' %('Magnet', 'scheme', 'time min', 'dI/dt / limit', 'EMF / limit')
+    cases = [('as modelled', {}, settings.voltageLimit),
+             ('L twice the model', {'inductance':2*MAGNET_INDUCTANCE}, settings.voltageLimit),
+             ('L half the model', {'inductance':MAGNET_INDUCTANCE/2}, settings.voltageLimit),
+             ('L a fifth of the model', {'inductance':MAGNET_INDUCTANCE/5}, settings.voltageLimit),
+             ('L a tenth of the model', {'inductance':MAGNET_INDUCTANCE/10}, settings.voltageLimit),
+             ('R 30% over the model', {'resistance':1.3*MAGNET_RESISTANCE}, settings.voltageLimit+0.5),
+             ('diode box (not modelled), 3V limit', {'diodeDrop':0.9}, 3.)]
+    for name, parameters, voltageLimit in cases:
+        settings.voltageLimit = voltageLimit
+        modelParameters = {'inductance':MAGNET_INDUCTANCE, 'resistance':MAGNET_RESISTANCE, 'diodeDrop':MAGNET_DIODE_DROP}
+        modelParameters.update(parameters)
+        for scheme in ('stepping', 'planner'):
+            planner = None
+            if scheme == 'planner': planner = MagUpPlanner(MagnetModel(MAGNET_INDUCTANCE, MAGNET_RESISTANCE, MAGNET_DIODE_DROP))
+            t, maxdIdt, maxBackEMF = magUp(settings, planner, **modelParameters)
+            print '%-38s %-9s %9.1f %14.2f %14.2f' %(name, scheme, t/60, maxdIdt/settings.dIdtMagUpLimit,
+                                                     maxBackEMF/settings.magnetVoltageLimit)
+
+""" A view for ADRCore (see ADRController) that only notes when the first samples are shown. """
+class StartupProbe:
+    def __init__(self):
+        self.firstSampleTime = None
+    def messageLogged(self):
+        pass
+    def showSamples(self, records):
+        if self.firstSampleTime is None: self.firstSampleTime = time.time()
+    def controlChanged(self):
+        pass
+
+def peakMemory():
+    """The most memory this process has used so far in MB, or None if that can't be found out here."""
+    try: import resource
+    except ImportError: return None #Windows
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return maxRSS/1e6 #bytes
+    return maxRSS/1e3 #kB
+
+def startup(mode, launchTime):
+    """Starts the ADR Controller on the simulated ADR, headless or with the window, and prints the time from
+    launchTime (when the process was started) until it was imported and until the first sample was shown, and
+    the memory used.  Run in a fresh process by startupBenchmark."""
+    import tempfile
+    importStart = time.time()
+    import ADRController
+    if mode == 'window':
+        import ADRWindow
+    importTime = time.time()
+    importMemory = peakMemory()
+    ADRController.FILE_PATH = tempfile.mkdtemp()
+    ADRController.REMOTE_ADDRESS = ('localhost', 0)
+    ADRController.useResourceManager(SimulatedADR().resourceManager)
+    core = ADRController.ADRCore()
+    probe = StartupProbe()
+    core.addView(probe)
+    window = None
+    if mode == 'window':
+        try: window = ADRWindow.ADRWindow(None, core)
+        except ADRWindow.Tkinter.TclError as e:
+            print '%-9s imported in %5.0f ms, %5.1f MB; no window: %s' %(mode, 1000*(importTime-importStart), importMemory, str(e).split('\n')[0])
+            return
+    core.start()
+    while probe.firstSampleTime is None and time.time() - importStart < 30:
+        if window is not None: window.update()
+        else: core.poll()
+        time.sleep(0.01)
+    memory = peakMemory()
+    core.close()
+    print '%-9s %8.0f %8.0f %13.0f %12s %12s' %(mode, 1000*(importStart-launchTime), 1000*(importTime-importStart),
+          1000*(probe.firstSampleTime-launchTime), '%.1f' %importMemory if importMemory else 'n/a', '%.1f' %memory if memory else 'n/a')
+
+def startupBenchmark(runs=3):
+    """Starts the ADR Controller in a new process runs times in each mode (see startup)."""
+    import subprocess
+    print '%-9s %8s %8s %13s %12s %12s' %('mode', 'python', 'imports', 'first sample', 'MB imported', 'MB running')
+    print '%-9s %8s %8s %13s' %('', 'ms', 'ms', 'ms')
+    for mode in ('headless', 'window'):
+        for n in range(runs):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'startup', mode, repr(time.time())])
+            print output.splitlines()[-1]
+
+def cryostatsBenchmark(counts=(1, 2, 4, 8), duration=15., latency=0.002, queryTime=0.01, powerSupplyQueryTime=0.05):
+    """Runs count simulated ADRs on one bus in one process (see ADRController.CryostatGroup), all magging up, for
+    duration seconds of real time each, and prints how much of the bus they used together and the most any one
+    did, how long the longest wait for the bus was, how many cycles only got it after their whole period had
+    gone by or overran, and the control latency (from the reading to the new voltage)."""
+    import tempfile
+    import ADRController
+    from ADRTiming import timing
+    print '%-10s %8s %8s %10s %6s %9s %12s %12s' %('cryostats', 'bus %', 'max %', 'wait ms', 'late', 'overran', 'latency ms', 'p99 ms')
+    for count in counts:
+        configs = [ADRController.CryostatConfig(name='ADR %d' %(n+1), SIM900Address='GPIB0::%d::INSTR' %(2*n+1),
+                                                powerSupplyAddress='GPIB0::%d::INSTR' %(2*n+2), filePath=tempfile.mkdtemp(),
+                                                remoteAddress=None, liveFeedFile=None) for n in range(count)]
+        bus = SimulatedBus(configs, latency=latency, queryTime=queryTime, powerSupplyQueryTime=powerSupplyQueryTime)
+        ADRController.useResourceManager(bus.resourceManager)
+        group = ADRController.CryostatGroup(configs)
+        for core in group.cores: core.addView(StartupProbe()) #keeps the messages off the console
+        group.start()
+        startTime = time.time()
+        while any(core.acquisition.hub.latest is None for core in group.cores) and time.time() - startTime < 10:
+            time.sleep(0.1)
+        for core in group.cores: core.magUp()
+        clients = [core.acquisition.busLock for core in group.cores]
+        clients[0].arbiter.reset()
+        timing.reset()
+        startTime = time.time()
+        while time.time() - startTime < duration:
+            for core in group.cores: core.poll()
+            time.sleep(0.1)
+        utilization = clients[0].arbiter.utilization()
+        latencies = timing.phases['control latency']
+        print '%-10d %8.1f %8.1f %10.1f %6d %9d %12.1f %12.1f' %(count, 100*sum(utilization.values()), 100*max(utilization.values()),
+              1000*max(client.maxWait for client in clients), sum(client.late for client in clients), timing.overruns,
+              1000*latencies.mean(), 1000*latencies.percentile(99))
+        group.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'acquisition': acquisitionBenchmark()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'newdata': newDataBenchmark()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'cryostats': cryostatsBenchmark()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'magup': magUpBenchmark()
+    elif len(sys.argv) > 3 and sys.argv[1] == 'startup': startup(sys.argv[2], float(sys.argv[3]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'startup': startupBenchmark()
+    else: benchmark()
@@ -0,0 +1,169 @@
+"""
+Timing instrumentation for the ADR Controller.  Records how long every GPIB command takes (per instrument and
+per command), how long each phase of a cycle takes (acquire, log, plot, control), how late each acquisition
+cycle starts compared to its deadline (jitter) and how many cycles overran.  Everything is kept in log spaced
+histograms of fixed size, so recording is a few microseconds and the memory used doesn't grow, and it can be
+left on all the time.  The Timing window of the ADR Controller shows summary() live, and export() saves the
+full histograms as JSON.
+"""
+
+import threading, time, math, json
+
+""" Counts of durations in log spaced bins, binsPerDecade bins from minTime to maxTime seconds (anything outside
+    goes in the first or last bin), plus the exact count, total and maximum. """
+class LatencyHistogram:
+    def __init__(self, minTime=1e-5, maxTime=100., binsPerDecade=10):
+        self.logMin = math.log10(minTime)
+        self.binsPerDecade = binsPerDecade
+        self.nBins = int(round((math.log10(maxTime)-self.logMin)*binsPerDecade))
+        self.counts = [0]*self.nBins
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+    def add(self, seconds):
+        if seconds > 0: n = int((math.log10(seconds)-self.logMin)*self.binsPerDecade)
+        else: n = 0
+        self.counts[min(max(n,0),self.nBins-1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+    def edge(self, n):
+        """The lower edge of bin n in seconds."""
+        return 10**(self.logMin + float(n)/self.binsPerDecade)
+    def mean(self):
+        return self.total/self.count if self.count > 0 else float('nan')
+    def percentile(self, p):
+        """Upper edge of the bin the p'th percentile falls in (so it is at most one bin too high)."""
+        if self.count == 0: return float('nan')
+        needed = p/100.*self.count
+        cumulative = 0
+        for n, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= needed: return min(self.edge(n+1), self.max)
+        return self.max
+    def toDict(self):
+        nonEmpty = [n for n in range(self.nBins) if self.counts[n] > 0]
+        return {'count':self.count, 'mean':self.mean(), 'max':self.max, 'p50':self.percentile(50),
+                'p90':self.percentile(90), 'p99':self.percentile(99),
+                'bins':[[self.edge(n), self.edge(n+1), self.counts[n]] for n in nonEmpty]}
+
+""" All the timing statistics of one controller.  Safe to use from the acquisition thread and the GUI at the
+    same time. """
+class TimingStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+    def clear(self):
+        self.startTime = time.time()
+        self.commands = {} #(instrument, command): LatencyHistogram
+        self.phases = {}   #phase: LatencyHistogram
+        self.jitter = LatencyHistogram()
+        self.cycles = 0
+        self.overruns = 0
+        self.staleSamples = 0
+    def reset(self):
+        with self.lock: self.clear()
+    def addCommand(self, instrument, command, seconds):
+        with self.lock:
+            key = (instrument, command)
+            if key not in self.commands: self.commands[key] = LatencyHistogram()
+            self.commands[key].add(seconds)
+    def addPhase(self, phase, seconds):
+        with self.lock:
+            if phase not in self.phases: self.phases[phase] = LatencyHistogram()
+            self.phases[phase].add(seconds)
+    def addCycle(self, lateness, overran, fresh=True):
+        """An acquisition cycle started lateness seconds after its deadline, overran if it took longer than
+        the cycle period, and got a stale sample if not fresh (see ADRAcquisition.Sample)."""
+        with self.lock:
+            self.cycles += 1
+            self.jitter.add(abs(lateness))
+            if overran: self.overruns += 1
+            if not fresh: self.staleSamples += 1
+    def phase(self, name):
+        """Times a with block as the phase name."""
+        return PhaseTimer(self, name)
+    def summary(self):
+        """A text table of everything, for the Timing window."""
+        with self.lock:
+            lines = ['%d cycles, %d overran (%.2f%%), start jitter %.1f ms mean, %.1f ms p99, %.1f ms max' %(
+                     self.cycles, self.overruns, 100.*self.overruns/max(self.cycles,1), 1000*self.jitter.mean(),
+                     1000*self.jitter.percentile(99), 1000*self.jitter.max),
+                     '%d stale samples (%.2f%%)' %(self.staleSamples, 100.*self.staleSamples/max(self.cycles,1)), '',
+                     '%-28s %8s %9s %9s %9s' %('Phase', 'count', 'mean ms', 'p99 ms', 'max ms')]
+            for name in sorted(self.phases):
+                h = self.phases[name]
+                lines.append('%-28s %8d %9.2f %9.2f %9.2f' %(name, h.count, 1000*h.mean(), 1000*h.percentile(99), 1000*h.max))
+            lines += ['', '%-28s %8s %9s %9s %9s' %('Instrument / command', 'count', 'mean ms', 'p99 ms', 'max ms')]
+            for instrument, command in sorted(self.commands):
+                h = self.commands[(instrument, command)]
+                lines.append('%-28s %8d %9.2f %9.2f %9.2f' %((instrument+' '+command)[:28], h.count, 1000*h.mean(),
+                                                            1000*h.percentile(99), 1000*h.max))
+        return '\n'.join(lines)
+    def export(self, path):
+        """Saves all the histograms to path as JSON."""
+        with self.lock:
+            commands = {}
+            for (instrument, command), h in self.commands.items():
+                commands.setdefault(instrument, {})[command] = h.toDict()
+            data = {'startTime':self.startTime, 'exportTime':time.time(), 'cycles':self.cycles,
+                    'overruns':self.overruns, 'staleSamples':self.staleSamples, 'jitter':self.jitter.toDict(), 'commands':commands,
+                    'phases':dict( (name, h.toDict()) for name, h in self.phases.items() )}
+        with open(path, 'w') as f: json.dump(data, f, indent=1, sort_keys=True)
+
+class PhaseTimer:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+    def __enter__(self):
+        self.startTime = time.time()
+    def __exit__(self, *exception):
+        self.stats.addPhase(self.name, time.time() - self.startTime)
+
+def commandName(command):
+    """What a command is recorded as: queries as they are, settings without their value
+    ('VOLT 1.234000' -> 'VOLT')."""
+    command = command.strip()
+    if '?' in command: return command
+    return command.split(' ')[0]
+
+""" Wraps an instrument session (anything with write/read/ask) and records how long each command takes.  For
+    the SIM900 it follows CONN and the escape string, so commands to the modules are recorded under the slot
+    they went to.  A query that is written and read separately (see ADRPipeline) is recorded as the write and
+    then '<query> reply' for the wait for the answer. """
+class TimedSession:
+    def __init__(self, session, name, stats):
+        self.session = session
+        self.name = name
+        self.stats = stats
+        self.slot = None
+        self.escape = None
+        self.lastQuery = None
+    def instrumentName(self):
+        if self.slot is None: return self.name
+        return self.name+' slot '+self.slot
+    def write(self, command):
+        startTime = time.time()
+        try: return self.session.write(command)
+        finally:
+            self.stats.addCommand(self.instrumentName(), commandName(command), time.time() - startTime)
+            if command.startswith('CONN '):
+                self.slot, escape = command[5:].split(',', 1)
+                self.escape = escape.strip("'")
+            elif command == self.escape: self.slot = None
+            self.lastQuery = commandName(command) if '?' in command else None
+    def read(self):
+        startTime = time.time()
+        try: return self.session.read()
+        finally:
+            name = 'read' if self.lastQuery is None else self.lastQuery+' reply'
+            self.stats.addCommand(self.instrumentName(), name, time.time() - startTime)
+            self.lastQuery = None
+    def ask(self, command):
+        startTime = time.time()
+        try: return self.session.ask(command)
+        finally: self.stats.addCommand(self.instrumentName(), commandName(command), time.time() - startTime)
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+timing = TimingStats() #the one used by the ADR Controller
@@ -0,0 +1,208 @@
+"""
+Offline tuning of the regulation loop.  Instead of trying gains on the cryostat, simulateRegulation() runs the
+regulation law (ADRControl.regulationStepArrays) against the model of the magnet and the FAA pill from
+ADRSimulator, for many gains and limits at once: every combination is one element of numpy arrays, so the
+thousands of combinations of a sweep cost about as much per step as one.  sweep() splits the combinations
+between processes to use all the cores.
+
+Each combination starts like a real regulation: magged up to the current limit and soaked at the 3K stage
+temperature, with the heat switch just opened.  Every STEP_LENGTH it is read the way the instruments would
+(the SIM922 back EMF, the power supply I and V with their noise, and the RuOx bridge with its noise, filter
+and out of range reading) and the new voltage is set, until the voltage reaches 0.  RegulationMetrics measures
+each one:
+    reachTime       - when the FAA first got within band (a fraction) of the target
+    settlingTime    - when it got within band and then stayed there for settleWindow seconds
+    overshoot       - how far below the target it went (K)
+    rms, peak       - how far from the target it was from reaching it on (K)
+    holdTime        - how long it was held from reaching the target until the magnet ran out (or the simulation
+                      ended)
+Times are in seconds from the start of regulation, NaN if it never happened.  logMetrics() gives the same
+numbers for a regulation recorded in a temperature log, to compare with.
+
+Run this file to sweep KP and KD around the values at the top of ADRController.py.
+"""
+
+import numpy, time, math, multiprocessing
+from ADRControl import ControlSettings, regulationStepArrays
+from ADRSimulator import ADRModel, SimulationClock, SimulatedSIM921
+
+SETTINGS_NAMES = ['currentLimit', 'voltageLimit', 'magnetVoltageLimit', 'magUpdV', 'dIdtMagUpLimit',
+                  'dIdtRegulateLimit', 'dVdtLimit', 'KP', 'KD', 'KI']
+RESULT_NAMES = ['reachTime', 'settlingTime', 'overshoot', 'rms', 'peak', 'holdTime']
+
+""" The regulation metrics (see above) of n runs at once.  add() is given the time, the measured temperatures
+    and which runs are still regulating, every step. """
+class RegulationMetrics:
+    def __init__(self, n, T_target, band=0.01, settleWindow=300.):
+        self.T_target = T_target
+        self.band = band
+        self.settleWindow = settleWindow
+        nan = numpy.empty(n)
+        nan.fill(numpy.nan)
+        self.reachTime = nan.copy()
+        self.inBandSince = nan.copy()
+        self.settlingTime = nan.copy()
+        self.endTime = nan.copy()
+        self.overshoot = numpy.zeros(n)
+        self.sumSquares = numpy.zeros(n)
+        self.count = numpy.zeros(n)
+        self.peak = numpy.zeros(n)
+    def add(self, t, T, regulating):
+        inBand = regulating & (numpy.abs(T - self.T_target) <= self.band*self.T_target)
+        self.reachTime = numpy.where(inBand & numpy.isnan(self.reachTime), t, self.reachTime)
+        self.inBandSince = numpy.where(inBand, numpy.where(numpy.isnan(self.inBandSince), t, self.inBandSince), numpy.nan)
+        with numpy.errstate(invalid='ignore'):
+            settled = numpy.isnan(self.settlingTime) & (t - self.inBandSince >= self.settleWindow)
+        self.settlingTime = numpy.where(settled, self.inBandSince, self.settlingTime)
+        self.overshoot = numpy.where(regulating, numpy.maximum(self.overshoot, self.T_target - T), self.overshoot)
+        counting = regulating & ~numpy.isnan(self.reachTime)
+        error = numpy.where(counting, T - self.T_target, 0.)
+        self.sumSquares += error**2
+        self.count += counting
+        self.peak = numpy.maximum(self.peak, numpy.abs(error))
+    def finish(self, t, finished):
+        """The runs in finished stopped regulating at t."""
+        self.endTime = numpy.where(finished & numpy.isnan(self.endTime), t, self.endTime)
+    def results(self, startTime, endTime):
+        """{name: array} of RESULT_NAMES, with times from startTime.  Runs still regulating are held until
+        endTime."""
+        reached = ~numpy.isnan(self.reachTime)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            rms = numpy.sqrt(self.sumSquares/self.count)
+        stopped = numpy.where(numpy.isnan(self.endTime), endTime, self.endTime)
+        return {'reachTime':self.reachTime - startTime, 'settlingTime':self.settlingTime - startTime,
+                'overshoot':numpy.maximum(self.overshoot, 0.), 'rms':numpy.where(reached, rms, numpy.nan),
+                'peak':numpy.where(reached, self.peak, numpy.nan),
+                'holdTime':numpy.where(reached, stopped - self.reachTime, 0.)}
+
+def arraySettings(settings, n, **values):
+    """A ControlSettings with every setting an array of n, from values (arrays or numbers) or else settings."""
+    arrays = [numpy.zeros(n) + values.get(name, getattr(settings, name)) for name in SETTINGS_NAMES]
+    return ControlSettings(*arrays)
+
+def simulateRegulation(settings, T_target=0.1, step=1., maxTime=24*60*60, ruoxTimeConstant=3., band=0.01,
+                       settleWindow=300., noise=True, seed=0, **modelParameters):
+    """Simulates regulation at T_target for every element of settings (a ControlSettings of arrays, see
+    arraySettings), reading and setting the voltage every step seconds for at most maxTime.  modelParameters go
+    to ADRModel (ex: inductance), to see how sensitive the gains are to the magnet.  Returns {name: array} of
+    RESULT_NAMES."""
+    n = len(settings.KP)
+    model = ADRModel(SimulationClock(0), **modelParameters)
+    FAA = model.FAA
+    L, R, diodeDrop, fieldPerAmp = model.inductance, model.resistance, model.diodeDrop, model.fieldPerAmp
+    highest, outOfRange = SimulatedSIM921.curves[2]
+    random = numpy.random.RandomState(seed)
+    def noisy(size):
+        return random.normal(0, size, n) if noise else 0.
+    #magged up to the current limit (constant current) and soaked at the 3K stage temperature
+    I = numpy.minimum(settings.currentLimit, settings.voltageLimit/R)
+    V = I*R + diodeDrop*(I > 0)
+    s = ((fieldPerAmp*I)**2 + FAA.internalField**2)/model.stage3K**2
+    T = numpy.zeros(n) + model.stage3K
+    measuredT = T.copy()
+    lastI, lastTime = I.copy(), numpy.zeros(n)
+    regulating = numpy.ones(n, dtype=bool)
+    metrics = RegulationMetrics(n, T_target, band, settleWindow)
+    decay = math.exp(-step*R/L)
+    filterDecay = math.exp(-step/ruoxTimeConstant) if ruoxTimeConstant > 0 else 0.
+    t = 0.
+    while t < maxTime and regulating.any():
+        t += step
+        #the magnet and the pill over one step (like ADRModel.update)
+        drive = numpy.maximum(V - diodeDrop, 0.)
+        finalCurrent = drive/R
+        I = finalCurrent + (I - finalCurrent)*decay
+        constantCurrent = I >= settings.currentLimit
+        I = numpy.maximum(numpy.where(constantCurrent, settings.currentLimit, I), 0.)
+        outputVoltage = numpy.where(constantCurrent, I*R + diodeDrop*(I > 0), V)
+        backEMF = numpy.where(constantCurrent, 0., drive - I*R)
+        fieldSquared = (fieldPerAmp*I)**2 + FAA.internalField**2
+        T = numpy.sqrt(fieldSquared/s)
+        s = numpy.maximum(s - FAA.heatLeak*step/(FAA.a*T), 1e-12)
+        T = numpy.sqrt(fieldSquared/s)
+        #the readings (like the simulated instruments and SIM922.parseMagnetVoltage)
+        measuredBackEMF = (numpy.abs(backEMF/2 + noisy(1e-5)) + numpy.abs(-backEMF/2 + noisy(1e-5)))/2
+        measuredI = numpy.where(constantCurrent, I, I*(1 + noisy(1e-5)))
+        measuredV = outputVoltage + noisy(1e-5)
+        measuredT += (T*(1 + noisy(0.001)) - measuredT)*(1 - filterDecay)
+        readT = numpy.where(measuredT > highest, outOfRange, measuredT)
+        #the control step; the voltage is held while the RuOx is out of range, like RegulationLoop does
+        acting = regulating & (readT != outOfRange)
+        newV, finished = regulationStepArrays(settings, measuredV, measuredI, measuredBackEMF, measuredI - lastI,
+                                              t - lastTime, readT, T_target)
+        V = numpy.where(acting, newV, V)
+        lastI = numpy.where(acting, measuredI, lastI)
+        lastTime = numpy.where(acting, t, lastTime)
+        metrics.add(t, readT, regulating)
+        finished &= acting
+        metrics.finish(t, finished)
+        regulating &= ~finished
+    return metrics.results(0., t)
+
+def logMetrics(path, T_target, tStart=None, tEnd=None, band=0.01, settleWindow=300.):
+    """RegulationMetrics of the FAA temperatures between tStart and tEnd (time stamps, default: all) of a binary
+    temperature log (see ADRLogFile), taking it as one regulation that started at tStart.  Returns {name: value}
+    of RESULT_NAMES."""
+    from ADRLogFile import readLog
+    header, records = readLog(path)
+    t = records['t']
+    T = records['values'][:, header['channels'].index('FAA')].astype(float)
+    if tStart is None: tStart = t[0]
+    if tEnd is None: tEnd = t[-1]
+    inRange = (t >= tStart) & (t <= tEnd) & ~numpy.isnan(T)
+    metrics = RegulationMetrics(1, T_target, band, settleWindow)
+    regulating = numpy.ones(1, dtype=bool)
+    for timeStamp, temperature in zip(t[inRange], T[inRange]):
+        metrics.add(timeStamp, numpy.array([temperature]), regulating)
+    return dict( (name, value[0]) for name, value in metrics.results(tStart, tEnd).items() )
+
+def simulateChunk(job):
+    """Runs simulateRegulation for one chunk of a sweep, in a worker process."""
+    settings, values, options = job
+    n = len(values.values()[0])
+    return simulateRegulation(arraySettings(settings, n, **values), **options)
+
+def sweep(settings, processes=None, chunkSize=256, **options):
+    """Simulates regulation for every combination of the values given for any of the settings (ex:
+    KP=[0.5,1,2], KD=numpy.linspace(0,0.2,21)); the other settings are taken from settings.  The combinations
+    are split in chunks of chunkSize and run by processes worker processes (default: one per core).  The other
+    options go to simulateRegulation.  Returns (names, table): table is a record array with a column for each
+    swept setting and each of RESULT_NAMES, one row per combination."""
+    names = [name for name in SETTINGS_NAMES if name in options]
+    ranges = [numpy.asarray(options.pop(name), dtype=float).ravel() for name in names]
+    grid = [g.ravel() for g in numpy.meshgrid(*ranges, indexing='ij')]
+    n = len(grid[0])
+    chunks = numpy.array_split(numpy.arange(n), max(1, int(math.ceil(float(n)/chunkSize))))
+    jobs = [(settings, dict( (name, values[chunk]) for name, values in zip(names, grid) ), options) for chunk in chunks]
+    if processes == 1 or len(jobs) == 1: results = map(simulateChunk, jobs)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try: results = pool.map(simulateChunk, jobs)
+        finally: pool.close()
+    table = numpy.zeros(n, dtype=[(name, float) for name in names+RESULT_NAMES])
+    for name, values in zip(names, grid): table[name] = values
+    for name in RESULT_NAMES: table[name] = numpy.concatenate([result[name] for result in results])
+    return names, table
+
+def printBest(names, table, count=10):
+    """Prints the count combinations that held the temperature best (the lowest rms)."""
+    order = numpy.argsort(numpy.where(numpy.isnan(table['rms']), numpy.inf, table['rms']))[:count]
+    print ' '.join('%10s' %name for name in names) + '    settle min  overshoot mK    rms mK   peak mK    hold h'
+    for row in table[order]:
+        print ' '.join('%10.4g' %row[name] for name in names) + '    %10.1f  %12.2f  %8.2f  %8.2f  %8.2f' %(
+              row['settlingTime']/60, 1000*row['overshoot'], 1000*row['rms'], 1000*row['peak'], row['holdTime']/3600)
+
+if __name__ == "__main__":
+    import ADRController
+    settings = ADRController.defaultControlSettings()
+    KP = settings.KP*numpy.logspace(-1, 1, 41)
+    KD = settings.KD*numpy.logspace(-1, 1, 41)
+    startTime = time.time()
+    names, table = sweep(settings, KP=KP, KD=KD)
+    wallTime = time.time() - startTime
+    print '%d combinations in %.1f s on %d cores' %(len(table), wallTime, multiprocessing.cpu_count())
+    current = simulateRegulation(arraySettings(settings, 1))
+    print 'Current gains (KP=%g, KD=%g): reached in %.1f min, settled in %.1f min, %.2f mK rms, held %.2f h' %(
+          settings.KP, settings.KD, current['reachTime'][0]/60, current['settlingTime'][0]/60, 1000*current['rms'][0],
+          current['holdTime'][0]/3600)
+    printBest(names, table)
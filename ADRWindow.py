@@ -0,0 +1,366 @@
+"""
+The ADR Controller window: the temperature plot, the Mag Up and Regulate buttons and the message log.  It is
+only a view of an ADRController.ADRCore, which does all the work, so Tkinter and matplotlib (which take most of
+the time and memory it takes to start) are only imported when there is a window to show.
+"""
+
+import matplotlib as mpl
+mpl.use('TkAgg')
+import pylab, numpy
+import Tkinter
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
+from ADRHistory import HistoryBuffer
+from ADRPlotting import stickyLimits, PlotRenderer
+from ADRTiming import timing
+
+"""Inherited from the Tkinter Entry widget, this just turns red when a limit is reached"""
+class EntryWithAlert(Tkinter.Entry):
+    def __init__(self, *args, **kwargs):
+        self.upper_limit = kwargs.pop('upper_limit',False)
+        self.lower_limit = kwargs.pop('lower_limit',False)
+        self.variable = kwargs['textvariable']
+        self.variable.trace('w',self.callback)
+        Tkinter.Entry.__init__(self,*args,**kwargs)
+        self.naturalBGColor = self.cget('disabledbackground')
+    def callback(self,*dummy):
+        if self.upper_limit != False or self.lower_limit != False:
+            x = self.variable.get()
+            if x == '' or float(x) > float(self.upper_limit) or float(x) < float(self.lower_limit):
+                self.configure(disabledbackground='red')
+            else:
+                self.configure(disabledbackground=self.naturalBGColor)
+
+"""This class inherits a Tkinter Text widget to make a simple log box.  It shows the newest messages of the
+ADRCore's log (which writes them to the log file), newest at the top, and sets the color to red for alerts.
+New messages are put in at most once every update_interval ms however many come in, and only the newest
+max_lines are kept, so a burst of alerts can't hold up the window.  setAlertsOnly hides everything else."""
+class LogBox(Tkinter.Text):
+    def __init__(self, *args, **kwargs):
+        self.messageLog = kwargs.pop('log')
+        self.maxLines = kwargs.pop('max_lines', 200)
+        self.updateInterval = kwargs.pop('update_interval', 250)
+        Tkinter.Text.__init__(self,*args,**kwargs)
+        self.tag_config("redAlert", background="red")
+        self.configure(state=Tkinter.DISABLED)
+        self.alertsOnly = False
+        self.lastShown = -1 #the number of the newest message shown
+        self.updatePending = False
+        self.messageLogged() #the ones logged before the window was opened
+    def messageLogged(self):
+        """Called for every new message.  They are shown at the next update."""
+        if self.updatePending: return
+        self.updatePending = True
+        self.after(self.updateInterval, self.showNewMessages)
+    def showNewMessages(self):
+        self.updatePending = False
+        entries = self.messageLog.getEntries(self.lastShown, self.alertsOnly, self.maxLines)
+        self.lastShown = self.messageLog.count - 1
+        if len(entries) == 0: return
+        self.configure(state=Tkinter.NORMAL)
+        for number, messageWithTimeStamp, alert in entries:
+            self.insert(1.0, messageWithTimeStamp, ('redAlert',) if alert else (), '\n')
+        self.delete('%d.0' %(self.maxLines+1), Tkinter.END)
+        self.configure(state=Tkinter.DISABLED)
+    def setAlertsOnly(self, alertsOnly):
+        """Shows only the alerts (the newest max_lines of them that are still in the log's memory), or
+        everything again."""
+        self.alertsOnly = alertsOnly
+        self.configure(state=Tkinter.NORMAL)
+        self.delete(1.0, Tkinter.END)
+        self.configure(state=Tkinter.DISABLED)
+        self.lastShown = -1
+        self.showNewMessages()
+
+""" The window.  core is the ADRCore it shows and controls; it adds itself as a view, so it should be created
+    before core.start().  blit, updateInterval and timingUpdateInterval are PLOT_BLITTING, GUI_UPDATE_INTERVAL and
+    TIMING_WINDOW_UPDATE_INTERVAL, and logLines and logUpdateInterval are LOG_BOX_LINES and LOG_BOX_UPDATE_INTERVAL. """
+class ADRWindow(Tkinter.Tk):
+    def __init__(self, parent, core, blit=True, updateInterval=100, timingUpdateInterval=1000, logLines=200, logUpdateInterval=250):
+        Tkinter.Tk.__init__(self,parent)
+        self.parent = parent
+        self.core = core
+        self.blit = blit
+        self.updateInterval = updateInterval
+        self.timingUpdateInterval = timingUpdateInterval
+        self.logLines = logLines
+        self.logUpdateInterval = logUpdateInterval
+        self.history = HistoryBuffer() #time stamps, temps, backEMF, I and V for every cycle
+        self.initializeWindow()
+        core.addView(self)
+        core.reloadHistory(self.history)
+        self.after(100, self.measurementCycle)
+    def initializeWindow(self):
+        root = self
+        settings = self.core.controlSettings
+        #set up window
+        self.wm_title('ADR Magnet Controller')
+        w, h = self.winfo_screenwidth(), self.winfo_screenheight()
+        self.geometry("%dx%d+0+0" % (w/2, 0.9*h))
+        #error/message box log
+        self.log = LogBox(master=root, height=5, log=self.core.log, max_lines=self.logLines, update_interval=self.logUpdateInterval)
+        self.log.pack(side=Tkinter.TOP, fill=Tkinter.X)
+        # temp plot
+        fig = pylab.figure()
+        self.ax = fig.add_subplot(111)
+        #self.ax2 = self.ax.twinx()
+        self.ax.set_title('Realtime Temperature Readout\n\n\n')
+        self.ax.set_xlabel('Time [s]')
+        self.ax.set_ylabel('Temparture [K]')
+        self.stage60K, = self.ax.plot([],[])
+        self.stage03K, = self.ax.plot([],[])
+        self.stageGGG, = self.ax.plot([],[])
+        self.stageFAA, = self.ax.plot([],[])
+        self.createLegend()
+        self.canvas = FigureCanvasTkAgg(fig, master=root)
+        self.canvas.show()
+        self.canvas.get_tk_widget().pack(side=Tkinter.TOP, fill=Tkinter.BOTH, expand=1)
+        #temp plot toolbar at bottom
+        self.toolbar = NavigationToolbar2TkAgg( self.canvas, root )
+        self.toolbar.update()
+        #self.toolbar.pack(side=Tkinter.BOTTOM, fill=Tkinter.X)
+        self.canvas._tkcanvas.pack(side=Tkinter.TOP, fill=Tkinter.BOTH, expand=1)
+        #only the lines and the legend change every cycle, everything else is cached when blitting
+        self.plotRenderer = PlotRenderer(self.canvas, [self.stage60K,self.stage03K,self.stageGGG,self.stageFAA,self.legend], blit=self.blit)
+        #which temp plots should I show? (checkboxes)
+        tempSelectFrame = Tkinter.Frame(root)
+        tempSelectFrame.pack(side=Tkinter.TOP)
+        self.t60K = Tkinter.IntVar()
+        self.t3K = Tkinter.IntVar()
+        self.tGGG = Tkinter.IntVar()
+        self.tFAA = Tkinter.IntVar()
+        self.t60K.set(0)
+        self.t3K.set(1)
+        self.tGGG.set(1 if self.core.readGGG else 0)
+        self.tFAA.set(1 if self.core.readFAA else 0)
+        t1checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '60K Stage', variable=self.t60K, fg='blue')
+        t1checkbox.pack(side=Tkinter.LEFT)
+        t2checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '3K Stage', variable=self.t3K, fg='forest green')
+        t2checkbox.pack(side=Tkinter.LEFT)
+        t3checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '1K Stage (GGG)', variable=self.tGGG, fg='red', command=self.onRuOxChannelsChanged)
+        t3checkbox.pack(side=Tkinter.LEFT)
+        t4checkbox = Tkinter.Checkbutton(tempSelectFrame, text = '50mK Stage (FAA)', variable=self.tFAA, fg='dark turquoise', command=self.onRuOxChannelsChanged)
+        t4checkbox.pack(side=Tkinter.LEFT)
+        self.plotLines = [(self.stage60K,'60K',self.t60K), (self.stage03K,'3K',self.t3K), (self.stageGGG,'GGG',self.tGGG), (self.stageFAA,'FAA',self.tFAA)]
+        #scale to adjust time shown in temp plot
+        self.wScale = Tkinter.Scale(master=root,label="60*Cycles=Minutes Displayed (1 cycle ~ 1 sec)", from_=1, to=1440,sliderlength=30,length=500, orient=Tkinter.HORIZONTAL)
+        self.wScale.set(1440)
+        self.wScale.pack(side=Tkinter.TOP)
+        #re-decimate the plotted data whenever the visible range or the plot size changes
+        self.settingLimits = False
+        self.wScale.configure(command=self.onPlotChanged)
+        self.canvas.mpl_connect('resize_event', self.onPlotChanged)
+        self.ax.callbacks.connect('xlim_changed', self.onXLimChanged)
+        #frame for mag up and regulate controls
+        magControlsFrame = Tkinter.Frame(root)
+        magControlsFrame.pack(side=Tkinter.TOP)
+        #mag up button
+        self.magUpButton = Tkinter.Button(master=magControlsFrame, text='Mag Up', command=self.core.magUp)
+        self.magUpButton.pack(side=Tkinter.LEFT)
+        #regulate button and temp field
+        self.regulateButton = Tkinter.Button(master=magControlsFrame, text='Regulate', command=self.regulate)
+        self.regulateButton.pack(side=Tkinter.LEFT)
+        Tkinter.Label(magControlsFrame, text=" at ").pack(side=Tkinter.LEFT)
+        self.regulateTemperature = Tkinter.StringVar()
+        self.regulateTemperature.set(str(self.core.regulateTemperature))
+        self.regulateTemperature.trace('w', self.onRegulateTemperatureChanged)
+        self.regulateTempField = Tkinter.Entry(magControlsFrame, textvariable=self.regulateTemperature)
+        self.regulateTempField.pack(side=Tkinter.LEFT)
+        Tkinter.Label(magControlsFrame, text="K").pack(side=Tkinter.LEFT)
+        #shows current values for backEMF, current, voltage
+        monitorFrame = Tkinter.Frame(root)
+        monitorFrame.pack(side=Tkinter.TOP)
+        self.currentBackEMF = Tkinter.StringVar() #current as in now, not as in amps
+        self.currentI = Tkinter.StringVar()
+        self.currentV = Tkinter.StringVar()
+        Tkinter.Label(monitorFrame, text="Back EMF = ").pack(side=Tkinter.LEFT)
+        backEMFField = EntryWithAlert(monitorFrame, textvariable=self.currentBackEMF, state=Tkinter.DISABLED, upper_limit=settings.magnetVoltageLimit)
+        backEMFField.pack(side=Tkinter.LEFT)
+        Tkinter.Label(monitorFrame, text="(V)   I = ").pack(side=Tkinter.LEFT)
+        currentIField = EntryWithAlert(monitorFrame, textvariable=self.currentI, state=Tkinter.DISABLED, upper_limit=settings.currentLimit)
+        currentIField.pack(side=Tkinter.LEFT)
+        Tkinter.Label(monitorFrame, text="(A)   V = ").pack(side=Tkinter.LEFT)
+        currentVField = EntryWithAlert(monitorFrame, textvariable=self.currentV, state=Tkinter.DISABLED, upper_limit=settings.voltageLimit)
+        currentVField.pack(side=Tkinter.LEFT)
+        Tkinter.Label(monitorFrame, text="(V)").pack(side=Tkinter.LEFT)
+        #how long it takes to put the plot on the screen every cycle, and the rest of the timing in its own window
+        timingFrame = Tkinter.Frame(root)
+        timingFrame.pack(side=Tkinter.TOP)
+        self.frameTime = Tkinter.StringVar()
+        Tkinter.Label(timingFrame, textvariable=self.frameTime).pack(side=Tkinter.LEFT)
+        Tkinter.Button(master=timingFrame, text='Timing', command=self.showTiming).pack(side=Tkinter.LEFT)
+        self.alertsOnly = Tkinter.IntVar()
+        Tkinter.Checkbutton(timingFrame, text='Only show alerts in the log', variable=self.alertsOnly,
+                            command=lambda: self.log.setAlertsOnly(self.alertsOnly.get()==1)).pack(side=Tkinter.LEFT)
+        self.timingWindow = None
+        #X BUTTON
+        self.protocol("WM_DELETE_WINDOW", self._quit)
+    def measurementCycle(self):
+        """ This takes care of the real time temperature plotting. It starts immediately upon starting the program, and never stops.
+        The core takes the new samples from the acquisition thread and hands them to showSamples. """
+        self.core.poll()
+        self.after(self.updateInterval, self.measurementCycle)
+    def messageLogged(self):
+        self.log.messageLogged()
+    def showSamples(self, records):
+        """Shows the newest readings, adds the (sample, time stamp, values) recorded by the core to the history
+        and redraws the plot."""
+        for sample, timeStamp, values in records:
+            self.history.append(timeStamp, values)
+        #update current and voltage data
+        self.currentBackEMF.set( "{0:.3f}".format(sample.backEMF) )
+        if sample.psConnected and not numpy.isnan(sample.current):
+            self.currentI.set( "{0:.3f}".format(sample.current) )
+            self.currentV.set( "{0:.3f}".format(sample.voltage) )
+        else:
+            self.currentI.set('')
+            self.currentV.set('')
+        with timing.phase('plot'):
+            self.redrawPlot()
+    def onRuOxChannelsChanged(self):
+        self.core.setRuOxChannels(GGG=self.tGGG.get()==1, FAA=self.tFAA.get()==1)
+    def onRegulateTemperatureChanged(self, *args):
+        try: self.core.regulateTemperature = float(self.regulateTemperature.get())
+        except ValueError: pass
+    def regulate(self):
+        """Called when the Regulate button is pressed."""
+        try: T_target = float(self.regulateTemperature.get())
+        except ValueError as e:
+            self.core.log.log('Cannot regulate: '+str(e)+'\n', alert=True)
+            return
+        self.core.regulate(T_target)
+    def controlChanged(self):
+        """Called by the core when mag up or regulation starts or stops, to change the buttons."""
+        if self.core.isMaggingUp:
+            self.magUpButton.configure(text='Stop Magging Up', command=self.core.stopControl)
+            self.regulateButton.configure(state=Tkinter.DISABLED)
+        elif self.core.isRegulating:
+            self.regulateButton.configure(text='Stop Regulating', command=self.core.stopControl)
+            self.magUpButton.configure(state=Tkinter.DISABLED)
+            if self.regulateTemperature.get() != str(self.core.regulateTemperature):
+                self.regulateTemperature.set(str(self.core.regulateTemperature))
+        else:
+            self.magUpButton.configure(text='Mag Up', command=self.core.magUp, state=Tkinter.NORMAL)
+            self.regulateButton.configure(text='Regulate', command=self.regulate, state=Tkinter.NORMAL)
+    def redrawPlot(self):
+        #decimate the new data and rescale axes, with the x being scaled by the slider
+        self.updatePlot()
+        self.updateLegend()
+        self.plotRenderer.update()
+        meanFrameTime, maxFrameTime = self.plotRenderer.frameTimeStats()
+        self.frameTime.set( "Plot frame time: {0:.1f} ms average, {1:.1f} ms max ({2} full redraws, {3} blits)".format(meanFrameTime, maxFrameTime, self.plotRenderer.fullDraws, self.plotRenderer.blits) )
+    def showTiming(self):
+        """Opens the Timing window, which shows the timing of the cycles, their phases and every GPIB command
+        (see ADRTiming) and can save it all to a file."""
+        if self.timingWindow is not None:
+            self.timingWindow.lift()
+            return
+        self.timingWindow = Tkinter.Toplevel(self)
+        self.timingWindow.wm_title('ADR Controller Timing')
+        self.timingText = Tkinter.Text(self.timingWindow, width=72, height=30, font='TkFixedFont')
+        self.timingText.pack(side=Tkinter.TOP, fill=Tkinter.BOTH, expand=1)
+        buttonFrame = Tkinter.Frame(self.timingWindow)
+        buttonFrame.pack(side=Tkinter.TOP)
+        Tkinter.Button(master=buttonFrame, text='Export', command=self.core.exportTiming).pack(side=Tkinter.LEFT)
+        Tkinter.Button(master=buttonFrame, text='Reset', command=self.resetTiming).pack(side=Tkinter.LEFT)
+        def close():
+            self.timingWindow.destroy()
+            self.timingWindow = None
+        self.timingWindow.protocol("WM_DELETE_WINDOW", close)
+        self.updateTimingWindow()
+    def resetTiming(self):
+        timing.reset()
+        if self.core.bus is not None: self.core.bus.reset()
+    def updateTimingWindow(self):
+        if self.timingWindow is None: return
+        self.timingText.configure(state=Tkinter.NORMAL)
+        self.timingText.delete(1.0, Tkinter.END)
+        summary = timing.summary()
+        #with several cryostats, how much of the bus each one uses
+        if self.core.bus is not None: summary += '\n\n'+self.core.bus.summary()
+        self.timingText.insert(1.0, summary)
+        self.timingText.configure(state=Tkinter.DISABLED)
+        self.after(self.timingUpdateInterval, self.updateTimingWindow)
+    def isAutoscaling(self):
+        """The axes follow the slider unless the toolbar is being used to zoom or pan."""
+        return self.toolbar._active == 'HOME' or self.toolbar._active == None
+    def plotWindow(self):
+        """Returns the (tMin,tMax) time range the plot should show: the range the user zoomed to with the
+        toolbar, or otherwise the last wScale minutes."""
+        if not self.isAutoscaling(): return self.ax.get_xlim()
+        timeStamps = self.history.times()
+        xCyclesMin = max(0,len(self.history)-60*self.wScale.get())
+        if self.wScale.get() == 1440: xCyclesMin = 0
+        return timeStamps[xCyclesMin], timeStamps[-1]
+    def decimatePlotData(self, tMin, tMax):
+        """Gives each visible line the history between tMin and tMax, decimated to about one min/max pair per
+        pixel across the axes, so matplotlib never draws more points than the screen can show.  The history's
+        index does the decimation without scanning the window.  Returns the slice of the history plotted."""
+        window = self.history.windowSlice(tMin, tMax)
+        #one extra point on either side so the lines run all the way to the edges of the plot
+        window = slice(max(0,window.start-1), min(len(self.history),window.stop+1))
+        nBuckets = max(1, int(self.ax.bbox.width))
+        timeStamps, values = self.history.decimate(window, nBuckets)
+        for line, channel, var in self.plotLines:
+            line.set_visible(var.get() == 1)
+            if var.get() == 1:
+                n = self.history.channels.index(channel)
+                line.set_data(timeStamps[n], values[n])
+        return window
+    def updatePlot(self):
+        """Decimates the history for the window being shown and, unless the user zoomed in with the toolbar,
+        rescales the axes to fit it.  The y limits come from the history's min/max index, so neither depends on
+        how long the window is."""
+        if len(self.history) == 0: return
+        xMin, xMax = self.plotWindow()
+        window = self.decimatePlotData(xMin, xMax)
+        if self.isAutoscaling():
+            ymin,ymax = 10000000, -10000000
+            mins, maxs = self.history.extremes(window)
+            for line, channel, var in self.plotLines:
+                n = self.history.channels.index(channel)
+                if var.get() == 1 and not numpy.isnan(mins[n]):
+                    ymin = min(ymin, mins[n])
+                    ymax = max(ymax, maxs[n])
+            if len(self.history)>1:
+                #the limits only move when the data gets near the edges, so the blitted background can be reused
+                xPad = max(5, (xMax-xMin)/20.)
+                xLimits = stickyLimits(self.ax.get_xlim(), (xMin,xMax), (xMin,xMax+xPad), 2*xPad)
+                self.settingLimits = True #don't re-decimate in onXLimChanged, it was just done
+                self.ax.set_xlim(*xLimits)
+                if ymin <= ymax:
+                    yPad = (ymax-ymin)/10
+                    yLimits = stickyLimits(self.ax.get_ylim(), (ymin-yPad/2,ymax+yPad/2), (ymin-yPad,ymax+yPad), 3*yPad)
+                    self.ax.set_ylim(*yLimits)
+                self.settingLimits = False
+    def onPlotChanged(self, *args):
+        """Called when the plot is resized or the time scale slider is moved."""
+        self.updatePlot()
+        self.canvas.draw_idle()
+    def onXLimChanged(self, ax):
+        """Called when the x limits change.  If it was the toolbar (zoom, pan, back/forward) the data needs to
+        be decimated again for the new range."""
+        if self.settingLimits or len(self.history) == 0: return
+        xMin, xMax = self.ax.get_xlim()
+        self.decimatePlotData(xMin, xMax)
+    def createLegend(self):
+        """creates the legend at the top of the temperature plot.  It is only made once, updateLegend changes
+        the temperatures in it."""
+        lines = [self.stage60K,self.stage03K,self.stageGGG,self.stageFAA]
+        #self.ax.legend(lines,labels,loc=0)#,bbox_to_anchor=(1.01, 1)) #legend in upper right
+        self.legend = self.ax.legend(lines,['']*len(lines),bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
+           ncol=4, mode="expand", borderaxespad=0.) #legend on top (if not using this, delete \n in title)
+        self.updateLegend()
+    def updateLegend(self):
+        """updates the temperatures shown in the legend at the top of the temperature plot."""
+        labelOrder = ['60K','3K ','GGG','FAA']
+        newTemps = self.core.newTemps
+        labels = [labelOrder[l]+' ['+"{0:.3f}".format(newTemps[l])+'K]' for l in range(len(labelOrder))]
+        labels = [s.replace('1.#QOK','OoR') for s in labels]
+        for text, label in zip(self.legend.get_texts(), labels):
+            text.set_text(label)
+    def _quit(self):
+        """ called when the window is closed."""
+        self.core.close()
+        self.quit()     # stops mainloop
+        self.destroy()  # this is necessary on Windows to prevent
+                        # Fatal Python Error: PyEval_RestoreThread: NULL tstate
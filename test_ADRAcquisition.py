@@ -0,0 +1,58 @@
+"""
+Tests of how the acquisition thread (ADRAcquisition.AcquisitionEngine) tells whether the SIM922 has measured
+again, including with a back EMF that doesn't change and with a measurement in between the queries of one
+reading.  Run with
+    python -m unittest test_ADRAcquisition
+"""
+
+import unittest
+from ADRAcquisition import AcquisitionEngine
+
+""" A SIM922 that answers with the readings it is given, in turn (the last one over and over). """
+class FakeSIM922:
+    def __init__(self, readings=()):
+        self.readings = list(readings)
+        self.reads = 0
+    def getDiodeTemperaturesAndMagnetVoltage(self):
+        self.reads += 1
+        if len(self.readings) > 1: return self.readings.pop(0)
+        return self.readings[0]
+
+class DiodeReadingTest(unittest.TestCase):
+    def engine(self, requeries=()):
+        self.sim922 = FakeSIM922(requeries)
+        return AcquisitionEngine(self.sim922, None, None, None)
+    def testSameReadingIsNotNew(self):
+        engine = self.engine()
+        engine.checkDiodeReading([50., 3.], 0.01, 1.)
+        self.assertTrue(engine.diodeReadingIsNew)
+        engine.checkDiodeReading([50., 3.], 0.01, 2.)
+        self.assertFalse(engine.diodeReadingIsNew)
+        self.assertEqual(engine.diodeReadTime, 1.)
+    def testConstantBackEMF(self):
+        #with the current held (or at 0), the back EMF reads the same every second
+        engine = self.engine()
+        for n in range(5):
+            engine.checkDiodeReading([50.+0.01*n, 3.+0.001*n], 0.0, float(n))
+            self.assertTrue(engine.diodeReadingIsNew)
+            self.assertEqual(engine.diodeReadTime, float(n))
+        self.assertEqual(self.sim922.reads, 0)
+    def testMeasuredBetweenQueries(self):
+        #only the voltage is from the new measurement, so the one read again is used
+        engine = self.engine([([50.01, 3.001], 0.02)])
+        engine.checkDiodeReading([50., 3.], 0.01, 1.)
+        temps, backEMF = engine.checkDiodeReading([50., 3.], 0.02, 2.)
+        self.assertTrue(engine.diodeReadingIsNew)
+        self.assertEqual((temps, backEMF), ([50.01, 3.001], 0.02))
+        self.assertEqual(self.sim922.reads, 1)
+    def testConstantTemperatures(self):
+        #read again, nothing else changed, so only the voltage did
+        engine = self.engine([([50., 3.], 0.02)])
+        engine.checkDiodeReading([50., 3.], 0.01, 1.)
+        temps, backEMF = engine.checkDiodeReading([50., 3.], 0.02, 2.)
+        self.assertTrue(engine.diodeReadingIsNew)
+        self.assertEqual((temps, backEMF), ([50., 3.], 0.02))
+        self.assertEqual(engine.diodeReadTime, 2.)
+
+if __name__ == "__main__":
+    unittest.main()
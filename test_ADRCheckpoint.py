@@ -0,0 +1,92 @@
+"""
+Tests of the checkpoints (ADRCheckpoint): saving and loading them, getting the older one back after a write that
+was cut off, and the checks before picking up a mag up or regulation again.  Run with
+    python -m unittest test_ADRCheckpoint
+"""
+
+import unittest, tempfile, shutil, os, time
+from ADRCheckpoint import CheckpointFile, checkResume, HEADER_FORMAT
+from ADRAcquisition import Sample
+from ADRControl import ControlSettings
+
+def controlSettings():
+    return ControlSettings(currentLimit=9, voltageLimit=2, magnetVoltageLimit=0.1, magUpdV=0.003, dIdtMagUpLimit=9./(30*60),
+                           dIdtRegulateLimit=9./(40*60), dVdtLimit=0.008, KP=1, KD=0.07)
+
+def checkpoint(control='magUp', I=4., V=1., age=5.):
+    now = time.time()
+    return {'time':now-age, 'control':control, 'sample':{'time':now-age, 'I':I, 'V':V}}
+
+def sample(I=4., V=1., backEMF=0.05, psConnected=True):
+    return Sample(time.time(), [50., 3., 1., 0.1], backEMF, I, V, psConnected)
+
+class CheckpointFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def testNothingSaved(self):
+        self.assertEqual(CheckpointFile(self.directory).load(), None)
+    def testNewestIsLoaded(self):
+        checkpoints = CheckpointFile(self.directory)
+        for n in range(5): checkpoints.save({'n':n})
+        self.assertEqual(checkpoints.load(), {'n':4})
+        #a new run carries on from the saved sequence, overwriting the older file
+        checkpoints = CheckpointFile(self.directory)
+        checkpoints.save({'n':5})
+        self.assertEqual(CheckpointFile(self.directory).load(), {'n':5})
+    def testTornWrite(self):
+        checkpoints = CheckpointFile(self.directory)
+        checkpoints.save({'n':1, 'control':'magUp'})
+        checkpoints.save({'n':2, 'control':'regulate'})
+        newest = checkpoints.paths[checkpoints.sequence % 2]
+        with open(newest, 'rb') as f: data = f.read()
+        for length in [0, 5, HEADER_FORMAT.size, len(data)-1]:
+            with open(newest, 'wb') as f: f.write(data[:length])
+            self.assertEqual(CheckpointFile(self.directory).load(), {'n':1, 'control':'magUp'})
+    def testCorruptBody(self):
+        checkpoints = CheckpointFile(self.directory)
+        checkpoints.save({'n':1})
+        checkpoints.save({'n':2})
+        newest = checkpoints.paths[checkpoints.sequence % 2]
+        with open(newest, 'rb') as f: data = f.read()
+        with open(newest, 'wb') as f: f.write(data[:-2]+'9}')
+        self.assertEqual(CheckpointFile(self.directory).load(), {'n':1})
+    def testCantWrite(self):
+        checkpoints = CheckpointFile(os.path.join(self.directory, 'missing'))
+        self.assertRaises(IOError, checkpoints.save, {'n':1})
+
+class CheckResumeTest(unittest.TestCase):
+    def check(self, checkpoint, sample):
+        return checkResume(checkpoint, sample, controlSettings(), maxAge=600, interval=10)
+    def testUnchanged(self):
+        self.assertEqual(self.check(checkpoint(), sample()), None)
+        self.assertEqual(self.check(checkpoint('regulate'), sample()), None)
+    def testWithinTheRateLimits(self):
+        #mag up could have raised the current by 0.025 A in 5 s, and the voltage by 0.04 V
+        self.assertEqual(self.check(checkpoint(age=5.), sample(I=4.07, V=1.045)), None)
+    def testTooOld(self):
+        self.assertNotEqual(self.check(checkpoint(age=601.), sample()), None)
+    def testNoReadings(self):
+        state = checkpoint()
+        state['sample'] = None
+        self.assertNotEqual(self.check(state, sample()), None)
+    def testPowerSupplyDisconnected(self):
+        self.assertNotEqual(self.check(checkpoint(), sample(psConnected=False)), None)
+    def testLimits(self):
+        self.assertNotEqual(self.check(checkpoint(I=9.), sample(I=9.1)), None)
+        self.assertNotEqual(self.check(checkpoint(V=2.), sample(V=2.1)), None)
+        self.assertNotEqual(self.check(checkpoint(), sample(backEMF=0.2)), None)
+        self.assertNotEqual(self.check(checkpoint(), sample(backEMF=-0.2)), None)
+    def testPowerSupplyReset(self):
+        self.assertNotEqual(self.check(checkpoint(V=1.), sample(V=0.)), None)
+    def testVoltageChangeIsLimitedToOneInterval(self):
+        #however long ago the checkpoint was, the voltage could only have changed in the last interval before the crash
+        self.assertEqual(self.check(checkpoint(age=300.), sample(V=1.08)), None)
+        self.assertNotEqual(self.check(checkpoint(age=300.), sample(V=1.2)), None)
+    def testCurrentJumped(self):
+        self.assertNotEqual(self.check(checkpoint(I=4.), sample(I=5.)), None)
+        self.assertNotEqual(self.check(checkpoint('regulate', I=4.), sample(I=3.5)), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Tests of the mag up planner (ADRControl.MagUpPlanner) on the simulated magnet (ADRSimulator.ADRModel), including
+magnets whose inductance is a lot lower than the planner's model says.  Run with
+    python -m unittest test_ADRControl
+"""
+
+import unittest
+from ADRSimulator import SimulationClock, ADRModel
+from ADRControl import ControlSettings, MagnetModel, MagUpPlanner
+
+MODEL_INDUCTANCE = 10.
+RESISTANCE = 1.69/9
+
+def controlSettings():
+    return ControlSettings(currentLimit=9, voltageLimit=2, magnetVoltageLimit=0.1, magUpdV=0.003, dIdtMagUpLimit=9./(30*60),
+                           dIdtRegulateLimit=9./(40*60), dVdtLimit=0.008, KP=1, KD=0.07)
+
+def magUp(settings, inductance, maxTime=2*60*60, step=1.):
+    """Mags up a simulated magnet of inductance with a planner whose model is MODEL_INDUCTANCE.  Returns (time to
+    the current limit, highest dI/dt over a step, highest back EMF)."""
+    clock = SimulationClock()
+    magnet = ADRModel(clock, inductance=inductance, resistance=RESISTANCE)
+    magnet.outputOn = True
+    magnet.currentSetting = settings.currentLimit
+    planner = MagUpPlanner(MagnetModel(MODEL_INDUCTANCE, RESISTANCE))
+    startTime = clock.time()
+    lastTime, lastCurrent = startTime, 0.
+    maxdIdt, maxBackEMF = 0., 0.
+    while clock.time() - startTime < maxTime:
+        clock.sleep(step)
+        magnet.update()
+        t, I = clock.time(), magnet.current
+        dIdt = (I - lastCurrent)/(t - lastTime)
+        lastTime, lastCurrent = t, I
+        maxdIdt, maxBackEMF = max(maxdIdt, dIdt), max(maxBackEMF, magnet.backEMF)
+        V, finished = planner.step(settings, magnet.outputVoltage, I, magnet.backEMF, dIdt, step)
+        if finished: return t - startTime, maxdIdt, maxBackEMF
+        if V is not None: magnet.voltageSetting = V
+    return float('inf'), maxdIdt, maxBackEMF
+
+class MagUpPlannerTest(unittest.TestCase):
+    def checkLimits(self, inductance):
+        settings = controlSettings()
+        t, maxdIdt, maxBackEMF = magUp(settings, inductance)
+        self.assertTrue(t < 32*60, 'took %.1f min' %(t/60))
+        self.assertTrue(maxdIdt <= 1.02*settings.dIdtMagUpLimit, 'dI/dt reached %.2f times the limit' %(maxdIdt/settings.dIdtMagUpLimit))
+        self.assertTrue(maxBackEMF <= settings.magnetVoltageLimit, 'the back EMF reached %.2f times the limit' %(maxBackEMF/settings.magnetVoltageLimit))
+    def testAsModelled(self):
+        self.checkLimits(MODEL_INDUCTANCE)
+    def testMoreInductance(self):
+        self.checkLimits(2*MODEL_INDUCTANCE)
+    def testLessInductance(self):
+        for inductance in [MODEL_INDUCTANCE/2, MODEL_INDUCTANCE/5, MODEL_INDUCTANCE/10, MODEL_INDUCTANCE/20]:
+            self.checkLimits(inductance)
+
+if __name__ == "__main__":
+    unittest.main()